@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+import logging
+
+logger = logging.getLogger("audio_hub")
+
+import os
+import sys
+import mmap
+import time
+import ctypes
+import struct
+import asyncio
+import platform
+import tempfile
+import threading
+from typing import Optional, BinaryIO, Union
+
+# -------------------------------------------------------------------------------------------------
+# Audio is captured once into a ring buffer in shared memory (a file in
+# /dev/shm), and every service reads it from there instead of from its own
+# copy of the stream.
+#
+# Positions in the ring are sample cursors: the number of samples written
+# since capture started. Cursors only increase, so a cursor sent in an event
+# (e.g., where a wake word was detected) identifies the same audio for every
+# service as long as it's still in the ring.
+#
+# Readers sleep on a sequence number that the writer bumps (and wakes them
+# with a futex) after every write, so new audio is picked up immediately
+# without polling. Where futexes aren't available, readers poll.
+# -------------------------------------------------------------------------------------------------
+
+MAGIC = b"RHAUDIO1"
+
+# magic, sample rate, sample width, channels, capacity (samples)
+_HEADER_FORMAT = "=8sIHHQ"
+
+# Written by the capture process only (8-byte aligned for atomic access)
+_CURSOR_OFFSET = 24
+_CLOSED_OFFSET = 32
+_SEQUENCE_OFFSET = 36
+
+HEADER_SIZE = 64
+
+
+def ring_path(name: str) -> str:
+    """Returns the path of a named ring buffer (in /dev/shm if available)."""
+    if os.path.sep in name:
+        # Already a path
+        return name
+
+    shm_dir = "/dev/shm"
+    if not os.path.isdir(shm_dir):
+        shm_dir = tempfile.gettempdir()
+
+    return os.path.join(shm_dir, name)
+
+
+# futex(2) syscall numbers by machine
+_FUTEX_SYSCALLS = {
+    "x86_64": 202,
+    "i386": 240,
+    "i686": 240,
+    "aarch64": 98,
+    "armv6l": 240,
+    "armv7l": 240,
+}
+
+_FUTEX_WAIT = 0
+_FUTEX_WAKE = 1
+
+# Wake everyone
+_FUTEX_WAKE_ALL = 2**31 - 1
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _load_futex():
+    """Returns (syscall, number) for futex, or None if not supported."""
+    futex_nr = _FUTEX_SYSCALLS.get(platform.machine())
+    if (not sys.platform.startswith("linux")) or (futex_nr is None):
+        return None
+
+    try:
+        return (ctypes.CDLL(None, use_errno=True).syscall, futex_nr)
+    except Exception:
+        logger.exception("futex")
+        return None
+
+
+_futex = _load_futex()
+
+
+# -------------------------------------------------------------------------------------------------
+
+
+class AudioRing:
+    """Ring buffer of raw audio in shared memory.
+
+    One process creates the ring and writes captured audio to it. Any number
+    of processes can attach and read any audio that hasn't been overwritten
+    yet (the last capacity samples).
+    """
+
+    def __init__(self, path: str, ring_mmap: mmap.mmap, inode: Optional[int] = None):
+        self.path = path
+        self._mmap = ring_mmap
+
+        magic, self.sample_rate, self.sample_width, self.channels, self.capacity = (
+            struct.unpack_from(_HEADER_FORMAT, ring_mmap)
+        )
+
+        if magic != MAGIC:
+            raise ValueError(f"Not an audio ring buffer: {path}")
+
+        self.frame_bytes = self.sample_width * self.channels
+        self.data_bytes = self.capacity * self.frame_bytes
+
+        # Single loads/stores of the shared counters
+        self._cursor = ctypes.c_uint64.from_buffer(ring_mmap, _CURSOR_OFFSET)
+        self._closed = ctypes.c_uint32.from_buffer(ring_mmap, _CLOSED_OFFSET)
+        self._sequence = ctypes.c_uint32.from_buffer(ring_mmap, _SEQUENCE_OFFSET)
+
+        # Identifies this ring's file after a new ring replaces it at path
+        self._inode = inode
+
+        self._data = memoryview(ring_mmap)[HEADER_SIZE : HEADER_SIZE + self.data_bytes]
+
+        # Partial sample left over from the last write
+        self._pending = b""
+
+    @classmethod
+    def create(
+        cls,
+        name: str,
+        seconds: float = 10,
+        sample_rate: int = 16000,
+        sample_width: int = 2,
+        channels: int = 1,
+    ) -> "AudioRing":
+        """Creates (or replaces) a ring buffer that holds seconds of audio."""
+        path = ring_path(name)
+        capacity = int(seconds * sample_rate)
+        size = HEADER_SIZE + (capacity * sample_width * channels)
+
+        # Readers of a replaced ring keep their old mapping
+        temp_path = f"{path}.{os.getpid()}"
+        with open(temp_path, "w+b") as ring_file:
+            ring_file.truncate(size)
+            ring_mmap = mmap.mmap(ring_file.fileno(), size)
+            inode = os.fstat(ring_file.fileno()).st_ino
+
+        struct.pack_into(
+            _HEADER_FORMAT,
+            ring_mmap,
+            0,
+            MAGIC,
+            sample_rate,
+            sample_width,
+            channels,
+            capacity,
+        )
+
+        os.rename(temp_path, path)
+        logger.debug(f"Created audio ring at {path} ({seconds} second(s))")
+
+        return cls(path, ring_mmap, inode=inode)
+
+    @classmethod
+    def attach(cls, name: str, wait_seconds: Optional[float] = None) -> "AudioRing":
+        """Opens an existing ring buffer, waiting for it to be created if needed."""
+        path = ring_path(name)
+        start_time = time.time()
+        while not os.path.exists(path):
+            if (wait_seconds is not None) and (
+                (time.time() - start_time) > wait_seconds
+            ):
+                raise FileNotFoundError(path)
+
+            time.sleep(0.1)
+
+        with open(path, "r+b") as ring_file:
+            ring_mmap = mmap.mmap(ring_file.fileno(), 0)
+            inode = os.fstat(ring_file.fileno()).st_ino
+
+        return cls(path, ring_mmap, inode=inode)
+
+    # -------------------------------------------------------------------------
+
+    @property
+    def cursor(self) -> int:
+        """Number of samples written so far."""
+        return self._cursor.value
+
+    @property
+    def oldest(self) -> int:
+        """Cursor of the oldest sample still in the ring."""
+        return max(0, self.cursor - self.capacity)
+
+    @property
+    def closed(self) -> bool:
+        """True if capture has finished."""
+        return self._closed.value != 0
+
+    @property
+    def sequence(self) -> int:
+        """Bumped after every write (and on close)."""
+        return self._sequence.value
+
+    @property
+    def replaced(self) -> bool:
+        """True if this ring is no longer the one at path (removed or re-created)."""
+        if self._inode is None:
+            return False
+
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except FileNotFoundError:
+            return True
+
+    def wait(self, sequence: int, timeout: float) -> bool:
+        """Blocks until the ring is written to after sequence was read.
+
+        Returns early on a write or close, or after timeout seconds. Returns
+        False without waiting if futexes aren't supported (caller polls).
+        """
+        if _futex is None:
+            return False
+
+        syscall, futex_nr = _futex
+        timeout_spec = _Timespec(int(timeout), int((timeout % 1) * 1e9))
+
+        # Returns immediately if the sequence has already changed
+        syscall(
+            ctypes.c_long(futex_nr),
+            ctypes.c_void_p(ctypes.addressof(self._sequence)),
+            ctypes.c_int(_FUTEX_WAIT),
+            ctypes.c_uint32(sequence),
+            ctypes.byref(timeout_spec),
+            None,
+            ctypes.c_int(0),
+        )
+
+        return True
+
+    def _notify(self):
+        """Bumps the sequence number and wakes up waiting readers."""
+        self._sequence.value = (self._sequence.value + 1) & 0xFFFFFFFF
+
+        if _futex is not None:
+            syscall, futex_nr = _futex
+            syscall(
+                ctypes.c_long(futex_nr),
+                ctypes.c_void_p(ctypes.addressof(self._sequence)),
+                ctypes.c_int(_FUTEX_WAKE),
+                ctypes.c_int(_FUTEX_WAKE_ALL),
+                None,
+                None,
+                ctypes.c_int(0),
+            )
+
+    def write(self, data: bytes) -> int:
+        """Appends audio to the ring, returning the new cursor."""
+        if len(self._pending) > 0:
+            data = self._pending + data
+
+        num_samples = len(data) // self.frame_bytes
+        self._pending = bytes(data[num_samples * self.frame_bytes :])
+
+        cursor = self._cursor.value
+        if num_samples > self.capacity:
+            # Only the most recent audio fits
+            skip = num_samples - self.capacity
+            data = memoryview(data)[skip * self.frame_bytes :]
+            cursor += skip
+            num_samples = self.capacity
+
+        # Copy (wrapping around the end), then publish the new cursor
+        start = (cursor % self.capacity) * self.frame_bytes
+        num_bytes = num_samples * self.frame_bytes
+        first_bytes = min(num_bytes, self.data_bytes - start)
+
+        with memoryview(data) as data_view:
+            self._data[start : start + first_bytes] = data_view[:first_bytes]
+            if first_bytes < num_bytes:
+                self._data[: num_bytes - first_bytes] = data_view[first_bytes:num_bytes]
+
+        self._cursor.value = cursor + num_samples
+        self._notify()
+
+        return cursor + num_samples
+
+    def read(self, start: int, end: Optional[int] = None) -> bytes:
+        """Copies audio between two cursors (end defaults to the current cursor).
+
+        Raises ValueError if any of the audio has already been overwritten.
+        """
+        if end is None:
+            end = self.cursor
+
+        end = min(end, self.cursor)
+        if start >= end:
+            return bytes()
+
+        if start < self.oldest:
+            raise ValueError(f"Audio at {start} is gone (oldest is {self.oldest})")
+
+        num_bytes = (end - start) * self.frame_bytes
+        offset = (start % self.capacity) * self.frame_bytes
+        first_bytes = min(num_bytes, self.data_bytes - offset)
+
+        if first_bytes == num_bytes:
+            audio = self._data[offset : offset + num_bytes].tobytes()
+        else:
+            # Wraps around the end
+            audio = b"".join(
+                (self._data[offset:], self._data[: num_bytes - first_bytes])
+            )
+
+        # Writer may have lapped us while copying
+        if start < self.oldest:
+            raise ValueError(f"Audio at {start} was overwritten while reading")
+
+        return audio
+
+    def close(self):
+        """Marks capture as finished (readers get end of file)."""
+        self._closed.value = 1
+        self._notify()
+
+    def unlink(self):
+        """Removes the ring buffer (attached readers keep their mapping)."""
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+# -------------------------------------------------------------------------------------------------
+
+
+class AudioReader:
+    """File-like reader that follows a ring buffer from a cursor.
+
+    Reads block until audio is available and return whatever is there (up to
+    the requested size), like read1 on a pipe. An empty result means capture
+    has finished or the ring was replaced by a new capture (attach again to
+    follow it). A reader that falls more than the ring's capacity behind
+    skips ahead to the oldest audio.
+
+    While waiting, the ring is checked for replacement every check_seconds.
+    poll_seconds is only used where readers can't sleep on the ring.
+    """
+
+    def __init__(
+        self,
+        ring: AudioRing,
+        cursor: Optional[int] = None,
+        poll_seconds: float = 0.005,
+        check_seconds: float = 0.5,
+    ):
+        self.ring = ring
+        self.poll_seconds = poll_seconds
+        self.check_seconds = check_seconds
+
+        # Start with new audio by default
+        self.cursor = ring.cursor if cursor is None else cursor
+
+        # Samples lost by falling too far behind
+        self.dropped = 0
+
+    @classmethod
+    def attach(cls, name: str, **kwargs) -> "AudioReader":
+        return cls(AudioRing.attach(name), **kwargs)
+
+    def seek(self, cursor: int):
+        """Moves to a cursor (clamped to what's still in the ring)."""
+        self.cursor = max(self.ring.oldest, min(cursor, self.ring.cursor))
+
+    def rewind(self, num_samples: int):
+        """Moves back for pre-roll audio."""
+        self.seek(self.cursor - num_samples)
+
+    def read(self, size: int = -1) -> bytes:
+        if size == 0:
+            return bytes()
+
+        check_time = time.time() + self.check_seconds
+        while True:
+            # Read before the cursor, so a write in between ends the wait
+            sequence = self.ring.sequence
+
+            write_cursor = self.ring.cursor
+            if write_cursor > self.cursor:
+                break
+
+            if self.ring.closed:
+                # End of audio
+                return bytes()
+
+            if time.time() >= check_time:
+                if self.ring.replaced:
+                    # Capture was restarted (or crashed and was cleaned up)
+                    logger.warning(f"Audio ring was replaced: {self.ring.path}")
+                    return bytes()
+
+                check_time = time.time() + self.check_seconds
+
+            if not self.ring.wait(sequence, self.check_seconds):
+                time.sleep(self.poll_seconds)
+
+        end = write_cursor
+        if size > 0:
+            end = min(end, self.cursor + max(1, size // self.ring.frame_bytes))
+
+        while True:
+            if self.cursor < self.ring.oldest:
+                oldest = self.ring.oldest
+                logger.warning(
+                    f"Reader fell behind, skipping {oldest - self.cursor} sample(s)"
+                )
+                self.dropped += oldest - self.cursor
+                self.cursor = oldest
+                end = max(end, self.cursor + 1)
+
+            try:
+                audio = self.ring.read(self.cursor, end)
+                break
+            except ValueError:
+                # Overwritten while reading
+                continue
+
+        self.cursor += len(audio) // self.ring.frame_bytes
+
+        return audio
+
+    read1 = read
+
+    def close(self):
+        pass
+
+
+# -------------------------------------------------------------------------------------------------
+
+
+async def read_chunks(audio_file: Union[BinaryIO, AudioReader], read_size: int):
+    """Yields (chunk, cursor) for whatever audio is available (up to read_size).
+
+    cursor is the ring buffer cursor after the chunk when reading from an
+    audio hub, and None otherwise.
+    """
+    if isinstance(audio_file, AudioReader):
+        loop = asyncio.get_event_loop()
+        chunks: asyncio.Queue = asyncio.Queue()
+
+        def read_ring():
+            while True:
+                chunk = audio_file.read(read_size)
+                loop.call_soon_threadsafe(chunks.put_nowait, (chunk, audio_file.cursor))
+                if len(chunk) == 0:
+                    break
+
+        # Reads block, so they're done in a daemon thread that can't hold up exit
+        threading.Thread(target=read_ring, daemon=True).start()
+
+        while True:
+            chunk, cursor = await chunks.get()
+            if len(chunk) == 0:
+                # End of audio
+                break
+
+            yield chunk, cursor
+    else:
+        from event_bus import open_reader
+
+        audio_reader = await open_reader(audio_file)
+        while True:
+            chunk = await audio_reader.read(read_size)
+            if len(chunk) == 0:
+                # End of audio
+                break
+
+            yield chunk, None
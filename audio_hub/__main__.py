@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import logging
+
+logger = logging.getLogger("audio_hub")
+
+import os
+import sys
+import argparse
+
+from audio_hub import AudioRing, AudioReader
+
+# -------------------------------------------------------------------------------------------------
+
+
+def main():
+    parser = argparse.ArgumentParser("audio_hub")
+    parser.add_argument(
+        "command",
+        choices=["capture", "read"],
+        help="capture audio into the ring buffer, or read it out again",
+    )
+    parser.add_argument(
+        "--name",
+        default="rhasspy-audio",
+        help="Name of ring buffer in /dev/shm (or path, default=rhasspy-audio)",
+    )
+    parser.add_argument(
+        "--audio-file",
+        help="File to read raw audio data from (16-bit 16Khz mono PCM, default=stdin)",
+    )
+    parser.add_argument(
+        "--seconds",
+        type=float,
+        default=10,
+        help="Seconds of audio kept in the ring buffer (capture, default=10)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1024,
+        help="Number of bytes to read at a time (capture, default=1024)",
+    )
+    parser.add_argument(
+        "--rewind-seconds",
+        type=float,
+        default=0,
+        help="Start reading this many seconds in the past (read, default=0)",
+    )
+    parser.add_argument(
+        "--debug", action="store_true", help="Print DEBUG messages to console"
+    )
+
+    args, _ = parser.parse_known_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    logger.debug(args)
+
+    # -------------------------------------------------------------------------
+
+    if args.command == "capture":
+        audio_file = sys.stdin.buffer
+        if args.audio_file and (args.audio_file != "-"):
+            audio_file = open(args.audio_file, "rb")
+
+        ring = AudioRing.create(args.name, seconds=args.seconds)
+        read = getattr(audio_file, "read1", audio_file.read)
+
+        try:
+            while True:
+                chunk = read(args.chunk_size)
+                if len(chunk) == 0:
+                    # End of audio
+                    break
+
+                ring.write(chunk)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            logger.debug(f"Captured {ring.cursor} sample(s)")
+            ring.close()
+            ring.unlink()
+    else:
+        # Write audio to stdout for programs that read a stream
+        reader = AudioReader.attach(args.name)
+        reader.rewind(int(args.rewind_seconds * reader.ring.sample_rate))
+
+        try:
+            while True:
+                chunk = reader.read(args.chunk_size)
+                if len(chunk) == 0:
+                    break
+
+                sys.stdout.buffer.write(chunk)
+                sys.stdout.buffer.flush()
+        except (KeyboardInterrupt, BrokenPipeError):
+            pass
+
+
+# -------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+import logging
+
+logger = logging.getLogger("event_bus")
+
+import os
+import json
+import queue
+import asyncio
+import threading
+from typing import (
+    Optional,
+    Dict,
+    Any,
+    Tuple,
+    List,
+    Callable,
+    Iterable,
+    Iterator,
+    TextIO,
+    BinaryIO,
+    Union,
+)
+
+# -------------------------------------------------------------------------------------------------
+# Events are sent one per line as <topic> <json>.
+#
+# Topics are <prefix>/<service>/<event>[/<request id>], so the first three
+# parts (the base topic) determine how an event is handled and the rest is
+# echoed back in responses.
+# -------------------------------------------------------------------------------------------------
+
+# Longest event line that can be read (bytes)
+LINE_LIMIT = 2**20
+
+# Same output as jsonlines.Writer
+_encode_json = json.JSONEncoder(ensure_ascii=False).encode
+
+
+def maybe_object(json_str) -> Dict[str, Any]:
+    """Parses a JSON object, returning an empty object if parsing fails."""
+    try:
+        return json.loads(json_str)
+    except:
+        return {}
+
+
+def parse_topic(topic: str) -> Tuple[str, str]:
+    """Splits a topic into its base topic and request id (empty or /...)."""
+    topic_parts = topic.split("/", maxsplit=3)
+    base_topic = "/".join(topic_parts[:3])
+
+    # Everything after base topic is request id
+    request_id = ""
+    if (len(topic_parts) > 3) and (len(topic_parts[3]) > 0):
+        request_id = "/" + topic_parts[3]
+
+    return base_topic, request_id
+
+
+def parse_event(line: str) -> Tuple[str, str, str]:
+    """Splits a <topic> <json> line into base topic, request id, and payload."""
+    # Raises ValueError if there is no payload
+    topic, event = line.split(" ", maxsplit=1)
+    base_topic, request_id = parse_topic(topic)
+
+    return base_topic, request_id, event
+
+
+def format_event(topic: Optional[str], payload_dict: Dict[str, Any] = {}) -> str:
+    """Creates a <topic> <json> line (just JSON if topic is None)."""
+    if topic is None:
+        return _encode_json(payload_dict) + "\n"
+
+    return topic + " " + _encode_json(payload_dict) + "\n"
+
+
+# -------------------------------------------------------------------------------------------------
+
+
+class EventWriter:
+    """Thread-safe writer for services that send events from multiple threads.
+
+    Each event is encoded once and written with a single call.
+    """
+
+    def __init__(self, out_file: TextIO):
+        self.out_file = out_file
+        self._lock = threading.Lock()
+
+    def send(self, topic: Optional[str], payload_dict: Dict[str, Any] = {}, flush=True):
+        line = format_event(topic, payload_dict)
+        with self._lock:
+            self.out_file.write(line)
+
+            if flush:
+                self.out_file.flush()
+
+    def flush(self):
+        with self._lock:
+            self.out_file.flush()
+
+
+# -------------------------------------------------------------------------------------------------
+
+
+class MqttClient:
+    """Persistent connection to an MQTT broker (requires paho-mqtt).
+
+    Messages on the subscribed topics become <topic> <payload> lines, so
+    they're handled exactly like lines from an events file. Iterate over the
+    client to get lines in order, or set on_line to get them as they arrive
+    (on the client's network thread).
+    """
+
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 1883,
+        topics: Iterable[str] = (),
+        on_line: Optional[Callable[[str], None]] = None,
+    ):
+        self.host = host
+        self.port = port
+        self.topics = list(topics)
+        self.on_line = on_line
+
+        self._lines: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._client = None
+
+    def connect(self):
+        import paho.mqtt.client as mqtt
+
+        self._client = mqtt.Client()
+        self._client.on_connect = self._on_connect
+        self._client.on_message = self._on_message
+
+        # Network thread reconnects automatically
+        self._client.connect(self.host, self.port)
+        self._client.loop_start()
+
+    def send(self, topic: Optional[str], payload_dict: Dict[str, Any] = {}, flush=True):
+        assert self._client is not None, "Not connected"
+        if topic is None:
+            # Plain JSON output (no topic) has nowhere to go on a broker
+            logger.warning(f"Not publishing event without a topic: {payload_dict}")
+            return
+
+        self._client.publish(topic, _encode_json(payload_dict))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._client is not None:
+            self._client.loop_stop()
+            self._client.disconnect()
+            self._client = None
+
+        self._lines.put(None)
+
+    def __iter__(self) -> Iterator[str]:
+        while True:
+            line = self._lines.get()
+            if line is None:
+                break
+
+            yield line
+
+    def _on_connect(self, client, userdata, flags, rc):
+        # Subscriptions are lost when reconnecting
+        logger.debug(f"Connected to {self.host}:{self.port} (rc={rc})")
+        for topic in self.topics:
+            client.subscribe(topic)
+
+    def _on_message(self, client, userdata, msg):
+        # Payload is passed along without being parsed
+        payload = msg.payload.decode().strip()
+        line = msg.topic + " " + (payload or "{}")
+
+        if self.on_line is not None:
+            self.on_line(line)
+        else:
+            self._lines.put(line)
+
+
+# -------------------------------------------------------------------------------------------------
+# Transports
+# -------------------------------------------------------------------------------------------------
+
+
+class Transport:
+    """Carries event lines between a service and the rest of the system."""
+
+    async def open(self, topics: List[str]):
+        """Connects, receiving events for topics (MQTT-style wildcards)."""
+        pass
+
+    async def read_line(self) -> Optional[str]:
+        """Returns the next event line or None when there are no more events."""
+        raise NotImplementedError()
+
+    def send(self, topic: Optional[str], payload_dict: Dict[str, Any] = {}):
+        self.write(format_event(topic, payload_dict))
+
+    def write(self, line: str):
+        raise NotImplementedError()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StdioTransport(Transport):
+    """Events from a text file (e.g., stdin) and to a text file (e.g., stdout)."""
+
+    def __init__(self, in_file: Optional[TextIO], out_file: TextIO):
+        self.in_file = in_file
+        self.out_file = out_file
+        self._reader: Optional[asyncio.StreamReader] = None
+
+    async def open(self, topics: List[str]):
+        if self.in_file is not None:
+            self._reader = await open_reader(self.in_file)
+
+    async def read_line(self) -> Optional[str]:
+        if self._reader is None:
+            return None
+
+        line = await self._reader.readline()
+        if len(line) == 0:
+            return None
+
+        return line.decode()
+
+    def write(self, line: str):
+        self.out_file.write(line)
+
+    def flush(self):
+        self.out_file.flush()
+
+
+class UnixSocketTransport(Transport):
+    """Events to and from a Unix domain socket (one per line both ways)."""
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def open(self, topics: List[str]):
+        self._reader, self._writer = await asyncio.open_unix_connection(
+            self.socket_path
+        )
+        logger.debug(f"Connected to {self.socket_path}")
+
+    async def read_line(self) -> Optional[str]:
+        assert self._reader is not None, "Not connected"
+        line = await self._reader.readline()
+        if len(line) == 0:
+            return None
+
+        return line.decode()
+
+    def write(self, line: str):
+        assert self._writer is not None, "Not connected"
+        self._writer.write(line.encode())
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+class MqttTransport(Transport):
+    """Events to and from an MQTT broker over one persistent connection."""
+
+    def __init__(self, host: str = "localhost", port: int = 1883):
+        self.client = MqttClient(host, port)
+        self._lines: Optional[asyncio.Queue] = None
+
+    async def open(self, topics: List[str]):
+        loop = asyncio.get_event_loop()
+        self._lines = asyncio.Queue()
+
+        def on_line(line: str):
+            loop.call_soon_threadsafe(self._lines.put_nowait, line)
+
+        self.client.topics = topics
+        self.client.on_line = on_line
+        await loop.run_in_executor(None, self.client.connect)
+
+    async def read_line(self) -> Optional[str]:
+        assert self._lines is not None, "Not connected"
+        return await self._lines.get()
+
+    def send(self, topic: Optional[str], payload_dict: Dict[str, Any] = {}):
+        self.client.send(topic, payload_dict)
+
+    def close(self):
+        self.client.close()
+
+
+def make_transport(
+    events_in_file: Optional[TextIO],
+    events_out_file: TextIO,
+    events_socket: Optional[str] = None,
+    mqtt_host: Optional[str] = None,
+    mqtt_port: int = 1883,
+) -> Transport:
+    """Creates a transport from the usual service command-line arguments."""
+    if mqtt_host:
+        return MqttTransport(mqtt_host, mqtt_port)
+
+    if events_socket:
+        return UnixSocketTransport(events_socket)
+
+    return StdioTransport(events_in_file, events_out_file)
+
+
+# -------------------------------------------------------------------------------------------------
+
+
+async def open_reader(
+    in_file: Union[TextIO, BinaryIO], limit: int = LINE_LIMIT
+) -> asyncio.StreamReader:
+    """Reads a file (e.g., audio or events) on the event loop.
+
+    Pipes and sockets are read directly by the loop. Regular files can't be
+    polled, so they're read by a thread instead.
+    """
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader(limit=limit)
+
+    try:
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), in_file
+        )
+    except ValueError:
+        # Not a pipe, socket, or character device
+        def read_file():
+            try:
+                while True:
+                    data = os.read(in_file.fileno(), 4096)
+                    if len(data) == 0:
+                        break
+
+                    loop.call_soon_threadsafe(reader.feed_data, data)
+            finally:
+                loop.call_soon_threadsafe(reader.feed_eof)
+
+        threading.Thread(target=read_file, daemon=True).start()
+
+    return reader
+
+
+# -------------------------------------------------------------------------------------------------
+
+
+class EventBus:
+    """Routes incoming events to handlers on an asyncio event loop.
+
+    Handlers are looked up by base topic and called with (request_id,
+    payload), where payload is the unparsed JSON. Coroutine handlers are
+    awaited before the next event is read.
+
+    Sent events are buffered and flushed together once the loop has nothing
+    else ready to run, so a burst of events costs one flush.
+    """
+
+    def __init__(
+        self,
+        transport: Transport,
+        error_topic: Optional[str] = None,
+        text_input_topic: Optional[str] = None,
+    ):
+        self.transport = transport
+
+        # Errors from handlers are sent to this topic (+ request id)
+        self.error_topic = error_topic
+
+        # Treat each line as {"text": line} for this topic (--text-input)
+        self.text_input_topic = text_input_topic
+
+        # base topic -> handler
+        self.handlers: Dict[str, Callable[[str, str], Any]] = {}
+
+        self._flush_handle: Optional[asyncio.Handle] = None
+
+    def on(self, base_topic: str, handler: Callable[[str, str], Any]):
+        """Sets the handler for a base topic."""
+        self.handlers[base_topic] = handler
+
+    def send(self, topic: Optional[str], payload_dict: Dict[str, Any] = {}):
+        """Buffers an outgoing event and schedules a flush."""
+        self.transport.send(topic, payload_dict)
+
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_soon(self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        self.transport.flush()
+
+    async def run(self):
+        """Handles events until the transport has no more."""
+        # Base topic and any request id
+        await self.transport.open([topic + "/#" for topic in self.handlers])
+
+        try:
+            while True:
+                line = await self.transport.read_line()
+                if line is None:
+                    break
+
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+
+                logger.debug(line)
+                request_id = ""
+
+                try:
+                    if self.text_input_topic:
+                        # Assume text input
+                        base_topic = self.text_input_topic
+                        event = json.dumps({"text": line})
+                    else:
+                        # Expected <topic> <payload> on each line
+                        base_topic, request_id, event = parse_event(line)
+
+                    handler = self.handlers.get(base_topic)
+                    if handler is not None:
+                        result = handler(request_id, event)
+                        if asyncio.iscoroutine(result):
+                            await result
+                except Exception as e:
+                    logger.exception(line)
+                    if self.error_topic:
+                        self.send(self.error_topic + request_id, {"error": str(e)})
+        finally:
+            self.flush()
+
+
+def run(coro):
+    """Runs a coroutine to completion on a new event loop."""
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(coro)
+    finally:
+        # Cancel tasks left running (e.g., audio readers or exiting on a signal)
+        all_tasks = getattr(asyncio, "all_tasks", None) or asyncio.Task.all_tasks
+        tasks = [task for task in all_tasks(loop) if not task.done()]
+        for task in tasks:
+            task.cancel()
+
+        if len(tasks) > 0:
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -29,7 +29,8 @@ def main():
         help="Directory with named entity recognition (NER) models (one directory per intent)",
     )
     parser.add_argument(
-        "--intent-fst", help="Path to intent finite state transducer for slot FSTs"
+        "--intent-artifact",
+        help="Path to memory-mapped recognizer artifact for slot FSTs",
     )
     parser.add_argument(
         "--lower", action="store_true", help="Automatically lower-case input text"
@@ -69,6 +70,7 @@ def main():
     # Doing imports later because they're so slow (ensure --help is fast)
     import flair, torch
     from .flair_rhasspy import load_models, recognize, make_slot_fsts
+    from jsgf2fst import IntentArtifact
 
     # Configure logging (flair screws with it)
     logging.config.dictConfig(
@@ -100,11 +102,11 @@ def main():
     if args.debug:
         logging.root.setLevel(logging.DEBUG)
 
-    # Load intent FST
-    if args.intent_fst is not None:
-        logger.debug(f"Loading intent FST from {args.intent_fst}")
-        intent_fst = fst.Fst.read(args.intent_fst)
-        intent_to_slots = make_slot_fsts(intent_fst)
+    # Load slot FSTs from intent artifact
+    intent_to_slots = {}
+    if args.intent_artifact is not None:
+        logger.debug(f"Loading intent artifact from {args.intent_artifact}")
+        intent_to_slots = make_slot_fsts(IntentArtifact(args.intent_artifact))
         logger.debug(
             "Intent slots: {}".format(
                 {
@@ -9,7 +9,7 @@ import pywrapfst as fst
 from flair.data import Sentence
 from flair.models import TextClassifier, SequenceTagger
 
-from jsgf2fst import fstaccept
+from jsgf2fst import fstaccept, IntentArtifact
 
 logger = logging.getLogger("flair_rhasspy")
 
@@ -120,83 +120,16 @@ def load_models(
 # -------------------------------------------------------------------------------------------------
 
 
-def make_slot_fsts(intent_fst: fst.Fst) -> Dict[str, Dict[str, fst.Fst]]:
-    out_symbols = intent_fst.output_symbols()
-    intent_to_slots: Dict[str, Dict[str, fst.Fst]] = {}
-
-    start_state = intent_fst.start()
-    for intent_arc in intent_fst.arcs(start_state):
-        # Extract intent name from output label
-        intent_label = out_symbols.find(intent_arc.olabel).decode()
-        assert intent_label.startswith("__label__"), intent_label
-        intent_name = intent_label[9:]
-
-        # Create mapping from slot (tag) name to acceptor FST
-        slot_to_fst: Dict[str, fst.Fst] = {}
-        intent_to_slots[intent_name] = slot_to_fst
-
-        _make_slot_fst(intent_arc.nextstate, intent_fst, slot_to_fst)
-
-    return intent_to_slots
-
-
-def _make_slot_fst(state: int, intent_fst: fst.Fst, slot_to_fst: Dict[str, fst.Fst]):
-    out_symbols = intent_fst.output_symbols()
-    one_weight = fst.Weight.One(intent_fst.weight_type())
-
-    for arc in intent_fst.arcs(state):
-        label = out_symbols.find(arc.olabel).decode()
-        if label.startswith("__begin__"):
-            slot_name = label[9:]
-
-            # Big assumption here that each instance of a slot (e.g., location)
-            # will produce the same FST, and therefore doesn't need to be
-            # processed again.
-            if slot_name in slot_to_fst:
-                continue  # skip duplicate slots
-
-            end_label = f"__end__{slot_name}"
-
-            # Create new FST
-            slot_fst = fst.Fst()
-            slot_fst.set_input_symbols(intent_fst.input_symbols())
-            slot_fst.set_output_symbols(intent_fst.output_symbols())
-
-            start_state = slot_fst.add_state()
-            slot_fst.set_start(start_state)
-            q = [arc.nextstate]
-            state_map = {arc.nextstate: start_state}
-
-            # Copy states/arcs from intent FST until __end__ is found
-            while len(q) > 0:
-                q_state = q.pop()
-                for q_arc in intent_fst.arcs(q_state):
-                    slot_arc_label = out_symbols.find(q_arc.olabel).decode()
-                    if slot_arc_label != end_label:
-                        if not q_arc.nextstate in state_map:
-                            state_map[q_arc.nextstate] = slot_fst.add_state()
-
-                        # Create arc
-                        slot_fst.add_arc(
-                            state_map[q_state],
-                            fst.Arc(
-                                q_arc.ilabel,
-                                q_arc.olabel,
-                                one_weight,
-                                state_map[q_arc.nextstate],
-                            ),
-                        )
-
-                        # Continue copy
-                        q.append(q_arc.nextstate)
-                    else:
-                        # Mark previous state as final
-                        slot_fst.set_final(state_map[q_state])
-
-            slot_to_fst[slot_name] = minimize_fst(slot_fst)
-
-        # Recurse
-        _make_slot_fst(arc.nextstate, intent_fst, slot_to_fst)
+def make_slot_fsts(artifact: IntentArtifact) -> Dict[str, Dict[str, fst.Fst]]:
+    # Big assumption here that each instance of a slot (e.g., location)
+    # will produce the same FST, so only the first instance is used.
+    return {
+        intent_name: {
+            slot_name: minimize_fst(slot_fst)
+            for slot_name, slot_fst in slot_fsts.items()
+        }
+        for intent_name, slot_fsts in artifact.slot_fsts().items()
+    }
 
 
 # -------------------------------------------------------------------------------------------------
@@ -6,18 +6,25 @@ logger = logging.getLogger("fsticuffs")
 import os
 import sys
 import argparse
-import json
-from typing import Optional, Dict, Any, Set
-
-import jsonlines
-import pywrapfst as fst
-
+import time
+import asyncio
+import multiprocessing
+import multiprocessing.pool
+from typing import Optional, Dict, Any, Set, List, Tuple, Callable
+
+import event_bus
+from event_bus import EventBus, EventWriter, make_transport, maybe_object
 from intent_recognition.fsticuffs.fsticuffs import (
     recognize,
     empty_intent,
-    fst_to_graph,
     recognize_fuzzy,
+    IntentMatcher,
+    IntentGraph,
+    IntentCache,
+    load_or_make_graph,
+    tokenize,
 )
+from training.jsgf2fst import IntentArtifact, load_intent_manifest
 
 # -------------------------------------------------------------------------------------------------
 # MQTT Events
@@ -28,19 +35,27 @@ EVENT_PREFIX = "rhasspy/intent-recognition/"
 # Input
 EVENT_RECOGNIZE = EVENT_PREFIX + "recognize-intent"
 EVENT_RELOAD = EVENT_PREFIX + "reload"
+EVENT_GET_STATS = EVENT_PREFIX + "get-stats"
 
 # Output
 EVENT_ERROR = EVENT_PREFIX + "error"
 EVENT_RECOGNIZED = EVENT_PREFIX + "intent-recognized"
 EVENT_RELOADED = EVENT_PREFIX + "reloaded"
+EVENT_STATS = EVENT_PREFIX + "stats"
 
 # -------------------------------------------------------------------------------------------------
 
 
 def main():
     parser = argparse.ArgumentParser("fsticuffs")
+    parser.add_argument("--intent-fst", help="Path to intent finite state transducer")
+    parser.add_argument(
+        "--intent-artifact",
+        help="Path to memory-mapped recognizer artifact (used instead of intent FST)",
+    )
     parser.add_argument(
-        "--intent-fst", help="Path to intent finite state transducer", required=True
+        "--intent-manifest",
+        help="Path to intent manifest from training (intent FSTs are assembled at load instead of reading intent FST)",
     )
     parser.add_argument(
         "--skip-unknown",
@@ -57,6 +72,10 @@ def main():
         "--stop-words",
         help="File with words that can be ignored during fuzzy recognition",
     )
+    parser.add_argument(
+        "--intent-graph",
+        help="Path to cached intent graph for fuzzy recognition (created from intent FST if missing or out of date)",
+    )
     parser.add_argument(
         "--events-in-file",
         help="File to read events from (one per line, topic followed by JSON)",
@@ -67,6 +86,35 @@ def main():
         help="File to write events to (one per line, topic followed by JSON)",
         default=None,
     )
+    parser.add_argument(
+        "--events-socket",
+        help="Unix socket to send/receive events on (instead of events files)",
+    )
+    parser.add_argument(
+        "--mqtt-host",
+        help="MQTT broker to send/receive events through (instead of events files)",
+    )
+    parser.add_argument(
+        "--mqtt-port", type=int, default=1883, help="MQTT broker port (default=1883)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Number of recognize events to group together (partial batches are recognized when no more events are waiting)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes that recognize batches in parallel",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=0,
+        help="Number of recognized intents to cache by token sequence (0 to disable)",
+    )
     parser.add_argument(
         "--text-input",
         action="store_true",
@@ -83,6 +131,12 @@ def main():
 
     logger.debug(args)
 
+    if not (args.intent_fst or args.intent_artifact or args.intent_manifest):
+        logger.fatal(
+            "--intent-fst, --intent-artifact, or --intent-manifest is required"
+        )
+        sys.exit(1)
+
     # -------------------------------------------------------------------------
 
     # File to read events from
@@ -95,116 +149,254 @@ def main():
     if args.events_out_file and (args.events_out_file != "-"):
         events_out_file = open(args.events_out_file, "w")
 
-    def send_event(topic, payload_dict={}):
-        if topic is not None:
-            print(topic, end=" ", file=events_out_file)
+    # Events are sent through the bus when reading events
+    bus: Optional[EventBus] = None
+    events_out = EventWriter(events_out_file)
 
-        with jsonlines.Writer(events_out_file) as out:
-            out.write(payload_dict)
-
-        events_out_file.flush()
+    def send_event(topic, payload_dict={}, flush=True):
+        if bus is not None:
+            # Bus flushes when idle
+            bus.send(topic, payload_dict)
+        else:
+            events_out.send(topic, payload_dict, flush=flush)
 
     # -------------------------------------------------------------------------
 
-    intent_fst = None
+    intent_artifact = None
+    intent_matcher = None
     known_tokens = set()
     intent_graph = None
     stop_words = set()
 
+    # Recognition results by (mode, tokens)
+    intent_cache = None
+    if args.cache_size > 0:
+        intent_cache = IntentCache(args.cache_size)
+
     def reload_fst():
-        nonlocal intent_fst, known_tokens, intent_graph, stop_words
+        nonlocal intent_artifact, intent_matcher, known_tokens, intent_graph, stop_words
+
+        start_time = time.time()
+        intent_artifact = None
+        intent_matcher = None
+        intent_graph = None
+        stop_words = set()
+
+        if intent_cache is not None:
+            # Cached results are from the previous FST
+            intent_cache.clear()
+
+        if args.intent_artifact:
+            # Arrays are memory-mapped, so nothing is parsed or copied here
+            intent_artifact = IntentArtifact(args.intent_artifact)
+            intent_graph = IntentGraph.from_artifact(intent_artifact)
+            in_symbols = intent_artifact.vocab
+            logger.debug(f"Loaded artifact from {args.intent_artifact}")
+        elif args.intent_manifest:
+            # Per-intent FSTs are spliced together with fst.replace
+            intent_graph = IntentGraph.from_fst(
+                load_intent_manifest(args.intent_manifest)
+            )
+            in_symbols = intent_graph.in_symbols
+            logger.debug(f"Assembled intent FSTs from {args.intent_manifest}")
+        else:
+            # Graph is cached beside the FST, so the FST may not need to be read
+            intent_graph = load_or_make_graph(args.intent_fst, args.intent_graph)
+            in_symbols = intent_graph.in_symbols
 
-        # Load intent fst
-        intent_fst = fst.Fst.read(args.intent_fst)
-        logger.debug(f"Loaded FST from {args.intent_fst}")
+        if args.fuzzy:
+            logger.debug("Fuzzy search enabled")
+
+            # Load stop words (words that act like wildcards for transitions)
+            if args.stop_words:
+                with open(args.stop_words, "r") as stop_words_file:
+                    stop_words = set([line.strip() for line in stop_words_file])
+        else:
+            # Transition tables are compiled as states are visited
+            intent_matcher = IntentMatcher(intent_graph)
+
+        logger.debug(f"Loaded recognizer in {time.time() - start_time} second(s)")
 
         # Add symbols from FST
         if args.skip_unknown:
             # Ignore words outside of input symbol table
             known_tokens = set()
-            in_symbols = intent_fst.input_symbols()
-            for i in range(in_symbols.num_symbols()):
-                token = in_symbols.find(i).decode()
+            for token in in_symbols:
                 if not (token.startswith("__") or token.startswith("<")):
                     known_tokens.add(token)
 
             logger.debug(f"Skipping words outside of set: {known_tokens}")
 
-        intent_graph = None
-        stop_words = set()
+    def recognize_text(text: str) -> Dict[str, Any]:
         if args.fuzzy:
-            logger.debug("Fuzzy search enabled")
-            intent_graph = fst_to_graph(intent_fst)
+            # Fuzzy search
+            return recognize_fuzzy(
+                intent_graph, text, known_tokens=known_tokens, stop_words=stop_words
+            )
 
-            # Load stop words (words that act like wildcards for transitions)
-            if args.stop_words:
-                with open(args.stop_words, "r") as stop_words_file:
-                    stop_words = set([line.strip() for line in stop_words_file])
+        # Fast (strict) search
+        return recognize(intent_matcher, text, known_tokens)
+
+    # -------------------------------------------------------------------------
+
+    # Worker processes are forked after each (re)load, so they share the
+    # loaded graph/artifact with this process.
+    pool = None
+
+    def restart_pool():
+        nonlocal pool
+
+        if pool is not None:
+            pool.terminate()
+            pool = None
+
+        if args.workers > 1:
+            pool = _make_pool(recognize_text, args.workers)
+            logger.debug(f"Started {args.workers} worker(s)")
+
+    # (topic, event) for each pending recognize event
+    batch: List[Tuple[Optional[str], Dict[str, Any]]] = []
+
+    # Partial batch is flushed once the event loop has nothing else to do
+    flush_handle: Optional[asyncio.Handle] = None
+
+    def flush_batch():
+        nonlocal flush_handle
+        if flush_handle is not None:
+            flush_handle.cancel()
+            flush_handle = None
+
+        if len(batch) == 0:
+            return
+
+        texts = [event_dict.get("text", "") for _, event_dict in batch]
+        if args.lower:
+            texts = [text.lower() for text in texts]
+
+        try:
+            intents: List[Optional[Dict[str, Any]]] = [None] * len(texts)
+            cache_keys: List[Any] = []
+            miss_indexes = list(range(len(texts)))
+
+            if intent_cache is not None:
+                # Only recognize texts whose tokens haven't been seen
+                mode = "fuzzy" if args.fuzzy else "strict"
+                miss_indexes = []
+                for i, text in enumerate(texts):
+                    start_time = time.time()
+                    key = (mode, tuple(tokenize(text, known_tokens)))
+                    cache_keys.append(key)
+                    intent = intent_cache.get(key)
+                    if intent is None:
+                        miss_indexes.append(i)
+                        continue
+
+                    if not intent["intent"]["name"]:
+                        # Empty intents carry the original text
+                        intent["text"] = text
+
+                    intent["recognize_seconds"] = time.time() - start_time
+                    intents[i] = intent
+
+            miss_texts = [texts[i] for i in miss_indexes]
+            if pool is not None:
+                # Results come back in input order
+                chunk_size = max(1, len(miss_texts) // (args.workers * 4))
+                miss_intents = pool.map(_worker_recognize, miss_texts, chunk_size)
+            else:
+                miss_intents = [recognize_text(text) for text in miss_texts]
+
+            for i, intent in zip(miss_indexes, miss_intents):
+                intents[i] = intent
+                if intent_cache is not None:
+                    intent_cache.put(cache_keys[i], intent)
+
+            for (topic, event_dict), intent in zip(batch, intents):
+                # Overwrite fields in original event
+                for key, value in intent.items():
+                    event_dict[key] = value
+
+                send_event(topic, event_dict, flush=False)
+        except Exception as e:
+            logger.exception("flush_batch")
+            send_event(EVENT_ERROR, {"error": str(e)}, flush=False)
+        finally:
+            batch.clear()
+
+            if bus is None:
+                events_out.flush()
+
+    def add_to_batch(topic: Optional[str], event_dict: Dict[str, Any]):
+        nonlocal flush_handle
+        batch.append((topic, event_dict))
+        if len(batch) >= args.batch_size:
+            flush_batch()
+        elif (bus is not None) and (flush_handle is None):
+            # Events that are already buffered join the batch first, but
+            # nothing waits for more events to arrive.
+            flush_handle = asyncio.get_event_loop().call_soon(flush_batch)
 
     # Initial load
     reload_fst()
+    restart_pool()
+
+    if events_in_file or args.events_socket or args.mqtt_host:
+        bus = EventBus(
+            make_transport(
+                events_in_file,
+                events_out_file,
+                events_socket=args.events_socket,
+                mqtt_host=args.mqtt_host,
+                mqtt_port=args.mqtt_port,
+            ),
+            error_topic=EVENT_ERROR,
+            text_input_topic=EVENT_RECOGNIZE if args.text_input else None,
+        )
+
+        def handle_recognize(request_id: str, event: str):
+            add_to_batch(EVENT_RECOGNIZED + request_id, maybe_object(event))
+
+        def handle_reload(request_id: str, event: str):
+            logging.debug("Reloading intent FST")
+
+            # Finish events that came before reload
+            flush_batch()
+
+            event_dict = maybe_object(event)
+            args.intent_fst = event_dict.get("intent-fst", args.intent_fst)
+            args.intent_graph = event_dict.get("intent-graph", args.intent_graph)
+            args.intent_artifact = event_dict.get(
+                "intent-artifact", args.intent_artifact
+            )
+            args.intent_manifest = event_dict.get(
+                "intent-manifest", args.intent_manifest
+            )
+            reload_fst()
+            restart_pool()
+
+            send_event(EVENT_RELOADED + request_id, event_dict)
+
+        def handle_get_stats(request_id: str, event: str):
+            # Finish events that came before stats request
+            flush_batch()
+
+            stats: Dict[str, Any] = {}
+            if intent_cache is not None:
+                stats["cache"] = intent_cache.stats()
+
+            send_event(EVENT_STATS + request_id, stats)
+
+        bus.on(EVENT_RECOGNIZE, handle_recognize)
+        bus.on(EVENT_RELOAD, handle_reload)
+        bus.on(EVENT_GET_STATS, handle_get_stats)
+
+        async def handle_events():
+            await bus.run()
+            flush_batch()
+            bus.flush()
 
-    if events_in_file:
         # Recognize lines from file
-        for line in events_in_file:
-            line = line.strip()
-            if len(line) == 0:
-                continue
-
-            logger.debug(line)
-
-            try:
-                if args.text_input:
-                    # Assume text input
-                    topic = EVENT_RECOGNIZE
-                    event = json.dumps({"text": line})
-                else:
-                    # Expected <topic> <payload> on each line
-                    topic, event = line.split(" ", maxsplit=1)
-
-                topic_parts = topic.split("/")
-                base_topic = "/".join(topic_parts[:3])
-
-                # Everything after base topic is request id
-                request_id = "/".join(topic_parts[3:])
-                if len(request_id) > 0:
-                    request_id = "/" + request_id
-
-                if base_topic == EVENT_RECOGNIZE:
-                    event_dict = maybe_object(event)
-                    text = event_dict.get("text", "")
-
-                    if args.lower:
-                        text = text.lower()
-
-                    if args.fuzzy:
-                        # Fuzzy search
-                        intent = recognize_fuzzy(
-                            intent_graph,
-                            text,
-                            known_tokens=known_tokens,
-                            stop_words=stop_words,
-                        )
-                    else:
-                        # Fast (strict) search
-                        intent = recognize(intent_fst, text, known_tokens)
-
-                    # Overwrite fields in original event
-                    for key, value in intent.items():
-                        event_dict[key] = value
-
-                    send_event(EVENT_RECOGNIZED + request_id, event_dict)
-                elif base_topic == EVENT_RELOAD:
-                    logging.debug("Reloading intent FST")
-
-                    event_dict = maybe_object(event)
-                    args.intent_fst = event_dict.get("intent-fst", args.intent_fst)
-                    reload_fst()
-
-                    send_event(EVENT_RELOADED + request_id, event_dict)
-            except Exception as e:
-                logger.exception(line)
-                send_event(EVENT_ERROR, {"error": str(e)})
+        event_bus.run(handle_events())
     else:
         # Read JSON or text line-by-line
         for line in sys.stdin:
@@ -213,38 +405,37 @@ def main():
             else:
                 event_dict = maybe_object(line)
 
-            text = event_dict.get("text", "")
+            add_to_batch(None, event_dict)
 
-            if args.lower:
-                text = text.lower()
+        flush_batch()
 
-            if args.fuzzy:
-                # Fuzzy search
-                intent = recognize_fuzzy(
-                    intent_graph,
-                    text,
-                    known_tokens=known_tokens,
-                    stop_words=stop_words,
-                )
-            else:
-                # Fast (strict) search
-                intent = recognize(intent_fst, text, known_tokens)
-
-            # Overwrite fields in original event
-            for key, value in intent.items():
-                event_dict[key] = value
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-            send_event(None, event_dict)
+    if intent_cache is not None:
+        logger.debug(f"Cache: {intent_cache.stats()}")
 
 
 # -------------------------------------------------------------------------------------------------
 
+# Recognizer used in worker processes (inherited through fork)
+_worker_recognize_text: Optional[Callable[[str], Dict[str, Any]]] = None
+
+
+def _make_pool(
+    recognize_text: Callable[[str], Dict[str, Any]], workers: int
+) -> multiprocessing.pool.Pool:
+    global _worker_recognize_text
+    _worker_recognize_text = recognize_text
+
+    # Fork so workers get the loaded recognizer without pickling it
+    return multiprocessing.get_context("fork").Pool(workers)
+
 
-def maybe_object(json_str):
-    try:
-        return json.loads(json_str)
-    except:
-        return {}
+def _worker_recognize(text: str) -> Dict[str, Any]:
+    assert _worker_recognize_text is not None
+    return _worker_recognize_text(text)
 
 
 # -------------------------------------------------------------------------------------------------
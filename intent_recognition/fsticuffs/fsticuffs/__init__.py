@@ -7,29 +7,49 @@ logger = logging.getLogger("fsticuffs")
 
 import re
 import time
-from typing import Optional, Dict, Any, Set, List, Tuple
+import bisect
+import heapq
+import itertools
+from collections import defaultdict
+from typing import Optional, Dict, Any, Set, List, Tuple, Union
 
 import pywrapfst as fst
-import networkx as nx
 
 from training.jsgf2fst import fstaccept, symbols2intent
 
+from .matcher import IntentMatcher
+from .graph import IntentGraph, load_or_make_graph
+from .cache import IntentCache
+
 # -------------------------------------------------------------------------------------------------
 
 
-def recognize(
-    intent_fst: fst.Fst, text: str, known_tokens: Optional[Set[str]] = None
-) -> Dict[str, Any]:
-    start_time = time.time()
+def tokenize(text: str, known_tokens: Optional[Set[str]] = None) -> List[str]:
+    """Splits text on whitespace, keeping only known tokens (if provided)."""
     tokens = re.split("\s+", text)
 
     if known_tokens:
         # Filter tokens
         tokens = [t for t in tokens if t in known_tokens]
 
+    return tokens
+
+
+def recognize(
+    intent_fst: Union[fst.Fst, IntentMatcher],
+    text: str,
+    known_tokens: Optional[Set[str]] = None,
+) -> Dict[str, Any]:
+    """Strict recognition with a compiled matcher (fast) or an intent FST."""
+    start_time = time.time()
+    tokens = tokenize(text, known_tokens)
+
     # Only run acceptor if there are any tokens
     if len(tokens) > 0:
-        intents = fstaccept(intent_fst, tokens)
+        if isinstance(intent_fst, IntentMatcher):
+            intents = intent_fst.accept(tokens)
+        else:
+            intents = fstaccept(intent_fst, tokens)
     else:
         intents = []
 
@@ -62,18 +82,14 @@ def recognize(
 
 
 def recognize_fuzzy(
-    intent_graph: nx.digraph.Graph,
+    intent_graph: IntentGraph,
     text: str,
     known_tokens: Optional[Set[str]] = None,
     stop_words: Set[str] = set(),
     eps: str = "<eps>",
 ) -> Dict[str, Any]:
     start_time = time.time()
-    tokens = re.split("\s+", text)
-
-    if known_tokens:
-        # Filter tokens
-        tokens = [t for t in tokens if t in known_tokens]
+    tokens = tokenize(text, known_tokens)
 
     # Only run search if there are any tokens
     intents = []
@@ -114,38 +130,75 @@ def recognize_fuzzy(
 
 
 def _get_symbols_and_costs(
-    intent_graph: nx.MultiDiGraph,
+    intent_graph: IntentGraph,
     tokens: List[str],
     stop_words: Set[str] = set(),
     eps: str = "<eps>",
 ) -> Dict[str, Tuple[List[str], int]]:
-    # node -> attrs
-    n_data = intent_graph.nodes(data=True)
-
-    # start state
-    start_node = [n for n, data in n_data if data["start"]][0]
+    """Finds the lowest cost output symbols for each intent.
+
+    Viterbi-style search that keeps only the best cost for each
+    (state, token position, intent). Skipped input tokens cost 1 each.
+    """
+    # Zero-copy views of graph arrays (indexing yields plain ints)
+    arc_offsets = memoryview(intent_graph.arc_offsets)
+    arc_ilabels = memoryview(intent_graph.arc_ilabels)
+    arc_olabels = memoryview(intent_graph.arc_olabels)
+    arc_nextstates = memoryview(intent_graph.arc_nextstates)
+    final = memoryview(intent_graph.final)
+    label_intents = intent_graph.label_intents
+
+    in_eps = intent_graph.in_ids.get(eps, -1)
+    out_eps = (
+        intent_graph.out_symbols.index(eps) if eps in intent_graph.out_symbols else -1
+    )
+    stop_ids = set(
+        intent_graph.in_ids[w] for w in stop_words if w in intent_graph.in_ids
+    )
+
+    # Input label ids (-1 for tokens outside the input symbol table)
+    token_ids = [intent_graph.in_ids.get(token, -1) for token in tokens]
+
+    # token id -> positions in input (for skipping ahead to the next match)
+    token_positions: Dict[int, List[int]] = defaultdict(list)
+    for i, token_id in enumerate(token_ids):
+        token_positions[token_id].append(i)
+
+    num_tokens = len(tokens)
+    start_state = intent_graph.start
 
     # intent -> (symbols, cost)
     intent_symbols_and_costs = {}
 
     # Lowest cost so far
-    best_cost = len(n_data)
+    best_cost = intent_graph.num_states
+
+    # (state, position, intent) -> lowest cost
+    best_state_costs: Dict[Tuple[int, int, Optional[str]], int] = {}
 
-    # (node, in_tokens, out_tokens, cost, intent_name)
-    q = [(start_node, tokens, [], 0, None)]
+    # (cost, order, state, position, intent, back-pointer)
+    # Back-pointers are (out label, previous back-pointer) or None.
+    order = itertools.count()
+    q = [(0, next(order), start_state, 0, None, None)]
+    best_state_costs[(start_state, 0, None)] = 0
 
-    # BFS it up
     while len(q) > 0:
-        q_node, q_in_tokens, q_out_tokens, q_cost, q_intent = q.pop()
+        q_cost, _, q_state, q_pos, q_intent, q_back = heapq.heappop(q)
+        if q_cost > best_state_costs.get((q_state, q_pos, q_intent), q_cost):
+            # Already reached with a lower cost
+            continue
 
         # Update best intent cost on final state.
         # Don't bother reporting intents that failed to consume any tokens.
-        if (n_data[q_node]["final"]) and (q_cost < len(tokens)):
+        if final[q_state] and (q_cost < num_tokens):
             best_intent_cost = intent_symbols_and_costs.get(q_intent, (None, None))[1]
-            final_cost = q_cost + len(q_in_tokens)  # remaning tokens count against
+            final_cost = q_cost + (num_tokens - q_pos)  # remaining tokens count against
 
             if (best_intent_cost is None) or (final_cost < best_intent_cost):
-                intent_symbols_and_costs[q_intent] = [q_out_tokens, final_cost]
+                intent_symbols_and_costs[q_intent] = [
+                    _follow_back_pointers(q_back, intent_graph.out_symbols),
+                    final_cost,
+                ]
 
             if final_cost < best_cost:
                 best_cost = final_cost
@@ -153,81 +206,68 @@ def _get_symbols_and_costs(
         if q_cost > best_cost:
             continue
 
-        # Process child edges
-        for next_node, edges in intent_graph[q_node].items():
-            for edge_idx, edge_data in edges.items():
-                in_label = edge_data["in_label"]
-                out_label = edge_data["out_label"]
-                next_in_tokens = q_in_tokens[:]
-                next_out_tokens = q_out_tokens[:]
-                next_cost = q_cost
-                next_intent = q_intent
-
-                if out_label.startswith("__label__"):
-                    next_intent = out_label[9:]
-
-                if in_label in stop_words:
-                    # Only consume token if it matches (no penalty if not)
-                    if (len(next_in_tokens) > 0) and (in_label == next_in_tokens[0]):
-                        next_in_tokens.pop(0)
-
-                    if out_label != eps:
-                        next_out_tokens.append(out_label)
-                elif in_label != eps:
-                    # Consume non-matching tokens and increase cost
-                    while (len(next_in_tokens) > 0) and (in_label != next_in_tokens[0]):
-                        next_in_tokens.pop(0)
-                        next_cost += 1
-
-                    if len(next_in_tokens) > 0:
-                        # Consume matching token
-                        next_in_tokens.pop(0)
-
-                        if out_label != eps:
-                            next_out_tokens.append(out_label)
-                    else:
-                        # No matching token
-                        continue
-                else:
-                    # Consume epsilon
-                    if out_label != eps:
-                        next_out_tokens.append(out_label)
-
-                q.append(
-                    [next_node, next_in_tokens, next_out_tokens, next_cost, next_intent]
-                )
+        # Process outgoing arcs
+        for arc_idx in range(arc_offsets[q_state], arc_offsets[q_state + 1]):
+            in_label = arc_ilabels[arc_idx]
+            out_label = arc_olabels[arc_idx]
+            next_pos = q_pos
+            next_cost = q_cost
+            next_intent = label_intents.get(out_label, q_intent)
+
+            if in_label in stop_ids:
+                # Only consume token if it matches (no penalty if not)
+                if (q_pos < num_tokens) and (in_label == token_ids[q_pos]):
+                    next_pos += 1
+            elif in_label != in_eps:
+                # Skip to next matching token, increasing cost for each
+                # non-matching token.
+                positions = token_positions.get(in_label)
+                if not positions:
+                    continue
+
+                match_idx = bisect.bisect_left(positions, q_pos)
+                if match_idx >= len(positions):
+                    # No matching token
+                    continue
+
+                next_pos = positions[match_idx] + 1
+                next_cost += positions[match_idx] - q_pos
+
+            next_state = arc_nextstates[arc_idx]
+            next_key = (next_state, next_pos, next_intent)
+            if next_cost >= best_state_costs.get(next_key, next_cost + 1):
+                continue
+
+            best_state_costs[next_key] = next_cost
+            next_back = q_back
+            if out_label != out_eps:
+                next_back = (out_label, q_back)
+
+            heapq.heappush(
+                q,
+                (next_cost, next(order), next_state, next_pos, next_intent, next_back),
+            )
 
     return intent_symbols_and_costs
 
 
-# -------------------------------------------------------------------------------------------------
-
-
-def fst_to_graph(the_fst: fst.Fst) -> nx.MultiDiGraph:
-    """Converts a finite state transducer to a directed graph."""
-    zero_weight = fst.Weight.Zero(the_fst.weight_type())
-    in_symbols = the_fst.input_symbols()
-    out_symbols = the_fst.output_symbols()
-
-    g = nx.MultiDiGraph()
+def _follow_back_pointers(back_pointer, out_symbols: List[str]) -> List[str]:
+    """Recovers output symbols from a chain of (label, previous) pairs."""
+    symbols = []
+    while back_pointer is not None:
+        symbols.append(out_symbols[back_pointer[0]])
+        back_pointer = back_pointer[1]
 
-    # Add nodes
-    for state in the_fst.states():
-        # Mark final states
-        is_final = the_fst.final(state) != zero_weight
-        g.add_node(state, final=is_final, start=False)
+    symbols.reverse()
+    return symbols
 
-        # Add edges
-        for arc in the_fst.arcs(state):
-            in_label = in_symbols.find(arc.ilabel).decode()
-            out_label = out_symbols.find(arc.olabel).decode()
 
-            g.add_edge(state, arc.nextstate, in_label=in_label, out_label=out_label)
+# -------------------------------------------------------------------------------------------------
 
-    # Mark start state
-    g.add_node(the_fst.start(), start=True)
 
-    return g
+def fst_to_graph(the_fst: fst.Fst) -> IntentGraph:
+    """Converts a finite state transducer to a compact array-backed graph."""
+    return IntentGraph.from_fst(the_fst)
 
 
 # -------------------------------------------------------------------------------------------------
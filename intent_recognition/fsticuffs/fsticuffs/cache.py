@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+import copy
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Hashable
+
+# -------------------------------------------------------------------------------------------------
+
+
+class IntentCache:
+    """Bounded least-recently-used cache of recognized intents.
+
+    Keys should be built from the normalized (lower-cased, filtered) token
+    sequence and the recognition mode, e.g. ("fuzzy", ("turn", "on", ...)).
+    Intents are copied going in and out, so callers are free to modify them.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._intents: "OrderedDict[Hashable, Dict[str, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Dict[str, Any]]:
+        """Returns a copy of the cached intent or None."""
+        intent = self._intents.get(key)
+        if intent is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._intents.move_to_end(key)
+        return copy.deepcopy(intent)
+
+    def put(self, key: Hashable, intent: Dict[str, Any]):
+        """Caches a copy of an intent, evicting the least recently used."""
+        if self.max_size <= 0:
+            return
+
+        self._intents[key] = copy.deepcopy(intent)
+        self._intents.move_to_end(key)
+
+        while len(self._intents) > self.max_size:
+            self._intents.popitem(last=False)
+
+    def clear(self):
+        """Drops all cached intents (hit/miss counts are kept)."""
+        self._intents.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._intents),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def __len__(self) -> int:
+        return len(self._intents)
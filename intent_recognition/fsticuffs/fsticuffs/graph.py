@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+import logging
+
+logger = logging.getLogger("fsticuffs")
+
+import time
+from pathlib import Path
+from typing import Optional, Dict, List, Union
+
+import numpy as np
+import pywrapfst as fst
+
+from training.jsgf2fst import fst_to_arrays, IntentArtifact
+
+# -------------------------------------------------------------------------------------------------
+
+
+class IntentGraph:
+    """Compact, array-backed copy of an intent FST used for fuzzy search.
+
+    Arcs are stored in compressed sparse row (CSR) order: the arcs leaving
+    state s are at indexes arc_offsets[s] up to arc_offsets[s + 1]. Labels are
+    integer ids into in_symbols/out_symbols.
+    """
+
+    def __init__(
+        self,
+        arc_offsets: np.ndarray,
+        arc_ilabels: np.ndarray,
+        arc_olabels: np.ndarray,
+        arc_nextstates: np.ndarray,
+        final: np.ndarray,
+        start: int,
+        in_symbols: List[str],
+        out_symbols: List[str],
+        eps: str = "<eps>",
+    ):
+        self.arc_offsets = arc_offsets
+        self.arc_ilabels = arc_ilabels
+        self.arc_olabels = arc_olabels
+        self.arc_nextstates = arc_nextstates
+        self.final = final
+        self.start = start
+        self.in_symbols = in_symbols
+        self.out_symbols = out_symbols
+
+        # Label lookups
+        self.in_ids: Dict[str, int] = {sym: i for i, sym in enumerate(in_symbols)}
+        self.in_eps = self.in_ids.get(eps, -1)
+        self.out_eps = out_symbols.index(eps) if eps in out_symbols else -1
+
+        # output label -> intent name (__label__ symbols only)
+        self.label_intents: Dict[int, str] = {
+            i: sym[9:]
+            for i, sym in enumerate(out_symbols)
+            if sym.startswith("__label__")
+        }
+
+    @property
+    def num_states(self) -> int:
+        return len(self.arc_offsets) - 1
+
+    @property
+    def num_arcs(self) -> int:
+        return len(self.arc_ilabels)
+
+    # ---------------------------------------------------------------------------------------------
+
+    @classmethod
+    def from_fst(cls, the_fst: fst.Fst, eps: str = "<eps>") -> "IntentGraph":
+        """Converts a finite state transducer to arrays."""
+        start_time = time.time()
+        arrays, in_symbols, out_symbols = fst_to_arrays(the_fst)
+
+        graph = cls(
+            arrays["arc_offsets"],
+            arrays["arc_ilabels"],
+            arrays["arc_olabels"],
+            arrays["arc_nextstates"],
+            arrays["final"],
+            the_fst.start(),
+            in_symbols,
+            out_symbols,
+            eps=eps,
+        )
+
+        logger.debug(
+            f"Converted FST to graph with {graph.num_states} state(s) and {graph.num_arcs} arc(s) in {time.time() - start_time} second(s)"
+        )
+
+        return graph
+
+    @classmethod
+    def from_artifact(cls, artifact: IntentArtifact) -> "IntentGraph":
+        """Wraps the memory-mapped arrays of a recognizer artifact (no copying)."""
+        return cls(
+            artifact.arc_offsets,
+            artifact.arc_ilabels,
+            artifact.arc_olabels,
+            artifact.arc_nextstates,
+            artifact.final,
+            artifact.start,
+            artifact.in_symbols,
+            artifact.out_symbols,
+            eps=artifact.eps,
+        )
+
+    # ---------------------------------------------------------------------------------------------
+
+    def save(self, graph_path: Union[str, Path], fst_stamp: Optional[List[int]] = None):
+        """Writes graph arrays to an uncompressed .npz file.
+
+        fst_stamp identifies the FST the graph was made from (see fst_stamp).
+        """
+        extra_arrays = {}
+        if fst_stamp is not None:
+            extra_arrays["fst_stamp"] = np.array(fst_stamp, dtype=np.int64)
+
+        # Pass a file object so numpy doesn't append .npz to the path
+        with open(graph_path, "wb") as graph_file:
+            np.savez(
+                graph_file,
+                arc_offsets=self.arc_offsets,
+                arc_ilabels=self.arc_ilabels,
+                arc_olabels=self.arc_olabels,
+                arc_nextstates=self.arc_nextstates,
+                final=self.final,
+                start=np.array([self.start], dtype=np.int32),
+                in_symbols=np.array(self.in_symbols, dtype=np.str_),
+                out_symbols=np.array(self.out_symbols, dtype=np.str_),
+                **extra_arrays,
+            )
+
+    @classmethod
+    def load(cls, graph_path: Union[str, Path], eps: str = "<eps>") -> "IntentGraph":
+        """Reads graph arrays from a file created with save."""
+        with np.load(graph_path) as graph_arrays:
+            return cls(
+                graph_arrays["arc_offsets"],
+                graph_arrays["arc_ilabels"],
+                graph_arrays["arc_olabels"],
+                graph_arrays["arc_nextstates"],
+                graph_arrays["final"],
+                int(graph_arrays["start"][0]),
+                graph_arrays["in_symbols"].tolist(),
+                graph_arrays["out_symbols"].tolist(),
+                eps=eps,
+            )
+
+
+# -------------------------------------------------------------------------------------------------
+
+
+def fst_stamp(intent_fst_path: Union[str, Path]) -> List[int]:
+    """Size and modification time (ns) of an FST file."""
+    fst_stat = Path(intent_fst_path).stat()
+    return [fst_stat.st_size, fst_stat.st_mtime_ns]
+
+
+def read_fst_stamp(graph_path: Union[str, Path]) -> Optional[List[int]]:
+    """Gets the stamp of the FST a cached graph was made from (None if missing)."""
+    try:
+        with np.load(graph_path) as graph_arrays:
+            if "fst_stamp" not in graph_arrays:
+                return None
+
+            return graph_arrays["fst_stamp"].tolist()
+    except Exception:
+        logger.exception("read graph")
+        return None
+
+
+def load_or_make_graph(
+    intent_fst_path: Union[str, Path],
+    graph_path: Optional[Union[str, Path]] = None,
+    eps: str = "<eps>",
+) -> IntentGraph:
+    """Loads a cached graph made from the same FST, otherwise converts (and caches) the FST.
+
+    The cached graph records the FST's size and modification time, so any
+    change to the FST (including being replaced with an older copy) is
+    detected.
+    """
+    intent_fst_path = Path(intent_fst_path)
+    stamp = fst_stamp(intent_fst_path)
+
+    if graph_path is not None:
+        graph_path = Path(graph_path)
+        if graph_path.exists() and (read_fst_stamp(graph_path) == stamp):
+            logger.debug(f"Loading intent graph from {graph_path}")
+            return IntentGraph.load(graph_path, eps=eps)
+
+    graph = IntentGraph.from_fst(fst.Fst.read(str(intent_fst_path)), eps=eps)
+
+    if graph_path is not None:
+        try:
+            graph.save(graph_path, fst_stamp=stamp)
+            logger.debug(f"Wrote intent graph to {graph_path}")
+        except Exception:
+            logger.exception("save graph")
+
+    return graph
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+import logging
+
+logger = logging.getLogger("fsticuffs")
+
+from collections import deque
+from typing import Dict, Any, List, Tuple
+
+import pywrapfst as fst
+
+from .graph import IntentGraph
+
+from training.jsgf2fst import symbols2intent
+
+# -------------------------------------------------------------------------------------------------
+
+# (next state, output labels)
+Transition = Tuple[int, Tuple[int, ...]]
+
+
+class IntentMatcher:
+    """Strict intent recognizer compiled from an intent graph.
+
+    Each state's epsilon closure is folded into a transition table keyed on
+    input label, so matching a sentence only walks the table (no per-sentence
+    FST construction or composition). Tables are compiled the first time a
+    state is visited, so a matcher over a memory-mapped artifact starts
+    immediately.
+
+    Every distinct sequence of output labels is kept, so alternatives that
+    only differ in their outputs (e.g., slot values) are all returned.
+    """
+
+    def __init__(self, intent_graph: IntentGraph):
+        self.graph = intent_graph
+        self.start_state = intent_graph.start
+        self.out_symbols = intent_graph.out_symbols
+
+        # token -> input label
+        self.token_ids: Dict[str, int] = {
+            token: label
+            for token, label in intent_graph.in_ids.items()
+            if label != intent_graph.in_eps
+        }
+
+        # Zero-copy views of graph arrays (indexing yields plain ints)
+        self._arc_offsets = memoryview(intent_graph.arc_offsets)
+        self._arc_ilabels = memoryview(intent_graph.arc_ilabels)
+        self._arc_olabels = memoryview(intent_graph.arc_olabels)
+        self._arc_nextstates = memoryview(intent_graph.arc_nextstates)
+        self._final = memoryview(intent_graph.final)
+
+        # state -> input label -> [(next state, output labels)]
+        self.transitions: Dict[int, Dict[int, List[Transition]]] = {}
+
+        # state -> [output labels along epsilon paths to a final state]
+        self.final_outputs: Dict[int, List[Tuple[int, ...]]] = {}
+
+    @classmethod
+    def from_fst(cls, intent_fst: fst.Fst, eps: str = "<eps>") -> "IntentMatcher":
+        """Creates a matcher directly from an intent FST."""
+        return cls(IntentGraph.from_fst(intent_fst, eps=eps))
+
+    def _state_transitions(self, state: int) -> Dict[int, List[Transition]]:
+        """Gets (or compiles) the transition table for a state."""
+        state_transitions = self.transitions.get(state)
+        if state_transitions is not None:
+            return state_transitions
+
+        in_eps = self.graph.in_eps
+        out_eps = self.graph.out_eps
+        state_transitions = {}
+        final_outputs = []
+
+        for closure_state, closure_outputs in self._eps_closure(state):
+            if self._final[closure_state]:
+                final_outputs.append(closure_outputs)
+
+            for arc_idx in range(
+                self._arc_offsets[closure_state], self._arc_offsets[closure_state + 1]
+            ):
+                ilabel = self._arc_ilabels[arc_idx]
+                if ilabel == in_eps:
+                    continue
+
+                olabel = self._arc_olabels[arc_idx]
+                outputs = closure_outputs
+                if olabel != out_eps:
+                    outputs = outputs + (olabel,)
+
+                transition = (self._arc_nextstates[arc_idx], outputs)
+                label_transitions = state_transitions.setdefault(ilabel, [])
+                if transition not in label_transitions:
+                    label_transitions.append(transition)
+
+        self.transitions[state] = state_transitions
+        self.final_outputs[state] = final_outputs
+
+        return state_transitions
+
+    def _eps_closure(self, state: int) -> List[Tuple[int, Tuple[int, ...]]]:
+        """Finds (state, output labels) for every input epsilon path from a state."""
+        in_eps = self.graph.in_eps
+        out_eps = self.graph.out_eps
+
+        closure: List[Tuple[int, Tuple[int, ...]]] = [(state, ())]
+        visited = set(closure)
+        state_queue = deque(closure)
+
+        while len(state_queue) > 0:
+            q_state, q_outputs = state_queue.popleft()
+            for arc_idx in range(
+                self._arc_offsets[q_state], self._arc_offsets[q_state + 1]
+            ):
+                if self._arc_ilabels[arc_idx] != in_eps:
+                    continue
+
+                olabel = self._arc_olabels[arc_idx]
+                next_outputs = q_outputs
+                if olabel != out_eps:
+                    next_outputs = next_outputs + (olabel,)
+
+                # Same state with different outputs is a different path
+                next_info = (self._arc_nextstates[arc_idx], next_outputs)
+                if next_info in visited:
+                    continue
+
+                visited.add(next_info)
+                closure.append(next_info)
+                state_queue.append(next_info)
+
+        return closure
+
+    # ---------------------------------------------------------------------------------------------
+
+    def accept(self, tokens: List[str]) -> List[Dict[str, Any]]:
+        """Recognizes intents from a tokenized sentence (like fstaccept)."""
+        all_symbols = self.accept_symbols(tokens)
+
+        intents = []
+        for symbols in all_symbols:
+            intent = symbols2intent(symbols)
+            intent["intent"]["confidence"] /= len(all_symbols)
+            intents.append(intent)
+
+        return intents
+
+    def accept_symbols(self, tokens: List[str]) -> List[List[str]]:
+        """Returns output symbols of every distinct accepting path."""
+        if len(tokens) == 0:
+            return []
+
+        # (state, output labels so far), in the order they were found
+        frontier: Dict[Tuple[int, Tuple[int, ...]], None] = {
+            (self.start_state, ()): None
+        }
+
+        for token in tokens:
+            token_id = self.token_ids.get(token)
+            if token_id is None:
+                # Token is not in FST input symbol table
+                return []
+
+            next_frontier: Dict[Tuple[int, Tuple[int, ...]], None] = {}
+            for state, path_outputs in frontier:
+                for next_state, outputs in self._state_transitions(state).get(
+                    token_id, []
+                ):
+                    next_frontier[(next_state, path_outputs + outputs)] = None
+
+            if len(next_frontier) == 0:
+                return []
+
+            frontier = next_frontier
+
+        # Finish paths at states that can reach a final state
+        all_outputs: Dict[Tuple[int, ...], None] = {}
+        for state, path_outputs in frontier:
+            self._state_transitions(state)
+            for final_outputs in self.final_outputs[state]:
+                all_outputs[path_outputs + final_outputs] = None
+
+        return [
+            [self.out_symbols[label] for label in outputs] for outputs in all_outputs
+        ]
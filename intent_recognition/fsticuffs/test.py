@@ -0,0 +1,277 @@
+import os
+import unittest
+import logging
+import tempfile
+from pathlib import Path
+
+logging.basicConfig(level=logging.DEBUG)
+
+from training.jsgf2fst import (
+    grammar_to_fsts,
+    slots_to_fsts,
+    make_intent_fst,
+    fstaccept,
+    write_intent_artifact,
+    IntentArtifact,
+)
+
+from intent_recognition.fsticuffs.fsticuffs import (
+    recognize,
+    recognize_fuzzy,
+    IntentMatcher,
+    IntentGraph,
+    IntentCache,
+    load_or_make_graph,
+)
+from intent_recognition.fsticuffs.fsticuffs.graph import fst_stamp, read_fst_stamp
+
+# Grammars shared with jsgf2fst tests
+test_dir = Path(__file__).parent.parent.parent / "training" / "jsgf2fst" / "test"
+
+# Same words, different slots
+paint_grammar = """#JSGF V1.0 UTF-8 en;
+grammar Paint;
+
+public <Paint> = paint it [bright] ((red:crimson){color} | (red){shade});
+"""
+
+
+def make_test_intent_fst():
+    slot_fsts = slots_to_fsts(test_dir / "slots")
+    change_light_color = grammar_to_fsts(
+        (test_dir / "ChangeLightColor.gram").read_text(), replace_fsts=slot_fsts
+    )
+
+    replace_fsts = {**slot_fsts, **change_light_color.fsts}
+    change_light = grammar_to_fsts(
+        (test_dir / "ChangeLight.gram").read_text(), replace_fsts=replace_fsts
+    )
+
+    set_timer = grammar_to_fsts((test_dir / "SetTimer.gram").read_text())
+    garage_state = grammar_to_fsts((test_dir / "GetGarageState.gram").read_text())
+
+    return make_intent_fst(
+        {
+            "ChangeLightColor": change_light_color.grammar_fst,
+            "ChangeLight": change_light.grammar_fst,
+            "SetTimer": set_timer.grammar_fst,
+            "GetGarageState": garage_state.grammar_fst,
+        }
+    )
+
+
+def intent_key(intent):
+    """Comparable summary of a recognized intent."""
+    return (
+        intent["intent"]["name"],
+        intent["intent"]["confidence"],
+        intent["text"],
+        intent.get("raw_text", ""),
+        tuple(
+            (ev["entity"], ev["value"], ev["raw_value"], ev["start"], ev["end"])
+            for ev in intent["entities"]
+        ),
+    )
+
+
+class FsticuffsTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.intent_fst = make_test_intent_fst()
+        cls.matcher = IntentMatcher.from_fst(cls.intent_fst)
+
+    # -------------------------------------------------------------------------
+
+    def test_matcher_same_as_fstaccept(self):
+        sentences = [
+            # Slot values
+            "set color to purple",
+            "make it yellow",
+            # Tags with alternatives
+            "turn on",
+            "turn off",
+            "is the garage door open",
+            "is the garage door closed",
+            # Substitutions inside tags and epsilon branches (optional words)
+            "set a timer for ten minutes and forty two seconds",
+            "set timer for twenty one minutes fifty seconds",
+            "set a timer for one minute",
+            # Rejected
+            "turn",
+            "set color to",
+            "set color to pink",
+            "is the garage door",
+            "turn on the",
+        ]
+
+        for sentence in sentences:
+            tokens = sentence.split()
+            expected = [intent_key(i) for i in fstaccept(self.intent_fst, tokens)]
+            actual = [intent_key(i) for i in self.matcher.accept(tokens)]
+
+            # Every fstaccept interpretation is found (confidence depends on
+            # the number of interpretations).
+            for key in expected:
+                self.assertIn(key[:1] + key[2:], [k[:1] + k[2:] for k in actual])
+
+            if len(expected) == 0:
+                self.assertEqual(actual, [], sentence)
+
+            if len(actual) == 1:
+                self.assertEqual(actual, expected, sentence)
+
+    def test_recognize_matcher(self):
+        fst_intent = recognize(self.intent_fst, "set color to purple")
+        self.assertEqual(fst_intent["slots"], {"color": "purple"})
+
+        # ChangeLight includes ChangeLightColor
+        matcher_intent = recognize(self.matcher, "set color to purple")
+        self.assertEqual(matcher_intent["slots"], {"color": "purple"})
+        self.assertEqual(len(matcher_intent["intents"]), 1)
+        self.assertEqual(
+            sorted(
+                i["intent"]["name"]
+                for i in [matcher_intent] + matcher_intent["intents"]
+            ),
+            ["ChangeLight", "ChangeLightColor"],
+        )
+
+        # Unknown word
+        self.assertEqual(
+            recognize(self.matcher, "set color to pink")["intent"]["name"], ""
+        )
+
+    def test_matcher_alternative_outputs(self):
+        paint_fst = make_intent_fst(
+            {"Paint": grammar_to_fsts(paint_grammar).grammar_fst}
+        )
+        matcher = IntentMatcher.from_fst(paint_fst)
+
+        for sentence in ["paint it red", "paint it bright red"]:
+            intents = matcher.accept(sentence.split())
+            self.assertEqual(
+                sorted(
+                    (ev["entity"], ev["value"]) for i in intents for ev in i["entities"]
+                ),
+                [("color", "crimson"), ("shade", "red")],
+            )
+
+            for intent in intents:
+                self.assertEqual(intent["intent"]["name"], "Paint")
+                self.assertEqual(intent["intent"]["confidence"], 0.5)
+
+    def test_graph_cache(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            fst_path = Path(temp_dir) / "intent.fst"
+            graph_path = Path(temp_dir) / "intent.npz"
+
+            self.intent_fst.write(str(fst_path))
+            load_or_make_graph(fst_path, graph_path)
+            self.assertEqual(read_fst_stamp(graph_path), fst_stamp(fst_path))
+
+            # Cached graph is used
+            matcher = IntentMatcher(load_or_make_graph(fst_path, graph_path))
+            self.assertEqual(len(matcher.accept("turn on".split())), 1)
+
+            # Replaced with a different FST that's older than the cache
+            paint_fst = make_intent_fst(
+                {"Paint": grammar_to_fsts(paint_grammar).grammar_fst}
+            )
+            paint_fst.write(str(fst_path))
+
+            old_ns = graph_path.stat().st_mtime_ns - (60 * (10**9))
+            os.utime(str(fst_path), ns=(old_ns, old_ns))
+
+            matcher = IntentMatcher(load_or_make_graph(fst_path, graph_path))
+            self.assertEqual(matcher.accept("turn on".split()), [])
+            self.assertEqual(len(matcher.accept("paint it red".split())), 2)
+            self.assertEqual(read_fst_stamp(graph_path), fst_stamp(fst_path))
+
+    def test_artifact_same_as_fst(self):
+        sentences = [
+            "set color to purple",
+            "make it yellow",
+            "turn on",
+            "set a timer for ten minutes and forty two seconds",
+            "is the garage door closed",
+            # Rejected (strict), closest match (fuzzy)
+            "turn on the",
+            "set color to pink",
+        ]
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            fst_path = Path(temp_dir) / "intent.fst"
+            artifact_path = Path(temp_dir) / "intent.bin"
+
+            # Same as --intent-fst and --intent-artifact
+            self.intent_fst.write(str(fst_path))
+            write_intent_artifact(self.intent_fst, artifact_path)
+
+            fst_graph = load_or_make_graph(fst_path)
+            artifact_graph = IntentGraph.from_artifact(IntentArtifact(artifact_path))
+
+            for sentence in sentences:
+                for fst_intent, artifact_intent in [
+                    (
+                        recognize(IntentMatcher(fst_graph), sentence),
+                        recognize(IntentMatcher(artifact_graph), sentence),
+                    ),
+                    (
+                        recognize_fuzzy(fst_graph, sentence),
+                        recognize_fuzzy(artifact_graph, sentence),
+                    ),
+                ]:
+                    self.assertEqual(
+                        sorted(
+                            intent_key(i)
+                            for i in [artifact_intent] + artifact_intent["intents"]
+                        ),
+                        sorted(
+                            intent_key(i) for i in [fst_intent] + fst_intent["intents"]
+                        ),
+                        sentence,
+                    )
+
+
+class IntentCacheTestCase(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = IntentCache(2)
+        cache.put("a", {"text": "a"})
+        cache.put("b", {"text": "b"})
+
+        # "a" is now most recently used
+        self.assertEqual(cache.get("a"), {"text": "a"})
+        cache.put("c", {"text": "c"})
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), {"text": "a"})
+        self.assertEqual(cache.get("c"), {"text": "c"})
+        self.assertEqual(cache.stats()["hits"], 3)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+        # Disabled
+        cache = IntentCache(0)
+        cache.put("a", {"text": "a"})
+        self.assertIsNone(cache.get("a"))
+
+    def test_copies(self):
+        cache = IntentCache(1)
+        intent = {"text": "turn on", "entities": [{"entity": "state", "value": "on"}]}
+        cache.put("a", intent)
+
+        # Changes to the original don't affect the cache
+        intent["entities"][0]["value"] = "off"
+
+        cached = cache.get("a")
+        self.assertEqual(cached["entities"][0]["value"], "on")
+
+        # Changes to a returned copy don't either
+        cached["entities"].clear()
+        self.assertEqual(cache.get("a")["entities"][0]["value"], "on")
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
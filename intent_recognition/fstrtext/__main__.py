@@ -2,13 +2,14 @@
 import sys
 import argparse
 import re
-import json
 import logging
 
 logger = logging.getLogger("fstrtext")
 
 import pywrapfst as fst
-import jsonlines
+
+import event_bus
+from event_bus import EventBus, make_transport, maybe_object
 
 from training.jsgf2fst import (
     filter_words,
@@ -16,9 +17,9 @@ from training.jsgf2fst import (
     longest_path,
     symbols2intent,
     fstprintall,
+    IntentArtifact,
 )
 
-
 # -------------------------------------------------------------------------------------------------
 # MQTT Events
 # -------------------------------------------------------------------------------------------------
@@ -37,7 +38,11 @@ EVENT_RECOGNIZED = EVENT_PREFIX + "intent-recognized"
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--slot-fst", required=True, help="Path to write slot acceptor")
+    parser.add_argument("--slot-fst", help="Path to slot acceptor")
+    parser.add_argument(
+        "--intent-artifact",
+        help="Path to memory-mapped recognizer artifact (instead of --slot-fst)",
+    )
     parser.add_argument(
         "--classifier-sentences",
         required=True,
@@ -56,6 +61,17 @@ def main():
         help="File to write events to (one per line, topic followed by JSON)",
         default=None,
     )
+    parser.add_argument(
+        "--events-socket",
+        help="Unix socket to send/receive events on (instead of events files)",
+    )
+    parser.add_argument(
+        "--mqtt-host",
+        help="MQTT broker to send/receive events through (instead of events files)",
+    )
+    parser.add_argument(
+        "--mqtt-port", type=int, default=1883, help="MQTT broker port (default=1883)"
+    )
     parser.add_argument(
         "--lower", action="store_true", help="Automatically lower-case input text"
     )
@@ -75,6 +91,10 @@ def main():
 
     logger.debug(args)
 
+    if not (args.slot_fst or args.intent_artifact):
+        logger.fatal("--slot-fst or --intent-artifact is required")
+        sys.exit(1)
+
     # -------------------------------------------------------------------------
 
     # File to read events from
@@ -87,13 +107,6 @@ def main():
     if args.events_out_file and (args.events_out_file != "-"):
         events_out_file = open(args.events_out_file, "w")
 
-    def send_event(topic, payload_dict={}):
-        print(topic, end=" ", file=events_out_file)
-        with jsonlines.Writer(events_out_file) as out:
-            out.write(payload_dict)
-
-        events_out_file.flush()
-
     # -------------------------------------------------------------------------
 
     # Files used to communicate with classifier
@@ -101,86 +114,71 @@ def main():
     classifier_labels = open(args.classifier_labels, "r")
 
     # FST used to recognize slot values
-    slot_fst = fst.Fst.read(args.slot_fst)
-    logging.debug(f"Loaded slot FST from {args.slot_fst}")
-
-    # Recognize lines from file
-    for line in events_in_file:
-        line = line.strip()
-        logger.debug(line)
-
-        try:
-            if args.text_input:
-                # Assume text input
-                topic = EVENT_RECOGNIZE
-                event = json.dumps({"text": line})
-            else:
-                # Expected <topic> <payload> on each line
-                topic, event = line.split(" ", maxsplit=1)
-
-            topic_parts = topic.split("/")
-            base_topic = "/".join(topic_parts[:3])
-
-            # Everything after base topic is request id
-            request_id = "/".join(topic_parts[3:])
-            if len(request_id) > 0:
-                request_id = "/" + request_id
-
-            if base_topic == EVENT_RECOGNIZE:
-                event_dict = maybe_object(event)
-                text = event_dict.get("text", "")
-
-                if args.lower:
-                    text = text.lower()
-
-                # Send text to classifier
-                print(text, file=classifier_sentences)
-                classifier_sentences.flush()
-
-                # Read predicted label back from classifier.
-                # Assume __label__ prefix.
-                label = classifier_labels.readline().strip()
-                logger.debug(label)
+    if args.intent_artifact:
+        slot_fst = IntentArtifact(args.intent_artifact).slot_acceptor()
+        logger.debug(f"Created slot FST from {args.intent_artifact}")
+    else:
+        slot_fst = fst.Fst.read(args.slot_fst)
+        logger.debug(f"Loaded slot FST from {args.slot_fst}")
+
+    bus = EventBus(
+        make_transport(
+            events_in_file,
+            events_out_file,
+            events_socket=args.events_socket,
+            mqtt_host=args.mqtt_host,
+            mqtt_port=args.mqtt_port,
+        ),
+        error_topic=EVENT_ERROR,
+        text_input_topic=EVENT_RECOGNIZE if args.text_input else None,
+    )
 
-                # Strip __label__ prefix
-                intent_name = label[9:]
+    def handle_recognize(request_id: str, event: str):
+        event_dict = maybe_object(event)
+        text = event_dict.get("text", "")
 
-                # Create filtered sentence with label
-                words = [label] + filter_words(re.split(r"\s+", text), slot_fst)
+        if args.lower:
+            text = text.lower()
 
-                try:
-                    # Run sentence through slot FST
-                    words_fst = apply_fst(words, slot_fst)
+        # Send text to classifier
+        print(text, file=classifier_sentences)
+        classifier_sentences.flush()
 
-                    # Assume the longest path through the FST is the correct one.
-                    # We're assuming more recognized slots are better.
-                    path_fst = longest_path(words_fst)
-                    path_words = fstprintall(path_fst, exclude_meta=False)[0]
-                except Exception as e:
-                    logger.exception("apply_fst")
+        # Read predicted label back from classifier.
+        # Assume __label__ prefix.
+        label = classifier_labels.readline().strip()
+        logger.debug(label)
 
-                    # Just use original words
-                    path_words = words
+        # Strip __label__ prefix
+        intent_name = label[9:]
 
-                # Convert recognized sentence to intent
-                intent = symbols2intent(path_words)
-                intent["intent"]["name"] = intent_name
+        # Create filtered sentence with label
+        words = [label] + filter_words(re.split(r"\s+", text), slot_fst)
 
-                send_event(EVENT_RECOGNIZED + request_id, intent)
+        try:
+            # Run sentence through slot FST
+            words_fst = apply_fst(words, slot_fst)
 
+            # Assume the longest path through the FST is the correct one.
+            # We're assuming more recognized slots are better.
+            path_fst = longest_path(words_fst)
+            path_words = fstprintall(path_fst, exclude_meta=False)[0]
         except Exception as e:
-            logger.exception(line)
-            send_event(EVENT_ERROR, {"error": str(e)})
+            logger.exception("apply_fst")
 
+            # Just use original words
+            path_words = words
 
-# -----------------------------------------------------------------------------
+        # Convert recognized sentence to intent
+        intent = symbols2intent(path_words)
+        intent["intent"]["name"] = intent_name
+
+        bus.send(EVENT_RECOGNIZED + request_id, intent)
 
+    bus.on(EVENT_RECOGNIZE, handle_recognize)
 
-def maybe_object(json_str):
-    try:
-        return json.loads(json_str)
-    except:
-        return {}
+    # Recognize lines from file
+    event_bus.run(bus.run())
 
 
 # -----------------------------------------------------------------------------
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+import threading
+from typing import Dict, List, Optional
+
+# -------------------------------------------------------------------------------------------------
+
+
+class AudioBuffers:
+    """Accumulates audio for any number of concurrent requests.
+
+    All requests share a single growable buffer, and each request only
+    remembers where its audio starts. Appending a chunk is a single copy no
+    matter how many requests are active, and stop returns a zero-copy view of
+    the request's audio.
+
+    Up to preroll_bytes of audio from before start is included in each
+    request. All methods are thread-safe.
+    """
+
+    def __init__(self, preroll_bytes: int = 0):
+        self.preroll_bytes = preroll_bytes
+
+        self._audio = bytearray()
+
+        # Position of _audio[0] in the audio stream
+        self._base = 0
+
+        # request id -> position where its audio starts
+        self._starts: Dict[str, int] = {}
+
+        self._lock = threading.Lock()
+
+    def start(self, request_id: str):
+        """Starts (or restarts) buffering audio for a request."""
+        with self._lock:
+            self._starts[request_id] = self._base + max(
+                0, len(self._audio) - self.preroll_bytes
+            )
+
+    def append(self, chunk: bytes):
+        """Adds audio to every active request."""
+        with self._lock:
+            self._audio += chunk
+
+            if (len(self._starts) == 0) and (
+                len(self._audio) > (2 * self.preroll_bytes)
+            ):
+                # Only keep pre-roll audio (trimming is amortized)
+                self._trim(self._base + len(self._audio) - self.preroll_bytes)
+
+    def get(self, request_id: str) -> bytes:
+        """Returns a copy of a request's audio so far."""
+        with self._lock:
+            start = self._starts.get(request_id)
+            if start is None:
+                return bytes()
+
+            return bytes(self._audio[start - self._base :])
+
+    def stop(self, request_id: str) -> memoryview:
+        """Stops buffering audio for a request and returns it without copying."""
+        with self._lock:
+            start = self._starts.pop(request_id, None)
+            if start is None:
+                return memoryview(bytes())
+
+            # The returned view keeps the current buffer from being resized,
+            # so other requests (and pre-roll) move to a new buffer.
+            audio, audio_base = self._audio, self._base
+            if len(self._starts) > 0:
+                keep_from = min(self._starts.values())
+            else:
+                keep_from = audio_base + max(0, len(audio) - self.preroll_bytes)
+
+            self._audio = bytearray(memoryview(audio)[keep_from - audio_base :])
+            self._base = keep_from
+
+            return memoryview(audio)[start - audio_base :]
+
+    def active(self) -> List[str]:
+        """Returns request ids that are currently buffering."""
+        with self._lock:
+            return list(self._starts)
+
+    def __contains__(self, request_id: str) -> bool:
+        return request_id in self._starts
+
+    def _trim(self, keep_from: int):
+        """Drops audio before a stream position."""
+        num_bytes = keep_from - self._base
+        if num_bytes > 0:
+            del self._audio[:num_bytes]
+            self._base = keep_from
+
+
+# -------------------------------------------------------------------------------------------------
+
+
+class HubAudioBuffers:
+    """AudioBuffers for audio read from a shared audio_hub ring buffer.
+
+    The ring already holds recent audio, so nothing is copied as chunks
+    arrive. Each request only remembers the cursor where its audio starts,
+    and its audio is copied out of the ring once when it's needed. Requests
+    can start at an earlier cursor (e.g., where a wake word was detected)
+    as long as that audio hasn't been overwritten.
+
+    reader is the audio_hub.AudioReader that chunks are read from. Audio for
+    a request ends at the reader's cursor, matching what has been appended.
+    """
+
+    def __init__(self, reader, preroll_bytes: int = 0):
+        self.reader = reader
+        self.preroll_samples = preroll_bytes // reader.ring.frame_bytes
+
+        # request id -> cursor where its audio starts
+        self._starts: Dict[str, int] = {}
+
+        self._lock = threading.Lock()
+
+    def start(self, request_id: str, cursor: Optional[int] = None):
+        """Starts (or restarts) buffering audio for a request.
+
+        Audio starts at cursor (default: now) minus pre-roll.
+        """
+        with self._lock:
+            if cursor is None:
+                cursor = self.reader.cursor
+
+            start = max(self.reader.ring.oldest, int(cursor) - self.preroll_samples)
+            self._starts[request_id] = min(start, self.reader.cursor)
+
+    def append(self, chunk: bytes):
+        """Audio is already in the ring."""
+        pass
+
+    def get(self, request_id: str) -> bytes:
+        """Returns a copy of a request's audio so far."""
+        with self._lock:
+            start = self._starts.get(request_id)
+            if start is None:
+                return bytes()
+
+            return self._read(start)
+
+    def stop(self, request_id: str) -> bytes:
+        """Stops buffering audio for a request and returns it."""
+        with self._lock:
+            start = self._starts.pop(request_id, None)
+            if start is None:
+                return bytes()
+
+            return self._read(start)
+
+    def active(self) -> List[str]:
+        """Returns request ids that are currently buffering."""
+        with self._lock:
+            return list(self._starts)
+
+    def __contains__(self, request_id: str) -> bool:
+        return request_id in self._starts
+
+    def _read(self, start: int) -> bytes:
+        # Audio that has been overwritten is skipped
+        return self.reader.ring.read(
+            max(start, self.reader.ring.oldest), self.reader.cursor
+        )
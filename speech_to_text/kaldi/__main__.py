@@ -6,15 +6,23 @@ logger = logging.getLogger("kaldi_rhasspy")
 import os
 import sys
 import argparse
+import asyncio
 import json
+import time
+import signal
+import socket
 import threading
 import subprocess
 import wave
 import io
 import tempfile
-from typing import Optional, Dict, Any, Set
+import functools
+from typing import Optional, Dict, Any, Set, Union
 
-import jsonlines
+import event_bus
+from audio_hub import AudioReader, read_chunks
+from event_bus import EventBus, EventWriter, make_transport, maybe_object
+from speech_to_text.audio_buffer import AudioBuffers, HubAudioBuffers
 
 # -------------------------------------------------------------------------------------------------
 
@@ -26,17 +34,34 @@ def main():
         help="File to raw audio data from (16-bit 16Khz mono PCM)",
         default=None,
     )
+    parser.add_argument(
+        "--audio-hub",
+        help="Read audio from a shared ring buffer (see audio_hub) instead of stdin",
+    )
     parser.add_argument(
         "--chunk-size",
         help="Number of bytes to read from audio file at a time (0 = synchronous read)",
         type=int,
         default=1024,
     )
+    parser.add_argument(
+        "--preroll-seconds",
+        help="Seconds of audio from before listening starts to include (default=0)",
+        type=float,
+        default=0,
+    )
     parser.add_argument(
         "--events-file",
         help="File to read events from (one per line, topic followed by JSON)",
         default=None,
     )
+    parser.add_argument(
+        "--mqtt-host",
+        help="MQTT broker to receive events and send results through (instead of events file)",
+    )
+    parser.add_argument(
+        "--mqtt-port", type=int, default=1883, help="MQTT broker port (default=1883)"
+    )
     parser.add_argument("--model-dir", required=True, help="Directory with kaldi model")
     parser.add_argument(
         "--model-type", required=True, choices=["nnet3", "gmm"], help="Kaldi model type"
@@ -55,6 +80,32 @@ def main():
         help="Topic to stop reading audio data and transcribe (default=stop)",
         default="stop",
     )
+    parser.add_argument(
+        "--event-reload",
+        help="Topic to reload the model/graph (restarts decode server, default=reload)",
+        default="reload",
+    )
+    parser.add_argument(
+        "--event-text",
+        help="Topic for transcriptions (default=none, just JSON; text-captured with --mqtt-host)",
+    )
+    parser.add_argument(
+        "--decode-server-port",
+        type=int,
+        default=0,
+        help="Keep an nnet3 decoder running on this TCP port (default=0, new decoder per utterance)",
+    )
+    parser.add_argument(
+        "--trim-silence",
+        action="store_true",
+        help="Cut leading/trailing silence before decoding (requires numpy)",
+    )
+    parser.add_argument(
+        "--trim-padding-seconds",
+        type=float,
+        default=0.25,
+        help="Seconds of silence to keep around speech when trimming (default=0.25)",
+    )
     parser.add_argument(
         "--debug", action="store_true", help="Print DEBUG messages to console"
     )
@@ -72,85 +123,213 @@ def main():
         logger.fatal("Audio file required if audio sync is on (chunk_size = 0)")
         sys.exit(1)
 
+    trim = None
+    if args.trim_silence:
+        # Decode time scales with audio length, so cut silence first
+        from speech_to_text.trim import trim_silence
+
+        trim = functools.partial(
+            trim_silence, padding_seconds=args.trim_padding_seconds
+        )
+
     audio_file = sys.stdin.buffer
-    if args.audio_file and not audio_sync:
+    if args.audio_hub and not audio_sync:
+        # Requests can start at an earlier cursor (audio_cursor in start event)
+        audio_file = AudioReader.attach(args.audio_hub)
+    elif args.audio_file and not audio_sync:
         audio_file = open(args.audio_file, "rb")
 
     # Start listening for events
-    if args.events_file:
-        listening = False
+    if args.events_file or args.mqtt_host:
         audio_data = bytes()
 
-        # Read thread (asynchronous)
-        if not audio_sync:
+        events_file = None
+        if args.events_file:
+            events_file = open(args.events_file, "r")
+
+        if args.mqtt_host and not args.event_text:
+            # Messages on a broker need a topic
+            args.event_text = "text-captured"
+
+        # Audio and events are handled on the same event loop
+        bus = EventBus(
+            make_transport(
+                events_file,
+                sys.stdout,
+                mqtt_host=args.mqtt_host,
+                mqtt_port=args.mqtt_port,
+            )
+        )
+
+        def start_decode_server() -> "KaldiDecodeServer":
+            return KaldiDecodeServer(
+                args.kaldi_dir,
+                args.model_dir,
+                args.model_type,
+                args.graph_dir,
+                port=args.decode_server_port,
+            )
+
+        # Persistent decoder (model is only loaded once)
+        decode_server: Optional[KaldiDecodeServer] = None
+        if args.decode_server_port > 0:
+            if args.model_type != "nnet3":
+                logger.fatal("Decode server requires an nnet3 model")
+                sys.exit(1)
+
+            decode_server = start_decode_server()
+
+        # Decode server is stopped in finally below
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        # Audio read on the loop, starting with pre-roll audio (16-bit samples)
+        preroll_bytes = 2 * int(args.preroll_seconds * 16000)
+        if args.audio_hub:
+            # Audio stays in the ring buffer until it's needed
+            audio_buffers = HubAudioBuffers(audio_file, preroll_bytes=preroll_bytes)
+        else:
+            audio_buffers = AudioBuffers(preroll_bytes=preroll_bytes)
+
+        async def read_audio():
+            try:
+                async for chunk, _ in read_chunks(audio_file, args.chunk_size):
+                    audio_buffers.append(chunk)
+
+                    if decode_server is not None:
+                        # Stream audio to decoder
+                        decode_server.send(chunk)
+            except Exception as e:
+                logger.exception("read_audio")
+
+        def handle_start(request_id: str, event: str):
+            nonlocal audio_data
+            if audio_sync:
+                with open(args.audio_file, "rb") as sync_audio_file:
+                    # Read entire file
+                    audio_data = sync_audio_file.read()
+            else:
+                # Start buffer with pre-roll audio and read asynchronously
+                if args.audio_hub:
+                    # Start where the wake word was detected, if given
+                    audio_buffers.start(
+                        "", cursor=maybe_object(event).get("audio_cursor")
+                    )
+                else:
+                    audio_buffers.start("")
+
+                if decode_server is not None:
+                    decode_server.start()
+                    decode_server.send(audio_buffers.get(""))
+
+            logger.debug("Started listening")
+
+        async def handle_stop(request_id: str, event: str):
+            nonlocal audio_data
+
+            # Stop reading and transcribe
+            if not audio_sync:
+                audio_data = audio_buffers.stop("")
+
+            logger.debug(f"Stopped listening. Decoding {len(audio_data)} bytes")
+
+            # Audio already streamed to the decoder can't be trimmed
+            trimmed_seconds = None
+            if (trim is not None) and (audio_sync or (decode_server is None)):
+                audio_data, trimmed_seconds = trim(audio_data)
+
+            # Decode in a thread while audio is still read
+            if decode_server is not None:
+                if audio_sync:
+                    decode = functools.partial(decode_server.transcribe, audio_data)
+                else:
+                    # Audio was already streamed
+                    decode = decode_server.finish
+            else:
+                decode = functools.partial(
+                    transcribe,
+                    audio_data,
+                    args.kaldi_dir,
+                    args.model_dir,
+                    args.model_type,
+                    args.graph_dir,
+                )
+
+            result = await asyncio.get_event_loop().run_in_executor(None, decode)
+
+            if trimmed_seconds is not None:
+                result["trimmed_seconds"] = trimmed_seconds
+
+            logging.debug(result)
+
+            bus.send(args.event_text, result)
+
+        async def handle_reload(request_id: str, event: str):
+            nonlocal decode_server
+
+            # Pick up a retrained model or graph
+            event_dict = maybe_object(event)
+            args.model_dir = event_dict.get("model-dir", args.model_dir)
+            args.graph_dir = event_dict.get("graph-dir", args.graph_dir)
+            logger.debug(f"Reloading (model={args.model_dir}, graph={args.graph_dir})")
+
+            if decode_server is not None:
+                # New server can't start until old one frees the port
+                old_server, decode_server = decode_server, None
+
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, old_server.close)
 
-            def read_audio():
-                nonlocal listening, audio_data
                 try:
-                    while True:
-                        chunk = audio_file.read(args.chunk_size)
-                        if len(chunk) > 0:
-                            if listening:
-                                audio_data += chunk
-                        else:
-                            time.sleep(0.01)
-                except Exception as e:
-                    logger.exception("read_audio")
-
-            threading.Thread(target=read_audio, daemon=True).start()
-
-        # Wait for start/stop events
-        with open(args.events_file, "r") as events:
-            while True:
-                line = events.readline().strip()
-                if len(line) == 0:
-                    continue
-
-                logger.debug(line)
-                topic, event = line.split(" ", maxsplit=1)
-                if topic == args.event_start:
-                    if audio_sync:
-                        with open(args.audio_file, "rb") as audio_file:
-                            # Read entire file
-                            audio_data = audio_file.read()
-                    else:
-                        # Clear buffer and start reading asynchronously
-                        audio_data = bytes()
-                        listening = True
-                        logger.debug("Started listening")
-
-                elif topic == args.event_stop:
-                    # Stop reading and transcribe
-                    listening = False
-                    logger.debug(f"Stopped listening. Decoding {len(audio_data)} bytes")
-
-                    result = transcribe(
-                        audio_data,
-                        args.kaldi_dir,
-                        args.model_dir,
-                        args.model_type,
-                        args.graph_dir,
+                    decode_server = await loop.run_in_executor(
+                        None, start_decode_server
                     )
-                    logging.debug(result)
+                except Exception:
+                    # Fall back to a new decoder per utterance
+                    logger.exception("reload")
 
-                    with jsonlines.Writer(sys.stdout) as out:
-                        out.write(result)
-                    sys.stdout.flush()
+        bus.on(args.event_start, handle_start)
+        bus.on(args.event_stop, handle_stop)
+        bus.on(args.event_reload, handle_reload)
+
+        async def handle_events():
+            audio_task = None
+            if not audio_sync:
+                audio_task = asyncio.ensure_future(read_audio())
+
+            await bus.run()
+
+            if audio_task is not None:
+                audio_task.cancel()
+
+        try:
+            event_bus.run(handle_events())
+        finally:
+            # Don't leave the decoder running (it holds the port)
+            if decode_server is not None:
+                decode_server.close()
     else:
         # Read all data from audio file, decode, and stop
         audio_data = audio_file.read()
+
+        trimmed_seconds = None
+        if trim is not None:
+            audio_data, trimmed_seconds = trim(audio_data)
+
         result = transcribe(
             audio_data, args.kaldi_dir, args.model_dir, args.model_type, args.graph_dir
         )
-        with jsonlines.Writer(sys.stdout) as out:
-            out.write(result)
+
+        if trimmed_seconds is not None:
+            result["trimmed_seconds"] = trimmed_seconds
+
+        EventWriter(sys.stdout).send(None, result)
 
 
 # -------------------------------------------------------------------------------------------------
 
 
 def transcribe(
-    audio_bytes: bytes,
+    audio_bytes: Union[bytes, memoryview],
     kaldi_dir: str,
     model_dir: str,
     model_type: str,
@@ -203,7 +382,178 @@ def transcribe(
 # -------------------------------------------------------------------------------------------------
 
 
-def buffer_to_wav(buffer: bytes) -> bytes:
+class KaldiDecodeServer:
+    """Long-running online nnet3 decoder (rhasspy-kaldi-decode-server).
+
+    The model and graph are loaded once. Audio for each utterance is
+    streamed over a new TCP connection, and the transcription is read back
+    after the audio ends.
+    """
+
+    def __init__(
+        self,
+        kaldi_dir: str,
+        model_dir: str,
+        model_type: str = "nnet3",
+        graph_dir: Optional[str] = None,
+        port: int = 5050,
+        host: str = "127.0.0.1",
+        start_timeout: float = 60,
+    ):
+        self.host = host
+        self.port = port
+
+        server_cmd = [
+            "rhasspy-kaldi-decode-server",
+            "--kaldi-dir",
+            kaldi_dir,
+            "--model-dir",
+            model_dir,
+            "--model-type",
+            model_type,
+            "--port",
+            str(port),
+        ]
+
+        if graph_dir:
+            server_cmd.extend(["--graph-dir", graph_dir])
+
+        # Otherwise we'd wait for (and use) a decoder that someone else started
+        if self._is_listening():
+            raise RuntimeError(f"Port {port} is already in use (old decode server?)")
+
+        logger.debug(server_cmd)
+        self.process = subprocess.Popen(server_cmd)
+
+        # Current utterance
+        self._connection: Optional[socket.socket] = None
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+        try:
+            self._wait_for_server(start_timeout)
+        except Exception:
+            self.close()
+            raise
+
+    def _is_listening(self) -> bool:
+        try:
+            with socket.create_connection((self.host, self.port)):
+                return True
+        except OSError:
+            # Refused, reset, unreachable, etc.
+            return False
+
+    def _wait_for_server(self, timeout: float):
+        """Waits until the decoder has loaded its model and accepts connections."""
+        start_time = time.time()
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError(
+                    f"Decode server exited with code {self.process.returncode}"
+                )
+
+            try:
+                # Server decodes an empty utterance
+                with socket.create_connection((self.host, self.port)):
+                    pass
+
+                break
+            except ConnectionRefusedError:
+                if (time.time() - start_time) > timeout:
+                    raise
+
+                time.sleep(0.1)
+
+        logger.debug(
+            f"Decode server ready on port {self.port} in {time.time() - start_time} second(s)"
+        )
+
+    def start(self):
+        """Starts a new utterance."""
+        connection = socket.create_connection((self.host, self.port))
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+
+            self._connection = connection
+            self._num_bytes = 0
+
+    def send(self, audio_bytes: Union[bytes, memoryview]):
+        """Sends raw audio (16-bit 16Khz mono) for the current utterance."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.sendall(audio_bytes)
+                self._num_bytes += len(audio_bytes)
+
+    def finish(self) -> Dict[str, Any]:
+        """Ends the current utterance and returns its transcription."""
+        with self._lock:
+            connection, self._connection = self._connection, None
+            num_bytes = self._num_bytes
+
+        if connection is None:
+            return {
+                "text": "",
+                "wav_name": "",
+                "wav_seconds": 0,
+                "transcribe_seconds": 0,
+            }
+
+        start_time = time.time()
+        with connection:
+            # Server finishes decoding when audio ends
+            connection.shutdown(socket.SHUT_WR)
+
+            output = bytearray()
+            while True:
+                data = connection.recv(4096)
+                if not data:
+                    break
+
+                output += data
+
+        # Final text for each segment ends with \n (partial results end with \r)
+        segments = [
+            line.rsplit("\r", maxsplit=1)[-1].strip()
+            for line in output.decode().split("\n")
+        ]
+
+        return {
+            "text": " ".join(s for s in segments if len(s) > 0),
+            "wav_name": "",
+            "wav_seconds": num_bytes / (16000 * 2),
+            "transcribe_seconds": time.time() - start_time,
+        }
+
+    def transcribe(self, audio_bytes: Union[bytes, memoryview]) -> Dict[str, Any]:
+        """Decodes a complete utterance."""
+        self.start()
+        self.send(audio_bytes)
+        return self.finish()
+
+    def close(self, timeout: float = 5):
+        """Stops the decoder, waiting for it to exit so the port is free."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+        logger.debug(f"Decode server exited with code {self.process.returncode}")
+
+
+# -------------------------------------------------------------------------------------------------
+
+
+def buffer_to_wav(buffer: Union[bytes, memoryview]) -> bytes:
     """Wraps a buffer of raw audio data (16-bit, 16Khz mono) in a WAV"""
     with io.BytesIO() as wav_buffer:
         with wave.open(wav_buffer, mode="wb") as wav_file:
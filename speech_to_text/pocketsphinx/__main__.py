@@ -6,16 +6,27 @@ logger = logging.getLogger("pocketsphinx_rhasspy")
 import os
 import sys
 import argparse
+import asyncio
 import json
-import threading
+import functools
+import multiprocessing.pool
 import time
 from collections import defaultdict
-from typing import Optional, Dict, Any, Set
+from typing import Optional, Dict, Any, Set, List
 
-import jsonlines
 import pocketsphinx
 
-from speech_to_text.pocketsphinx.pocketsphinx_rhasspy import get_decoder, transcribe
+import event_bus
+from event_bus import EventBus, EventWriter, make_transport, maybe_object
+from audio_hub import AudioReader, read_chunks
+from speech_to_text.audio_buffer import AudioBuffers, HubAudioBuffers
+from speech_to_text.pocketsphinx.pocketsphinx_rhasspy import (
+    get_decoder,
+    transcribe,
+    TranscriptionStream,
+    get_decoder_pool,
+    pool_transcribe,
+)
 
 # -------------------------------------------------------------------------------------------------
 # MQTT Events
@@ -32,6 +43,7 @@ EVENT_RELOAD = EVENT_PREFIX + "reload"
 EVENT_ERROR = EVENT_PREFIX + "error"
 EVENT_RECEIVNG_AUDIO = EVENT_PREFIX + "receiving-audio"
 EVENT_TEXT_CAPTURED = EVENT_PREFIX + "text-captured"
+EVENT_PARTIAL_TEXT = EVENT_PREFIX + "partial-text"
 EVENT_STARTED = EVENT_PREFIX + "listening-started"
 EVENT_STOPPED = EVENT_PREFIX + "listening-stopped"
 EVENT_RELOADED = EVENT_PREFIX + "reloaded"
@@ -46,6 +58,10 @@ def main():
         help="File to raw audio data from (16-bit 16Khz mono PCM)",
         default=None,
     )
+    parser.add_argument(
+        "--audio-hub",
+        help="Read audio from a shared ring buffer (see audio_hub) instead of stdin",
+    )
     parser.add_argument(
         "--audio-file-lines",
         action="store_true",
@@ -57,6 +73,12 @@ def main():
         type=int,
         default=1024,
     )
+    parser.add_argument(
+        "--preroll-seconds",
+        help="Seconds of audio from before listening starts to include (default=0)",
+        type=float,
+        default=0,
+    )
     parser.add_argument(
         "--events-in-file",
         help="File to read events from (one per line, topic followed by JSON)",
@@ -67,6 +89,17 @@ def main():
         help="File to write events to (one per line, topic followed by JSON)",
         default=None,
     )
+    parser.add_argument(
+        "--events-socket",
+        help="Unix socket to send/receive events on (instead of events files)",
+    )
+    parser.add_argument(
+        "--mqtt-host",
+        help="MQTT broker to send/receive events through (instead of events files)",
+    )
+    parser.add_argument(
+        "--mqtt-port", type=int, default=1883, help="MQTT broker port (default=1883)"
+    )
     parser.add_argument(
         "--acoustic-model", required=True, help="Directory with Sphinx acoustic model"
     )
@@ -85,6 +118,33 @@ def main():
         default=0,
         help="Include up to N best alternative transcriptions",
     )
+    parser.add_argument(
+        "--decoders",
+        type=int,
+        default=1,
+        help="Number of decoder processes for concurrent transcriptions (default=1)",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Decode audio while listening instead of after stop-listening",
+    )
+    parser.add_argument(
+        "--partial-results",
+        action="store_true",
+        help="Send partial-text events while decoding (requires --streaming)",
+    )
+    parser.add_argument(
+        "--trim-silence",
+        action="store_true",
+        help="Cut leading/trailing silence before decoding (requires numpy, not applied to --streaming requests)",
+    )
+    parser.add_argument(
+        "--trim-padding-seconds",
+        type=float,
+        default=0.25,
+        help="Seconds of silence to keep around speech when trimming (default=0.25)",
+    )
     parser.add_argument(
         "--debug", action="store_true", help="Print DEBUG messages to console"
     )
@@ -99,7 +159,10 @@ def main():
     # -------------------------------------------------------------------------
 
     audio_file = sys.stdin.buffer
-    if args.audio_file and (args.audio_file != "-"):
+    if args.audio_hub:
+        # Requests can start at an earlier cursor (audio_cursor in start event)
+        audio_file = AudioReader.attach(args.audio_hub)
+    elif args.audio_file and (args.audio_file != "-"):
         if not args.audio_file_lines:
             # Contains raw audio data
             audio_file = open(args.audio_file, "rb")
@@ -129,161 +192,353 @@ def main():
     if args.events_out_file and not (args.events_out_file == "-"):
         events_out_file = open(args.events_out_file, "w")
 
-    def send_event(topic, payload_dict={}):
-        print(topic, end=" ", file=events_out_file)
-        with jsonlines.Writer(events_out_file) as out:
-            out.write(payload_dict)
+    trim = None
+    if args.trim_silence:
+        # Decode time scales with audio length, so cut silence first
+        from speech_to_text.trim import trim_silence
 
-        events_out_file.flush()
+        trim = functools.partial(
+            trim_silence, padding_seconds=args.trim_padding_seconds
+        )
 
     # -------------------------------------------------------------------------
 
-    if events_in_file:
-        # Audio buffers keyed by request id
-        audio_data: Dict[str, bytes] = {}
+    if events_in_file or args.events_socket or args.mqtt_host:
+        # Audio and events are handled on the same event loop
+        bus = EventBus(
+            make_transport(
+                events_in_file,
+                events_out_file,
+                events_socket=args.events_socket,
+                mqtt_host=args.mqtt_host,
+                mqtt_port=args.mqtt_port,
+            ),
+            error_topic=EVENT_ERROR,
+        )
+
+        # Audio buffers keyed by request id (shared by concurrent requests).
+        # Pre-roll audio is added to the start of each buffer (16-bit samples).
+        preroll_bytes = 2 * int(args.preroll_seconds * 16000)
+        if args.audio_hub:
+            # Audio stays in the ring buffer until it's needed
+            audio_data = HubAudioBuffers(audio_file, preroll_bytes=preroll_bytes)
+        else:
+            audio_data = AudioBuffers(preroll_bytes=preroll_bytes)
 
-        # Lock for audio_data
-        audio_data_lock = threading.Lock()
+        # Audio read entirely from files keyed by request id (--audio-file-lines)
+        file_audio_data: Dict[str, bytes] = {}
 
         report_audio = False
 
-        # Read thread (asynchronous)
-        if not args.audio_file_lines:
-
-            def read_audio():
-                nonlocal audio_data, audio_data_lock, report_audio
+        # Request being decoded while listening (--streaming).
+        # The decoder can only stream one request at a time, so other requests
+        # are decoded after stop-listening. Audio is still buffered in case
+        # the stream needs to be cancelled.
+        stream: Optional[TranscriptionStream] = None
+        stream_request_id = ""
+
+        def take_stream() -> Optional[TranscriptionStream]:
+            """Stops decoding audio as it arrives."""
+            nonlocal stream
+            current_stream, stream = stream, None
+
+            return current_stream
+
+        # Decoder processes for concurrent transcriptions (--decoders).
+        # Model files are shared through the page cache.
+        def make_pool(
+            decoder_args: Dict[str, Any],
+        ) -> Optional[multiprocessing.pool.Pool]:
+            if args.decoders > 1:
+                return get_decoder_pool(
+                    args.decoders,
+                    decoder_args["acoustic_model"],
+                    decoder_args["dictionary"],
+                    decoder_args["language_model"],
+                    mllr_matrix=decoder_args["mllr_matrix"],
+                    nbest=args.nbest,
+                )
+
+            return None
+
+        def get_decoder_args() -> Dict[str, Any]:
+            return {
+                "acoustic_model": args.acoustic_model,
+                "dictionary": args.dictionary,
+                "language_model": args.language_model,
+                "mllr_matrix": args.mllr_matrix,
+            }
+
+        # Closed pools finishing their pending transcriptions
+        retired_pools: List[multiprocessing.pool.Pool] = []
+        pool = make_pool(get_decoder_args())
+
+        # Replacement decoders are loaded in the background, one at a time
+        reload_lock: Optional[asyncio.Lock] = None
+        reload_tasks: List[asyncio.Future] = []
+
+        async def reload_decoder(
+            request_id: str, event_dict: Dict[str, Any], decoder_args: Dict[str, Any]
+        ):
+            nonlocal decoder, pool
+            async with reload_lock:
                 try:
-                    while True:
-                        chunk = audio_file.read(args.chunk_size)
-                        if len(chunk) > 0:
-                            if report_audio:
-                                # Inform user that audio is being successfully received
-                                logger.debug("Receiving audio")
-                                send_event(EVENT_RECEIVNG_AUDIO)
-                                report_audio = False
-
-                            with audio_data_lock:
-                                # Add to all active buffers
-                                for key in audio_data:
-                                    audio_data[key] += chunk
-                        else:
-                            # Avoid 100% CPU usage
-                            time.sleep(0.01)
+                    # Load decoder (and pool) in a thread
+                    loop = asyncio.get_event_loop()
+                    start_time = time.time()
+                    new_decoder = await loop.run_in_executor(
+                        None,
+                        functools.partial(
+                            get_decoder,
+                            decoder_args["acoustic_model"],
+                            decoder_args["dictionary"],
+                            decoder_args["language_model"],
+                            mllr_matrix=decoder_args["mllr_matrix"],
+                            debug=args.debug,
+                        ),
+                    )
+                    new_pool = await loop.run_in_executor(None, make_pool, decoder_args)
+                    load_seconds = time.time() - start_time
+
+                    # Audio is processed on this loop, so the swap is atomic
+                    # (in-progress requests keep the old decoder).
+                    decoder = new_decoder
+                    old_pool, pool = pool, new_pool
+
+                    if old_pool is not None:
+                        # Finish pending transcriptions in the background
+                        old_pool.close()
+                        retired_pools.append(old_pool)
+
+                    logger.debug(f"Reloaded decoder in {load_seconds} second(s)")
+                    event_dict["load_seconds"] = load_seconds
+                    bus.send(EVENT_RELOADED + request_id, event_dict)
                 except Exception as e:
-                    logger.exception("read_audio")
-
-            threading.Thread(target=read_audio, daemon=True).start()
+                    logger.exception("reload")
+                    bus.send(EVENT_ERROR + request_id, {"error": str(e)})
+
+        def send_result(
+            request_id: str,
+            event: str,
+            result: Dict[str, Any],
+            trimmed_seconds: Optional[float] = None,
+            streamed: bool = False,
+        ):
+            logger.debug(result.get("text", ""))
+
+            if trimmed_seconds is not None:
+                result["trimmed_seconds"] = trimmed_seconds
+
+            if args.streaming:
+                # Streamed audio was decoded as it arrived (untrimmed)
+                result["streamed"] = streamed
+
+            # Merge stop event data into result
+            try:
+                event_dict = json.loads(event)
+                for key, value in event_dict.items():
+                    result[key] = value
+            except:
+                pass
 
-        # Wait for start/stop events
-        for line in events_in_file:
-            line = line.strip()
-            if len(line) == 0:
-                continue
+            bus.send(EVENT_TEXT_CAPTURED + request_id, result)
 
-            logger.debug(line)
+        def send_error(request_id: str, error: Exception):
+            logger.error(f"transcribe: {error} (request_id={request_id})")
+            bus.send(EVENT_ERROR + request_id, {"error": str(error)})
 
+        async def read_audio():
+            nonlocal report_audio
             try:
-                # Expected <topic> <payload> on each line
-                topic, event = line.split(" ", maxsplit=1)
-                topic_parts = topic.split("/")
-                base_topic = "/".join(topic_parts[:3])
-
-                # Everything after base topic is request id
-                request_id = "/".join(topic_parts[3:])
-                if len(request_id) > 0:
-                    request_id = "/" + request_id
-
-                if base_topic == EVENT_START:
-                    if args.audio_file_lines:
-                        # Get next file path
-                        audio_path = audio_file.readline().strip()
-                        logger.debug(f"Reading raw audio data from {audio_path}")
-                        with open(audio_path, "rb") as actual_audio_file:
-                            # Read entire file
-                            audio_data[request_id] = actual_audio_file.read()
-                    else:
-                        # Clear buffer and start reading asynchronously
-                        with audio_data_lock:
-                            audio_data[request_id] = bytes()
-
-                        logger.debug(f"Started listening (request_id={request_id})")
-                        report_audio = True
-
-                    send_event(EVENT_STARTED + request_id)
-                elif base_topic == EVENT_STOP:
-                    # Stop reading and transcribe
-                    with audio_data_lock:
-                        audio_buffer = audio_data.pop(request_id, bytes())
-                        logger.debug(
-                            f"Stopped listening. Decoding {len(audio_buffer)} bytes (request_id={request_id})"
-                        )
-
-                    event_dict = maybe_object(event)
-                    send_event(EVENT_STOPPED + request_id, event_dict)
-
-                    # Transcribe audio data
-                    result = transcribe(decoder, audio_buffer, nbest=args.nbest)
-                    logger.debug(result.get("text", ""))
-
-                    # Merge stop event data into result
-                    try:
-                        event_dict = json.loads(event)
-                        for key, value in event_dict.items():
-                            result[key] = value
-                    except:
-                        pass
-
-                    send_event(EVENT_TEXT_CAPTURED + request_id, result)
-                elif base_topic == EVENT_RELOAD:
-                    # Re-load pocketsphinx decoder
-                    logger.debug("Reloading decoder.")
-                    event_dict = maybe_object(event)
-
-                    try:
-                        # Load new settings
-                        args.acoustic_model = event_dict.get(
-                            "acoustic-model", args.acoustic_model
-                        )
-                        args.language_model = event_dict.get(
-                            "language-model", args.language_model
-                        )
-                        args.dictionary = event_dict.get("dictionary", args.dictionary)
-                        args.mllr_matrix = event_dict.get(
-                            "mllr-matrix", args.mllr_matrix
-                        )
-                    except Exception as e:
-                        logger.exception("reload")
-
-                    # Load decoder again
-                    decoder = get_decoder(
-                        args.acoustic_model,
-                        args.dictionary,
-                        args.language_model,
-                        mllr_matrix=args.mllr_matrix,
-                        debug=args.debug,
+                async for chunk, _ in read_chunks(audio_file, args.chunk_size):
+                    if report_audio:
+                        # Inform user that audio is being successfully received
+                        logger.debug("Receiving audio")
+                        bus.send(EVENT_RECEIVNG_AUDIO)
+                        report_audio = False
+
+                    # Add to all active buffers
+                    audio_data.append(chunk)
+
+                    if stream is not None:
+                        partial_text = stream.process(chunk)
+                        if args.partial_results and (partial_text is not None):
+                            bus.send(
+                                EVENT_PARTIAL_TEXT + stream_request_id,
+                                {"text": partial_text},
+                            )
+            except Exception as e:
+                logger.exception("read_audio")
+
+        def handle_start(request_id: str, event: str):
+            nonlocal report_audio, stream, stream_request_id
+            if args.audio_file_lines:
+                # Get next file path
+                audio_path = audio_file.readline().strip()
+                logger.debug(f"Reading raw audio data from {audio_path}")
+                with open(audio_path, "rb") as actual_audio_file:
+                    # Read entire file
+                    file_audio_data[request_id] = actual_audio_file.read()
+            else:
+                # Start buffer with pre-roll audio and read asynchronously
+                if args.audio_hub:
+                    # Start where the wake word was detected, if given
+                    audio_data.start(
+                        request_id, cursor=maybe_object(event).get("audio_cursor")
+                    )
+                else:
+                    audio_data.start(request_id)
+
+                if args.streaming and (stream is None):
+                    # Decode audio as it arrives
+                    stream = TranscriptionStream(decoder, nbest=args.nbest)
+                    stream_request_id = request_id
+                    stream.process(audio_data.get(request_id))
+
+                logger.debug(f"Started listening (request_id={request_id})")
+                report_audio = True
+
+            bus.send(EVENT_STARTED + request_id)
+
+        async def handle_stop(request_id: str, event: str):
+            # Stop reading and transcribe
+            if request_id in file_audio_data:
+                audio_buffer = file_audio_data.pop(request_id)
+            else:
+                audio_buffer = audio_data.stop(request_id)
+
+            logger.debug(
+                f"Stopped listening. Decoding {len(audio_buffer)} bytes (request_id={request_id})"
+            )
+
+            event_dict = maybe_object(event)
+            bus.send(EVENT_STOPPED + request_id, event_dict)
+
+            is_streamed = (stream is not None) and (stream_request_id == request_id)
+
+            trimmed_seconds = None
+            if trim is not None:
+                if is_streamed:
+                    # Audio was already decoded as it arrived
+                    logger.debug(
+                        f"Not trimming streamed audio (request_id={request_id})"
                     )
+                else:
+                    audio_buffer, trimmed_seconds = trim(audio_buffer)
+
+            loop = asyncio.get_event_loop()
+            if is_streamed:
+                # Finish decoding
+                send_result(request_id, event, take_stream().finish(), streamed=True)
+            elif pool is not None:
+                # Transcribe in a worker process, sending the result when it's
+                # ready. Callbacks run on the pool's thread, so results are
+                # passed back to the loop.
+                pool.apply_async(
+                    pool_transcribe,
+                    (bytes(audio_buffer),),
+                    callback=lambda result: loop.call_soon_threadsafe(
+                        functools.partial(
+                            send_result,
+                            request_id,
+                            event,
+                            result,
+                            trimmed_seconds=trimmed_seconds,
+                        )
+                    ),
+                    error_callback=lambda error: loop.call_soon_threadsafe(
+                        send_error, request_id, error
+                    ),
+                )
+            else:
+                if (stream is not None) and (stream.decoder is decoder):
+                    # Decoder is needed, so stream falls back to its buffer
+                    logger.debug(f"Cancelling stream (request_id={stream_request_id})")
+                    take_stream().decoder.end_utt()
+
+                # Transcribe audio data in a thread while audio is still read
+                result = await loop.run_in_executor(
+                    None,
+                    functools.partial(
+                        transcribe, decoder, audio_buffer, nbest=args.nbest
+                    ),
+                )
+                send_result(request_id, event, result, trimmed_seconds)
+
+        def handle_reload(request_id: str, event: str):
+            nonlocal reload_tasks
+
+            # Re-load pocketsphinx decoder
+            logger.debug("Reloading decoder.")
+            event_dict = maybe_object(event)
 
-                    send_event(EVENT_RELOADED + request_id, event_dict)
+            try:
+                # Load new settings
+                args.acoustic_model = event_dict.get(
+                    "acoustic-model", args.acoustic_model
+                )
+                args.language_model = event_dict.get(
+                    "language-model", args.language_model
+                )
+                args.dictionary = event_dict.get("dictionary", args.dictionary)
+                args.mllr_matrix = event_dict.get("mllr-matrix", args.mllr_matrix)
             except Exception as e:
-                logger.exception(line)
-                send_event(EVENT_ERROR, {"error": str(e)})
+                logger.exception("reload")
+
+            # Load decoder again without blocking requests
+            reload_tasks = [t for t in reload_tasks if not t.done()]
+            reload_tasks.append(
+                asyncio.ensure_future(
+                    reload_decoder(request_id, event_dict, get_decoder_args())
+                )
+            )
 
+        bus.on(EVENT_START, handle_start)
+        bus.on(EVENT_STOP, handle_stop)
+        bus.on(EVENT_RELOAD, handle_reload)
+
+        def join_pools():
+            if pool is not None:
+                retired_pools.append(pool)
+
+            for old_pool in retired_pools:
+                old_pool.close()
+                old_pool.join()
+
+        async def handle_events():
+            nonlocal reload_lock
+            reload_lock = asyncio.Lock()
+
+            audio_task = None
+            if not args.audio_file_lines:
+                audio_task = asyncio.ensure_future(read_audio())
+
+            await bus.run()
+
+            # Wait for reloads and pending transcriptions
+            if len(reload_tasks) > 0:
+                await asyncio.wait(reload_tasks)
+
+            await asyncio.get_event_loop().run_in_executor(None, join_pools)
+            bus.flush()
+
+            if audio_task is not None:
+                audio_task.cancel()
+
+        event_bus.run(handle_events())
     else:
         # Read all data from audio file, decode, and stop
         audio_buffer = audio_file.read()
-        result = transcribe(decoder, audio_buffer)
-        with jsonlines.Writer(events_out_file) as out:
-            out.write(result)
 
+        trimmed_seconds = None
+        if trim is not None:
+            audio_buffer, trimmed_seconds = trim(audio_buffer)
 
-# -------------------------------------------------------------------------------------------------
-
+        result = transcribe(decoder, audio_buffer)
+        if trimmed_seconds is not None:
+            result["trimmed_seconds"] = trimmed_seconds
 
-def maybe_object(json_str):
-    try:
-        return json.loads(json_str)
-    except:
-        return {}
+        EventWriter(events_out_file).send(None, result)
 
 
 # -------------------------------------------------------------------------------------------------
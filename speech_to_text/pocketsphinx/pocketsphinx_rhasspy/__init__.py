@@ -10,7 +10,9 @@ import time
 import argparse
 import threading
 import json
-from typing import Optional, Dict, Any
+import multiprocessing
+import multiprocessing.pool
+from typing import Optional, Dict, Any, Union
 
 import pocketsphinx
 
@@ -49,9 +51,15 @@ def get_decoder(
 
 
 def transcribe(
-    decoder: pocketsphinx.Decoder, audio_data: bytes, nbest: int = 0
+    decoder: pocketsphinx.Decoder,
+    audio_data: Union[bytes, memoryview],
+    nbest: int = 0,
 ) -> Dict[str, Any]:
     """Transcribes audio data to text."""
+    if not isinstance(audio_data, bytes):
+        # SWIG wrapper only accepts bytes
+        audio_data = bytes(audio_data)
+
     # Process data as an entire utterance
     start_time = time.time()
     decoder.start_utt()
@@ -61,10 +69,15 @@ def transcribe(
 
     logger.debug(f"Decoded audio in {end_time - start_time} second(s)")
 
+    return get_result(decoder, end_time - start_time, nbest=nbest)
+
+
+def get_result(
+    decoder: pocketsphinx.Decoder, decode_seconds: float, nbest: int = 0
+) -> Dict[str, Any]:
+    """Creates a transcription result from the decoder's last utterance."""
     transcription = ""
-    decode_seconds = end_time - start_time
     likelihood = 0.0
-    score = 0
 
     hyp = decoder.hyp()
     if hyp is not None:
@@ -82,3 +95,98 @@ def transcribe(
         result["nbest"] = {nb.hypstr: nb.score for nb in decoder.nbest()[:nbest]}
 
     return result
+
+
+# -------------------------------------------------------------------------------------------------
+
+
+class TranscriptionStream:
+    """Decodes audio incrementally while it's being recorded.
+
+    Only one stream can be active per decoder at a time.
+    """
+
+    def __init__(self, decoder: pocketsphinx.Decoder, nbest: int = 0):
+        self.decoder = decoder
+        self.nbest = nbest
+
+        # Seconds spent decoding before finish was called
+        self.stream_seconds = 0.0
+        self.partial_text: Optional[str] = None
+
+        self.decoder.start_utt()
+
+    def process(self, audio_data: bytes) -> Optional[str]:
+        """Decodes a chunk of audio. Returns the partial transcription if it changed."""
+        start_time = time.time()
+        self.decoder.process_raw(audio_data, False, False)
+        self.stream_seconds += time.time() - start_time
+
+        hyp = self.decoder.hyp()
+        partial_text = hyp.hypstr if hyp is not None else ""
+        if partial_text != (self.partial_text or ""):
+            self.partial_text = partial_text
+            return partial_text
+
+        return None
+
+    def finish(self) -> Dict[str, Any]:
+        """Ends the utterance and returns the final transcription."""
+        start_time = time.time()
+        self.decoder.end_utt()
+        end_time = time.time()
+
+        logger.debug(
+            f"Finished decoding audio stream in {end_time - start_time} second(s)"
+        )
+
+        # transcribe_seconds is only the time needed after audio stopped
+        result = get_result(self.decoder, end_time - start_time, nbest=self.nbest)
+        result["stream_seconds"] = self.stream_seconds
+
+        return result
+
+
+# -------------------------------------------------------------------------------------------------
+
+# Decoder loaded by each pool worker process
+_pool_decoder: Optional[pocketsphinx.Decoder] = None
+_pool_nbest = 0
+
+
+def get_decoder_pool(
+    processes: int,
+    acoustic_model: str,
+    dictionary: str,
+    language_model: str,
+    mllr_matrix: str,
+    nbest: int = 0,
+) -> multiprocessing.pool.Pool:
+    """Starts worker processes that each load a decoder (use with pool_transcribe)."""
+    # Workers come from a fork server, since forking a threaded process
+    # can deadlock the child.
+    return multiprocessing.get_context("forkserver").Pool(
+        processes,
+        initializer=_init_pool_decoder,
+        initargs=(acoustic_model, dictionary, language_model, mllr_matrix, nbest),
+    )
+
+
+def _init_pool_decoder(
+    acoustic_model: str,
+    dictionary: str,
+    language_model: str,
+    mllr_matrix: str,
+    nbest: int,
+):
+    global _pool_decoder, _pool_nbest
+    _pool_decoder = get_decoder(
+        acoustic_model, dictionary, language_model, mllr_matrix=mllr_matrix
+    )
+    _pool_nbest = nbest
+
+
+def pool_transcribe(audio_data: bytes) -> Dict[str, Any]:
+    """Transcribes audio with a pool worker's decoder."""
+    assert _pool_decoder is not None, "Not a decoder pool worker"
+    return transcribe(_pool_decoder, audio_data, nbest=_pool_nbest)
@@ -0,0 +1,148 @@
+import unittest
+import logging
+import time
+import threading
+
+logging.basicConfig(level=logging.DEBUG)
+
+import numpy as np
+
+from speech_to_text.audio_buffer import AudioBuffers
+from speech_to_text.trim import trim_silence
+
+sample_rate = 16000
+
+
+def make_audio(*parts) -> bytes:
+    """Concatenates (seconds, amplitude) parts of a 440Hz tone as 16-bit audio."""
+    chunks = []
+    for seconds, amplitude in parts:
+        t = np.arange(int(seconds * sample_rate)) / sample_rate
+        chunks.append(
+            (amplitude * np.sin(2 * np.pi * 440 * t)).astype(np.int16).tobytes()
+        )
+
+    return b"".join(chunks)
+
+
+class TrimTestCase(unittest.TestCase):
+    def test_empty(self):
+        audio, trimmed_seconds = trim_silence(bytes())
+        self.assertEqual(bytes(audio), bytes())
+        self.assertEqual(trimmed_seconds, 0.0)
+
+    def test_all_silence(self):
+        silence = make_audio((1.0, 0))
+        audio, trimmed_seconds = trim_silence(silence)
+        self.assertEqual(bytes(audio), silence)
+        self.assertEqual(trimmed_seconds, 0.0)
+
+    def test_odd_length(self):
+        # Less than a sample
+        audio, trimmed_seconds = trim_silence(b"\x01")
+        self.assertEqual(bytes(audio), b"\x01")
+        self.assertEqual(trimmed_seconds, 0.0)
+
+        # 0.5s silence, 0.3s speech, 1s silence, and a stray byte
+        speech = make_audio((0.5, 0), (0.3, 10000), (1.0, 0)) + b"\x00"
+        audio, trimmed_seconds = trim_silence(speech, padding_seconds=0.25)
+
+        # Speech frames 50-79 (10ms), plus 25 frames of padding on each side
+        frame_bytes = 320
+        start, end = 25 * frame_bytes, 105 * frame_bytes
+        self.assertEqual(bytes(audio), speech[start:end])
+        self.assertEqual(
+            trimmed_seconds, (len(speech) - (end - start)) / (2 * sample_rate)
+        )
+
+    def test_speech_to_end(self):
+        # Padding past the end keeps everything (including a partial frame)
+        speech = make_audio((0.5, 0), (0.5, 10000)) + b"\x00"
+        audio, _ = trim_silence(speech, padding_seconds=0.25)
+        self.assertEqual(bytes(audio), speech[25 * 320 :])
+
+
+class AudioBuffersTestCase(unittest.TestCase):
+    def test_preroll(self):
+        buffers = AudioBuffers(preroll_bytes=4)
+        buffers.append(b"abcdef")
+        buffers.start("a")
+        buffers.append(b"gh")
+        self.assertEqual(bytes(buffers.stop("a")), b"cdefgh")
+
+        # Pre-roll is kept when no requests are active
+        buffers.append(b"ijklmnopqrstuvwxyz")
+        buffers.start("b")
+        self.assertEqual(bytes(buffers.stop("b")), b"wxyz")
+
+        # Not enough audio for full pre-roll
+        buffers = AudioBuffers(preroll_bytes=4)
+        buffers.append(b"ab")
+        buffers.start("a")
+        self.assertEqual(bytes(buffers.stop("a")), b"ab")
+
+    def test_overlapping_requests(self):
+        buffers = AudioBuffers(preroll_bytes=2)
+        buffers.append(b"xyab")
+        buffers.start("a")
+        buffers.append(b"12")
+        buffers.start("b")
+        buffers.append(b"34")
+
+        self.assertEqual(sorted(buffers.active()), ["a", "b"])
+        self.assertEqual(buffers.get("a"), b"ab1234")
+
+        # Stopped audio is unaffected by later appends
+        audio_b = buffers.stop("b")
+        buffers.append(b"56")
+        self.assertEqual(bytes(audio_b), b"1234")
+        self.assertEqual(bytes(buffers.stop("a")), b"ab123456")
+
+        # Unknown requests
+        self.assertNotIn("a", buffers)
+        self.assertEqual(bytes(buffers.stop("a")), b"")
+        self.assertEqual(buffers.get("a"), b"")
+
+    def test_concurrent_requests(self):
+        buffers = AudioBuffers(preroll_bytes=20)
+        num_samples = 20000
+        done = threading.Event()
+
+        def append_audio():
+            # Each sample is its position in the stream
+            for sample in range(num_samples):
+                buffers.append(np.array([sample], dtype=np.uint16).tobytes())
+
+            done.set()
+
+        results = []
+
+        def run_requests(request_id: str):
+            while not done.is_set():
+                buffers.start(request_id)
+                time.sleep(0.001)
+                results.append(np.frombuffer(buffers.stop(request_id), np.uint16))
+
+        threads = [threading.Thread(target=append_audio)] + [
+            threading.Thread(target=run_requests, args=(str(i),)) for i in range(4)
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        # Every request got contiguous audio (pre-roll is 10 samples)
+        self.assertTrue(any(len(samples) > 10 for samples in results))
+        for samples in results:
+            if len(samples) > 0:
+                self.assertTrue(np.all(np.diff(samples) == 1))
+
+        self.assertEqual(buffers.active(), [])
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
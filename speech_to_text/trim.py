@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+import logging
+
+logger = logging.getLogger("speech_to_text.trim")
+
+from typing import Tuple, Union
+
+import numpy as np
+
+# -------------------------------------------------------------------------------------------------
+
+
+def trim_silence(
+    audio: Union[bytes, memoryview],
+    sample_rate: int = 16000,
+    energy_ratio: float = 3.0,
+    padding_seconds: float = 0.25,
+    frame_seconds: float = 0.01,
+    min_speech_seconds: float = 0.03,
+    min_floor: float = 50.0,
+) -> Tuple[memoryview, float]:
+    """Cuts leading and trailing silence from 16-bit mono audio.
+
+    Each frame's RMS energy is compared against the noise floor of the
+    buffer (its quietest frames). Speech starts with the first run of
+    min_speech_seconds that is energy_ratio times louder than the floor and
+    ends with the last one, plus padding_seconds on each side.
+
+    Returns a view of the speech region and the number of seconds trimmed.
+    Audio without any speech is returned unchanged.
+    """
+    frame_length = max(1, int(sample_rate * frame_seconds))
+    frame_bytes = frame_length * 2
+    num_frames = len(audio) // frame_bytes
+
+    audio_view = memoryview(audio).cast("B")
+    if num_frames == 0:
+        return audio_view, 0.0
+
+    # Energy of all frames at once
+    samples = np.frombuffer(
+        audio_view, dtype=np.int16, count=num_frames * frame_length
+    ).reshape(num_frames, frame_length)
+
+    float_samples = samples.astype(np.float32)
+    frame_rms = np.sqrt(np.mean(float_samples * float_samples, axis=1))
+    del samples, float_samples
+
+    noise_floor = max(min_floor, float(np.percentile(frame_rms, 10)))
+    is_speech = (frame_rms > (noise_floor * energy_ratio)).astype(np.int32)
+
+    # Ignore clicks shorter than min_speech_seconds
+    run_frames = min(num_frames, max(1, int(min_speech_seconds / frame_seconds)))
+    speech_runs = np.flatnonzero(
+        np.convolve(is_speech, np.ones(run_frames, dtype=np.int32), mode="valid")
+        >= run_frames
+    )
+
+    if len(speech_runs) == 0:
+        logger.debug("No speech found, not trimming")
+        return audio_view, 0.0
+
+    padding_frames = int(padding_seconds / frame_seconds)
+    first_frame = max(0, int(speech_runs[0]) - padding_frames)
+    last_frame = int(speech_runs[-1]) + run_frames + padding_frames
+
+    start = first_frame * frame_bytes
+    end = len(audio_view) if last_frame >= num_frames else last_frame * frame_bytes
+
+    trimmed_seconds = (len(audio_view) - (end - start)) / (2 * sample_rate)
+    logger.debug(f"Trimmed {trimmed_seconds} second(s) of silence")
+
+    return audio_view[start:end], trimmed_seconds
@@ -3,8 +3,11 @@ import os
 import re
 import sys
 import json
+import time
 import argparse
 import logging
+import subprocess
+import tempfile
 from pathlib import Path
 from typing import Dict, Set, Iterable
 from collections import deque
@@ -15,12 +18,19 @@ import pywrapfst as fst
 import networkx as nx
 import doit
 from doit import create_after
+from doit.tools import config_changed
+from doit.reporter import ConsoleReporter
 
 from training.jsgf2fst import (
     get_grammar_dependencies,
     grammar_to_fsts,
     slots_to_fsts,
-    make_intent_fst,
+    optimize_fst,
+    fst_size,
+    write_intent_artifact,
+    write_intent_manifest,
+    load_intent_manifest,
+    manifest_vocab,
 )
 
 from training.ini_jsgf import make_grammars
@@ -75,11 +85,15 @@ kaldi_dir = Path(os.getenv("kaldi_dir") or "/opt/kaldi")
 kaldi_model_dir = ppath("training.kaldi.model-directory", "model")
 kaldi_graph_dir = ppath("training.kaldi.graph-directory", "model/graph")
 kaldi_model_type = pydash.get(profile, "training.kaldi.model-type", None)
+optimize_intent_fst = pydash.get(profile, "training.optimize-intent-fst", False)
 
 # Outputs
 dictionary = ppath("training.dictionary", "dictionary.txt")
 language_model = ppath("training.language-model", "language_model.txt")
 intent_fst = ppath("training.intent-fst", "intent.fst")
+intent_manifest = ppath("training.intent-manifest", "intent_manifest.json")
+intent_artifact = ppath("training.intent-artifact", "intent.bin")
+intent_fst_report = ppath("training.intent-fst-report", "intent_fst_report.json")
 vocab = ppath("training.vocabulary-file", "vocab.txt")
 unknown_words = ppath("training.unknown-words-file", "unknown.txt")
 guess_words = ppath("training.guess-words-file", "guess_words.json")
@@ -98,6 +112,9 @@ for dir_path in [grammar_dir, fsts_dir]:
 # Set of used intents
 intents: Set[str] = set()
 
+# Set of slots used by intents (no "$")
+used_slots: Set[str] = set()
+
 # -----------------------------------------------------------------------------
 
 
@@ -197,8 +214,6 @@ def task_grammar_dependencies():
 @create_after(executed="grammar_dependencies")
 def task_grammar_fsts():
     """Creates grammar FSTs from JSGF grammars and relevant slots."""
-    used_slots: Set[str] = set()
-
     for intent in intents:
         grammar_path = grammar_dir / f"{intent}.gram"
         grammar_dep_path = str(grammar_path) + ".json"
@@ -240,41 +255,111 @@ def task_grammar_fsts():
             "actions": [(do_grammar_to_fsts, [grammar_path, replace_fst_paths])],
         }
 
-    # slots -> FST
-    yield {
-        "name": "slot_fsts",
-        "file_dep": [slots_dir / slot_name for slot_name in used_slots],
-        "targets": [fsts_dir / f"${slot_name}.fst" for slot_name in used_slots],
-        "actions": [(do_slots_to_fst, [used_slots])],
-    }
+    # slots -> FST (one task per slot, so editing one slot file only rebuilds
+    # that slot and the intents that use it)
+    for slot_name in used_slots:
+        yield {
+            "name": f"${slot_name}_fst",
+            "file_dep": [slots_dir / slot_name],
+            "targets": [fsts_dir / f"${slot_name}.fst"],
+            "actions": [(do_slots_to_fst, [{slot_name}])],
+        }
 
 
 # -----------------------------------------------------------------------------
 
 
-def do_intent_fst(intents: Iterable[str], targets):
-    intent_fsts = {
-        intent: fst.Fst.read(str(fsts_dir / f"{intent}.fst")) for intent in intents
+def do_intent_manifest(targets):
+    write_intent_manifest(
+        targets[0],
+        {intent: fsts_dir / f"{intent}.fst" for intent in sorted(intents)},
+        {f"${slot}": fsts_dir / f"${slot}.fst" for slot in sorted(used_slots)},
+    )
+
+
+@create_after(executed="grammar_fsts")
+def task_intent_manifest():
+    """Writes content hashes of intent/slot FSTs to intent_manifest.json."""
+    return {
+        "file_dep": [fsts_dir / f"{intent}.fst" for intent in intents]
+        + [fsts_dir / f"${slot}.fst" for slot in used_slots],
+        "targets": [intent_manifest],
+        "actions": [do_intent_manifest],
     }
-    intent_fst = make_intent_fst(intent_fsts)
+
+
+# -----------------------------------------------------------------------------
+
+
+def do_intent_fst(targets):
+    intent_fst = load_intent_manifest(intent_manifest)
+
+    if optimize_intent_fst:
+        # Remove epsilons, determinize, minimize
+        before_size = fst_size(intent_fst)
+        start_time = time.time()
+        intent_fst = optimize_fst(intent_fst)
+        after_size = fst_size(intent_fst)
+
+        report = {
+            "before": before_size,
+            "after": after_size,
+            "optimize_seconds": time.time() - start_time,
+        }
+
+        logger.info(f"Optimized intent FST: {report}")
+        with open(targets[1], "w") as report_file:
+            json.dump(report, report_file, indent=4)
+
     intent_fst.write(targets[0])
 
 
-@create_after(executed="grammars")
+@create_after(executed="intent_manifest")
 def task_intent_fst():
-    """Merges grammar FSTs into single intent.fst."""
+    """Assembles intent FSTs from manifest into intent.fst (optionally optimized)."""
+    targets = [intent_fst]
+    if optimize_intent_fst:
+        targets.append(intent_fst_report)
+
+    return {
+        "file_dep": [intent_manifest],
+        "targets": targets,
+        "actions": [do_intent_fst],
+        "uptodate": [config_changed({"optimize": optimize_intent_fst})],
+    }
+
+
+# -----------------------------------------------------------------------------
+
+
+def do_intent_artifact(targets):
+    write_intent_artifact(fst.Fst.read(str(intent_fst)), targets[0])
+
+
+@create_after(executed="intent_fst")
+def task_intent_artifact():
+    """Writes memory-mappable recognizer artifact from intent.fst."""
     return {
-        "file_dep": [fsts_dir / f"{intent}.fst" for intent in intents],
-        "targets": [intent_fst],
-        "actions": [(do_intent_fst, [intents])],
+        "file_dep": [intent_fst],
+        "targets": [intent_artifact],
+        "actions": [do_intent_artifact],
     }
 
 
 # -----------------------------------------------------------------------------
 
 
+def do_intent_counts(targets):
+    # Counted from the manifest instead of intent.fst, so only a changed
+    # intent/slot FST cascades into the language model and Kaldi graph.
+    with tempfile.NamedTemporaryFile(suffix=".fst") as fst_file:
+        load_intent_manifest(intent_manifest).write(fst_file.name)
+        subprocess.check_call(["ngramcount", fst_file.name, targets[0]])
+
+
+@create_after(executed="intent_manifest")
 def task_language_model():
-    """Creates an ARPA language model from intent.fst."""
+    """Creates an ARPA language model from the intent FSTs in the manifest."""
 
     if base_language_model_weight is not None:
         yield {
@@ -288,9 +373,9 @@ def task_language_model():
     intent_counts = str(intent_fst) + ".counts"
     yield {
         "name": "intent_counts",
-        "file_dep": [intent_fst],
+        "file_dep": [intent_manifest],
         "targets": [intent_counts],
-        "actions": ["ngramcount %(dependencies)s %(targets)s"],
+        "actions": [do_intent_counts],
     }
 
     # n-gram counts -> model
@@ -331,16 +416,14 @@ def task_language_model():
 
 def do_vocab(targets):
     with open(targets[0], "w") as vocab_file:
-        input_symbols = fst.Fst.read(str(intent_fst)).input_symbols()
-        for i in range(input_symbols.num_symbols()):
-            symbol = input_symbols.find(i).decode().strip()
-            if not (symbol.startswith("__") or symbol.startswith("<")):
-                print(symbol, file=vocab_file)
+        for word in sorted(manifest_vocab(intent_manifest)):
+            print(word, file=vocab_file)
 
 
+@create_after(executed="intent_manifest")
 def task_vocab():
-    """Writes all vocabulary words to a file from intent.fst."""
-    return {"file_dep": [intent_fst], "targets": [vocab], "actions": [do_vocab]}
+    """Writes all vocabulary words to a file from the intent FSTs in the manifest."""
+    return {"file_dep": [intent_manifest], "targets": [vocab], "actions": [do_vocab]}
 
 
 # -----------------------------------------------------------------------------
@@ -351,6 +434,7 @@ def do_dict(dictionary_paths: Iterable[Path], targets):
         make_dict(vocab, dictionary_paths, dictionary_file, unknown_path=unknown_words)
 
 
+@create_after(executed="vocab")
 def task_vocab_dict():
     """Creates custom pronunciation dictionary based on desired vocabulary."""
     dictionary_paths = [base_dictionary]
@@ -397,6 +481,7 @@ def task_vocab_g2p():
 # -----------------------------------------------------------------------------
 
 
+@create_after(executed="vocab_dict")
 def task_kaldi_train():
     """Creates HCLG.fst for a Kaldi nnet3 or gmm model."""
     if kaldi_model_type is not None:
@@ -439,7 +524,49 @@ def _get_intents(ini_path):
 
 # -----------------------------------------------------------------------------
 
-DOIT_CONFIG = {"action_string_formatting": "old"}
+
+class TimingReporter(ConsoleReporter):
+    """Console reporter that prints how long each executed task took."""
+
+    def __init__(self, outstream, options):
+        super().__init__(outstream, options)
+        self.run_start = time.time()
+        self.task_starts: Dict[str, float] = {}
+        self.task_seconds: Dict[str, float] = {}
+
+    def execute_task(self, task):
+        super().execute_task(task)
+        self.task_starts[task.name] = time.time()
+
+    def add_success(self, task):
+        super().add_success(task)
+        self._stop_timer(task)
+
+    def add_failure(self, task, exception):
+        super().add_failure(task, exception)
+        self._stop_timer(task)
+
+    def _stop_timer(self, task):
+        start_time = self.task_starts.pop(task.name, None)
+        if (start_time is not None) and task.actions:
+            self.task_seconds[task.name] = time.time() - start_time
+
+    def complete_run(self):
+        super().complete_run()
+
+        if len(self.task_seconds) > 0:
+            self.write("\n")
+            for task_name, seconds in sorted(
+                self.task_seconds.items(), key=lambda kv: kv[1], reverse=True
+            ):
+                self.write(f"{seconds:8.3f}s  {task_name}\n")
+
+            self.write(f"{time.time() - self.run_start:8.3f}s  (total)\n")
+
+
+# -----------------------------------------------------------------------------
+
+DOIT_CONFIG = {"action_string_formatting": "old", "reporter": TimingReporter}
 
 if __name__ == "__main__":
     # Monkey patch inspect to make doit work inside Pyinstaller.
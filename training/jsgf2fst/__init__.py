@@ -3,6 +3,8 @@ from .jsgf2fst import (
     grammar_to_fsts,
     slots_to_fsts,
     make_intent_fst,
+    optimize_fst,
+    fst_size,
     symbols2intent,
     fstaccept,
     fstprintall,
@@ -10,4 +12,11 @@ from .jsgf2fst import (
     filter_words,
     apply_fst,
     longest_path,
+    fst_to_arrays,
+    write_intent_artifact,
+    IntentArtifact,
+    write_intent_manifest,
+    read_intent_manifest,
+    load_intent_manifest,
+    manifest_vocab,
 )
@@ -35,12 +35,29 @@ from .fstaccept import (
     apply_fst,
 )
 
+from .artifact import (
+    fst_to_arrays,
+    write_intent_artifact,
+    IntentArtifact,
+    ARTIFACT_VERSION,
+)
+
+from .manifest import (
+    write_intent_manifest,
+    read_intent_manifest,
+    load_intent_manifest,
+    manifest_vocab,
+)
+
 logger = logging.getLogger("jsgf2fst")
 
 # -----------------------------------------------------------------------------
 
 JSGF_RESERVED = re.compile(r"[;=,*+()<>{}\[]]")
 
+# Slot values with any of these characters are run through the JSGF parser
+SLOT_JSGF_SYNTAX = re.compile(r"[;=,*+()<>{}\[\]|/$\"#\\]")
+
 # -----------------------------------------------------------------------------
 
 
@@ -162,8 +179,8 @@ def slots_to_fsts(
         slot_start = slot_fst.add_state()
         slot_fst.set_start(slot_start)
 
-        slot_end = slot_fst.add_state()
-        slot_fst.set_final(slot_end)
+        # Final state for values that go through the parser
+        slot_end: Optional[int] = None
 
         input_symbols = fst.SymbolTable()
         in_eps = input_symbols.add_symbol(eps)
@@ -173,6 +190,10 @@ def slots_to_fsts(
 
         replacements: Dict[str, fst.Fst] = {}
 
+        # Plain text values share prefixes in a tree rooted at slot_start.
+        # (state, input label, output label) -> next state
+        trie_arcs: Dict[Tuple[int, int, int], int] = {}
+
         with open(slot_path, "r") as slot_file:
             # Process each line independently to avoid recursion limit
             for line in slot_file:
@@ -180,6 +201,33 @@ def slots_to_fsts(
                 if len(line) == 0:
                     continue
 
+                if SLOT_JSGF_SYNTAX.search(line) is None:
+                    # Fast path (no parsing needed)
+                    last_state = slot_start
+                    for word in re.split(r"\s+", line):
+                        in_label, out_label = _slot_word_labels(
+                            word, input_symbols, output_symbols, eps
+                        )
+
+                        arc_key = (last_state, in_label, out_label)
+                        next_state = trie_arcs.get(arc_key)
+                        if next_state is None:
+                            next_state = slot_fst.add_state()
+                            slot_fst.add_arc(
+                                last_state,
+                                fst.Arc(in_label, out_label, weight_one, next_state),
+                            )
+                            trie_arcs[arc_key] = next_state
+
+                        last_state = next_state
+
+                    slot_fst.set_final(last_state)
+                    continue
+
+                if slot_end is None:
+                    slot_end = slot_fst.add_state()
+                    slot_fst.set_final(slot_end)
+
                 replace_symbol = f"__replace__{len(replacements)}"
                 out_replace = output_symbols.add_symbol(replace_symbol)
 
@@ -205,16 +253,38 @@ def slots_to_fsts(
         slot_fst.set_output_symbols(output_symbols)
 
         # Replace slot values
-        slot_fsts["$" + slot_name] = _replace_fsts(slot_fst, replacements)
+        if len(replacements) > 0:
+            slot_fst = _replace_fsts(slot_fst, replacements)
+
+        slot_fsts["$" + slot_name] = slot_fst
 
     return slot_fsts
 
 
+def _slot_word_labels(
+    word: str,
+    input_symbols: fst.SymbolTable,
+    output_symbols: fst.SymbolTable,
+    eps: str = "<eps>",
+) -> Tuple[int, int]:
+    """Gets input/output labels for a plain slot word (same as JSGF literals)."""
+    if ":" in word:
+        # Substitution (entire word with ":" is output)
+        in_word = word.split(":", maxsplit=1)[0] or eps
+        return input_symbols.add_symbol(in_word), output_symbols.add_symbol(word)
+
+    return input_symbols.add_symbol(word), output_symbols.add_symbol(word)
+
+
 # -----------------------------------------------------------------------------
 
 
 def make_intent_fst(grammar_fsts: Dict[str, fst.Fst], eps: str = "<eps>") -> fst.Fst:
-    """Merges grammar FSTs created with grammar_to_fsts into a single acceptor FST."""
+    """Merges grammar FSTs created with grammar_to_fsts into a single acceptor FST.
+
+    Grammar FSTs are relabeled onto shared symbol tables and spliced in with
+    fst.replace, so each one is copied once.
+    """
     input_symbols = fst.SymbolTable()
     output_symbols = fst.SymbolTable()
 
@@ -258,13 +328,79 @@ def make_intent_fst(grammar_fsts: Dict[str, fst.Fst], eps: str = "<eps>") -> fst
 
         replacements[out_replace] = grammar_fst
 
+    # Shared symbol tables
+    for grammar_fst in replacements.values():
+        _add_symbols(input_symbols, grammar_fst.input_symbols())
+        _add_symbols(output_symbols, grammar_fst.output_symbols())
+
+    pairs: List[Tuple[int, fst.Fst]] = []
+    for out_replace, grammar_fst in replacements.items():
+        grammar_fst = grammar_fst.copy()
+        grammar_fst.relabel_tables(
+            old_isymbols=grammar_fst.input_symbols(),
+            new_isymbols=input_symbols,
+            old_osymbols=grammar_fst.output_symbols(),
+            new_osymbols=output_symbols,
+        )
+        grammar_fst.set_input_symbols(input_symbols)
+        grammar_fst.set_output_symbols(output_symbols)
+        pairs.append((out_replace, grammar_fst))
+
     # Fix symbol tables
     intent_fst.set_input_symbols(input_symbols)
     intent_fst.set_output_symbols(output_symbols)
 
-    # Do replacements
+    # Do replacements (root label is unused by any arc)
+    root_label = output_symbols.available_key()
 
-    return _replace_fsts(intent_fst, replacements, eps=eps)
+    return fst.replace([(root_label, intent_fst)] + pairs, epsilon_on_replace=True)
+
+
+def _add_symbols(symbols: fst.SymbolTable, other_symbols: fst.SymbolTable):
+    for i in range(other_symbols.num_symbols()):
+        symbols.add_symbol(other_symbols.find(other_symbols.get_nth_key(i)))
+
+
+# -----------------------------------------------------------------------------
+
+
+def optimize_fst(the_fst: fst.Fst) -> fst.Fst:
+    """Removes epsilon bridges, then determinizes and minimizes an (acyclic) FST.
+
+    Input/output label pairs are encoded as single labels first, so
+    __label__/__begin__/__end__ outputs stay on the same paths and
+    ambiguous sentences (same words, different intents) are preserved.
+    Only <eps>:<eps> arcs are removed. Returns a new FST.
+    """
+    input_symbols = the_fst.input_symbols().copy()
+    output_symbols = the_fst.output_symbols().copy()
+
+    opt_fst = the_fst.copy()
+    opt_fst.rmepsilon()
+
+    mapper = fst.EncodeMapper(opt_fst.arc_type(), encode_labels=True)
+    opt_fst.encode(mapper)
+    opt_fst = fst.determinize(opt_fst)
+    opt_fst.minimize()
+    opt_fst.decode(mapper)
+    opt_fst.topsort()
+
+    # Encoding doesn't preserve symbol tables
+    opt_fst.set_input_symbols(input_symbols)
+    opt_fst.set_output_symbols(output_symbols)
+
+    return opt_fst
+
+
+def fst_size(the_fst: fst.Fst) -> Dict[str, int]:
+    """Counts states and arcs in an FST."""
+    num_states = 0
+    num_arcs = 0
+    for state in the_fst.states():
+        num_states += 1
+        num_arcs += the_fst.num_arcs(state)
+
+    return {"states": num_states, "arcs": num_arcs}
 
 
 # -----------------------------------------------------------------------------
@@ -304,6 +440,9 @@ def _replace_fsts(
     in_eps = new_input_symbols.add_symbol(eps)
     out_eps = new_output_symbols.add_symbol(eps)
 
+    # id(replace FST) -> (old -> new input labels, old -> new output labels)
+    symbol_maps: Dict[int, Tuple[Dict[int, int], Dict[int, int]]] = {}
+
     # Copy states
     for outer_state in outer_fst.states():
         new_state = new_fst.add_state()
@@ -340,18 +479,33 @@ def _replace_fsts(
                             fst.Arc(in_eps, out_eps, weight_one, next_state),
                         )
 
+                # Symbols are only looked up once per replaced FST
+                input_map, output_map = symbol_maps.setdefault(
+                    id(replace_fst), ({}, {})
+                )
+
                 # Copy arcs
                 for replace_state in replace_fst.states():
                     for replace_arc in replace_fst.arcs(replace_state):
+                        ilabel = input_map.get(replace_arc.ilabel)
+                        if ilabel is None:
+                            ilabel = new_input_symbols.add_symbol(
+                                replace_input_symbols.find(replace_arc.ilabel)
+                            )
+                            input_map[replace_arc.ilabel] = ilabel
+
+                        olabel = output_map.get(replace_arc.olabel)
+                        if olabel is None:
+                            olabel = new_output_symbols.add_symbol(
+                                replace_output_symbols.find(replace_arc.olabel)
+                            )
+                            output_map[replace_arc.olabel] = olabel
+
                         new_fst.add_arc(
                             state_map[(r, replace_state)],
                             fst.Arc(
-                                new_input_symbols.add_symbol(
-                                    replace_input_symbols.find(replace_arc.ilabel)
-                                ),
-                                new_output_symbols.add_symbol(
-                                    replace_output_symbols.find(replace_arc.olabel)
-                                ),
+                                ilabel,
+                                olabel,
                                 weight_one,
                                 state_map[(r, replace_arc.nextstate)],
                             ),
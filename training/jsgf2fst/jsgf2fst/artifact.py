@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+import json
+import mmap
+import struct
+import logging
+from collections import deque
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Dict, List, Set, Tuple, Union, Any
+
+import numpy as np
+import pywrapfst as fst
+
+logger = logging.getLogger("jsgf2fst")
+
+# -----------------------------------------------------------------------------
+
+# Single-file, memory-mappable intent recognizer artifact.
+#
+# Layout:
+#   magic (8 bytes)
+#   version (uint32, little endian)
+#   header size (uint32, little endian)
+#   header (JSON: section name -> offset/dtype/count, start state, eps)
+#   sections (raw little endian arrays, each aligned to ARTIFACT_ALIGN bytes)
+#
+# Symbol tables and the token vocabulary are each stored as two sections:
+# <name>_offsets (int32, one more than the number of symbols) and <name>_blob
+# (concatenated UTF-8). Symbol i is blob[offsets[i]:offsets[i + 1]].
+#
+# The slot_states section has an (intent label, __begin__ label, state) row
+# for the first state of each slot (tag) sub-graph.
+
+ARTIFACT_MAGIC = b"RHSPYINT"
+ARTIFACT_VERSION = 2
+ARTIFACT_ALIGN = 64
+
+_PREAMBLE = struct.Struct("<8sII")
+
+# -----------------------------------------------------------------------------
+
+
+def fst_to_arrays(
+    the_fst: fst.Fst,
+) -> Tuple[Dict[str, np.ndarray], List[str], List[str]]:
+    """Converts a finite state transducer to CSR arc arrays and symbol lists.
+
+    The arcs leaving state s are at indexes arc_offsets[s] up to
+    arc_offsets[s + 1]. Labels are indexes into the returned symbol lists.
+    """
+    zero_weight = fst.Weight.Zero(the_fst.weight_type())
+
+    # Symbol keys are re-numbered so they can index a list
+    in_symbols, in_map = _symbol_list(the_fst.input_symbols())
+    out_symbols, out_map = _symbol_list(the_fst.output_symbols())
+
+    num_states = the_fst.num_states()
+    num_arcs = sum(the_fst.num_arcs(state) for state in the_fst.states())
+
+    arc_offsets = np.zeros(num_states + 1, dtype=np.int32)
+    arc_ilabels = np.zeros(num_arcs, dtype=np.int32)
+    arc_olabels = np.zeros(num_arcs, dtype=np.int32)
+    arc_nextstates = np.zeros(num_arcs, dtype=np.int32)
+    final = np.zeros(num_states, dtype=np.bool_)
+
+    arc_idx = 0
+    for state in the_fst.states():
+        arc_offsets[state] = arc_idx
+        final[state] = the_fst.final(state) != zero_weight
+
+        for arc in the_fst.arcs(state):
+            arc_ilabels[arc_idx] = in_map[arc.ilabel]
+            arc_olabels[arc_idx] = out_map[arc.olabel]
+            arc_nextstates[arc_idx] = arc.nextstate
+            arc_idx += 1
+
+    arc_offsets[num_states] = arc_idx
+
+    arrays = {
+        "arc_offsets": arc_offsets,
+        "arc_ilabels": arc_ilabels,
+        "arc_olabels": arc_olabels,
+        "arc_nextstates": arc_nextstates,
+        "final": final,
+    }
+
+    return arrays, in_symbols, out_symbols
+
+
+def _symbol_list(symbols: fst.SymbolTable) -> Tuple[List[str], Dict[int, int]]:
+    """Creates a list of symbols and a mapping from symbol key to list index."""
+    symbol_list: List[str] = []
+    key_map: Dict[int, int] = {}
+    for i in range(symbols.num_symbols()):
+        key = symbols.get_nth_key(i)
+        key_map[key] = len(symbol_list)
+        symbol_list.append(symbols.find(key).decode())
+
+    return symbol_list, key_map
+
+
+# -----------------------------------------------------------------------------
+
+
+def find_slot_states(
+    arrays: Dict[str, np.ndarray], start: int, out_symbols: List[str]
+) -> np.ndarray:
+    """Finds the first state of each slot (tag) sub-graph for each intent.
+
+    Returns an (N, 3) array of (intent label, __begin__ label, state) rows.
+    Like flair's make_slot_fsts, only the first instance of a slot is kept.
+    """
+    arc_offsets = arrays["arc_offsets"]
+    arc_olabels = arrays["arc_olabels"]
+    arc_nextstates = arrays["arc_nextstates"]
+
+    rows: List[Tuple[int, int, int]] = []
+    for arc_idx in range(arc_offsets[start], arc_offsets[start + 1]):
+        intent_label = int(arc_olabels[arc_idx])
+        if not out_symbols[intent_label].startswith("__label__"):
+            continue
+
+        seen_slots = set()
+        visited = set()
+        state_stack = [int(arc_nextstates[arc_idx])]
+        while len(state_stack) > 0:
+            state = state_stack.pop()
+            if state in visited:
+                continue
+
+            visited.add(state)
+            for slot_arc in range(arc_offsets[state], arc_offsets[state + 1]):
+                out_label = int(arc_olabels[slot_arc])
+                next_state = int(arc_nextstates[slot_arc])
+                if out_symbols[out_label].startswith("__begin__") and (
+                    out_label not in seen_slots
+                ):
+                    seen_slots.add(out_label)
+                    rows.append((intent_label, out_label, next_state))
+
+                state_stack.append(next_state)
+
+    return np.array(rows, dtype=np.int32).reshape((len(rows), 3))
+
+
+def make_slot_acceptor_arrays(
+    arrays: Dict[str, np.ndarray],
+    start: int,
+    in_symbols: Sequence,
+    out_symbols: Sequence,
+    eps: str = "<eps>",
+) -> fst.Fst:
+    """Creates the fstrtext slot acceptor from CSR arc arrays.
+
+    See fstaccept.make_slot_acceptor.
+    """
+    arc_offsets = arrays["arc_offsets"]
+    arc_ilabels = arrays["arc_ilabels"]
+    arc_olabels = arrays["arc_olabels"]
+    arc_nextstates = arrays["arc_nextstates"]
+
+    in_eps = in_symbols.index(eps) if eps in in_symbols else -1
+    out_eps = out_symbols.index(eps) if eps in out_symbols else -1
+    slot_fst = fst.Fst()
+
+    # Combined symbol table
+    all_symbols = fst.SymbolTable()
+    meta_keys = set()
+
+    for symbols in [in_symbols, out_symbols]:
+        for sym in symbols:
+            all_key = all_symbols.add_symbol(sym)
+            if sym.startswith("__"):
+                meta_keys.add(all_key)
+
+    # Symbol list index -> combined key
+    in_keys = [all_symbols.find(sym) for sym in in_symbols]
+    out_keys = [all_symbols.find(sym) for sym in out_symbols]
+
+    weight_one = fst.Weight.One(slot_fst.weight_type())
+
+    # States that will be set to final
+    final_states: Set[int] = set()
+
+    # States that already have all-word loops
+    loop_states: Set[int] = set()
+
+    all_eps = all_symbols.find(eps)
+    loop_keys = [all_symbols.get_nth_key(i) for i in range(all_symbols.num_symbols())]
+    loop_keys = [k for k in loop_keys if (k != all_eps) and (k not in meta_keys)]
+
+    # Add self transitions to a state for all input words (besides <eps>)
+    def add_loop_state(state):
+        for all_key in loop_keys:
+            slot_fst.add_arc(state, fst.Arc(all_key, all_key, weight_one, state))
+
+    slot_fst.set_start(slot_fst.add_state())
+
+    # Queue of (intent state, acceptor state, copy count)
+    state_queue = deque()
+    state_queue.append((start, slot_fst.start(), 0))
+
+    # BFS
+    while len(state_queue) > 0:
+        intent_state, slot_state, do_copy = state_queue.popleft()
+        final_states.add(slot_state)
+        for arc_idx in range(arc_offsets[intent_state], arc_offsets[intent_state + 1]):
+            ilabel = int(arc_ilabels[arc_idx])
+            olabel = int(arc_olabels[arc_idx])
+            out_symbol = out_symbols[olabel]
+            all_key = out_keys[olabel]
+
+            if out_symbol.startswith("__label__"):
+                # Create corresponding __label__ arc
+                next_state = slot_fst.add_state()
+                slot_fst.add_arc(
+                    slot_state, fst.Arc(all_key, all_key, weight_one, next_state)
+                )
+
+                # Must create a loop here for intents with no slots
+                add_loop_state(next_state)
+                loop_states.add(slot_state)
+            else:
+                # Non-label arc
+                if out_symbol.startswith("__begin__"):
+                    # States/arcs will be copied until __end__ is reached
+                    do_copy += 1
+
+                    # Add loop transitions to soak up non-tag words
+                    if not slot_state in loop_states:
+                        add_loop_state(slot_state)
+                        loop_states.add(slot_state)
+
+                if (do_copy > 0) and ((ilabel != in_eps) or (olabel != out_eps)):
+                    # Copy state/arc
+                    next_state = slot_fst.add_state()
+                    slot_fst.add_arc(
+                        slot_state,
+                        fst.Arc(in_keys[ilabel], all_key, weight_one, next_state),
+                    )
+                    final_states.discard(slot_state)
+                else:
+                    next_state = slot_state
+
+                if out_symbol.startswith("__end__"):
+                    # Stop copying after this state until next __begin__
+                    do_copy -= 1
+
+            state_queue.append((int(arc_nextstates[arc_idx]), next_state, do_copy))
+
+    # Mark all dangling states as final (excluding start)
+    for state in final_states:
+        if state != slot_fst.start():
+            slot_fst.set_final(state)
+
+    slot_fst.set_input_symbols(all_symbols)
+    slot_fst.set_output_symbols(all_symbols)
+
+    return slot_fst
+
+
+# -----------------------------------------------------------------------------
+
+
+def write_intent_artifact(
+    intent_fst: fst.Fst, artifact_path: Union[str, Path], eps: str = "<eps>"
+):
+    """Writes a memory-mappable recognizer artifact for an intent FST."""
+    arrays, in_symbols, out_symbols = fst_to_arrays(intent_fst)
+    start = intent_fst.start()
+
+    # Words that can be recognized (no meta/epsilon symbols)
+    vocab = [s for s in in_symbols if not (s.startswith("__") or s.startswith("<"))]
+
+    sections: Dict[str, np.ndarray] = dict(arrays)
+    sections["final"] = arrays["final"].astype(np.uint8)
+    sections["slot_states"] = find_slot_states(arrays, start, out_symbols)
+
+    for name, symbols in [
+        ("in_symbols", in_symbols),
+        ("out_symbols", out_symbols),
+        ("vocab", vocab),
+    ]:
+        offsets, blob = _encode_symbols(symbols)
+        sections[f"{name}_offsets"] = offsets
+        sections[f"{name}_blob"] = blob
+
+    # Lay out sections after the header
+    header: Dict[str, Any] = {"start": start, "eps": eps, "sections": {}}
+    offset = 0
+    for name, array in sections.items():
+        array = np.ascontiguousarray(array)
+        sections[name] = array
+        header["sections"][name] = {
+            "offset": offset,
+            "dtype": array.dtype.newbyteorder("<").str,
+            "shape": list(array.shape),
+        }
+        offset = _align(offset + array.nbytes)
+
+    header_bytes = json.dumps(header).encode()
+    data_start = _align(_PREAMBLE.size + len(header_bytes))
+
+    with open(artifact_path, "wb") as artifact_file:
+        artifact_file.write(
+            _PREAMBLE.pack(ARTIFACT_MAGIC, ARTIFACT_VERSION, len(header_bytes))
+        )
+        artifact_file.write(header_bytes)
+
+        for name, array in sections.items():
+            artifact_file.seek(data_start + header["sections"][name]["offset"])
+            artifact_file.write(
+                array.astype(header["sections"][name]["dtype"]).tobytes()
+            )
+
+        artifact_file.truncate(data_start + offset)
+
+    logger.debug(
+        f"Wrote intent artifact to {artifact_path} ({len(in_symbols)} input symbol(s), {len(arrays['arc_ilabels'])} arc(s))"
+    )
+
+
+def _encode_symbols(symbols: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Encodes symbols as an offsets array and a UTF-8 blob."""
+    symbols_bytes = [s.encode() for s in symbols]
+    offsets = np.zeros(len(symbols_bytes) + 1, dtype=np.int32)
+    np.cumsum([len(b) for b in symbols_bytes], out=offsets[1:])
+    blob = np.frombuffer(b"".join(symbols_bytes), dtype=np.uint8)
+
+    return offsets, blob
+
+
+def _align(offset: int) -> int:
+    return ((offset + ARTIFACT_ALIGN - 1) // ARTIFACT_ALIGN) * ARTIFACT_ALIGN
+
+
+# -----------------------------------------------------------------------------
+
+
+class IntentArtifact:
+    """Read-only, memory-mapped view of a file from write_intent_artifact.
+
+    Arrays are backed directly by the mapped file, so processes that open
+    the same artifact share its pages.
+    """
+
+    def __init__(self, artifact_path: Union[str, Path]):
+        self.path = Path(artifact_path)
+
+        with open(self.path, "rb") as artifact_file:
+            self._mmap = mmap.mmap(artifact_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, header_size = _PREAMBLE.unpack_from(self._mmap, 0)
+        if magic != ARTIFACT_MAGIC:
+            raise ValueError(f"Not an intent artifact: {self.path}")
+
+        if version != ARTIFACT_VERSION:
+            raise ValueError(
+                f"Unsupported intent artifact version {version} (expected {ARTIFACT_VERSION}): {self.path}"
+            )
+
+        header_end = _PREAMBLE.size + header_size
+        header = json.loads(self._mmap[_PREAMBLE.size : header_end].decode())
+        data_start = _align(header_end)
+
+        self.start: int = header["start"]
+        self.eps: str = header["eps"]
+
+        # name -> zero-copy array
+        self.sections: Dict[str, np.ndarray] = {}
+        for name, info in header["sections"].items():
+            dtype = np.dtype(info["dtype"])
+            count = int(np.prod(info["shape"], dtype=np.int64))
+            self.sections[name] = np.frombuffer(
+                self._mmap,
+                dtype=dtype,
+                count=count,
+                offset=data_start + info["offset"],
+            ).reshape(info["shape"])
+
+        self.in_symbols = self._symbols("in_symbols")
+        self.out_symbols = self._symbols("out_symbols")
+        self.vocab = self._symbols("vocab")
+
+    @property
+    def arc_offsets(self) -> np.ndarray:
+        return self.sections["arc_offsets"]
+
+    @property
+    def arc_ilabels(self) -> np.ndarray:
+        return self.sections["arc_ilabels"]
+
+    @property
+    def arc_olabels(self) -> np.ndarray:
+        return self.sections["arc_olabels"]
+
+    @property
+    def arc_nextstates(self) -> np.ndarray:
+        return self.sections["arc_nextstates"]
+
+    @property
+    def final(self) -> np.ndarray:
+        return self.sections["final"]
+
+    def slot_states(self) -> Dict[str, Dict[str, int]]:
+        """Returns intent name -> slot name -> first state of slot sub-graph."""
+        intent_slots: Dict[str, Dict[str, int]] = {}
+        for intent_label, begin_label, state in self.sections["slot_states"].tolist():
+            intent_name = self.out_symbols[intent_label][9:]
+            slot_name = self.out_symbols[begin_label][9:]
+            intent_slots.setdefault(intent_name, {})[slot_name] = state
+
+        return intent_slots
+
+    def slot_fsts(self) -> Dict[str, Dict[str, fst.Fst]]:
+        """Returns intent name -> slot name -> FST for the slot sub-graph.
+
+        Arcs are copied from the first state of the slot until its __end__
+        arc. FSTs are not minimized.
+        """
+        input_symbols = _symbol_table(self.in_symbols)
+        output_symbols = _symbol_table(self.out_symbols)
+
+        intent_slots: Dict[str, Dict[str, fst.Fst]] = {}
+        for intent_name, slot_states in self.slot_states().items():
+            slot_to_fst = intent_slots.setdefault(intent_name, {})
+            for slot_name, slot_state in slot_states.items():
+                slot_fst = self._slot_fst(slot_state, f"__end__{slot_name}")
+                slot_fst.set_input_symbols(input_symbols)
+                slot_fst.set_output_symbols(output_symbols)
+                slot_to_fst[slot_name] = slot_fst
+
+        return intent_slots
+
+    def slot_acceptor(self) -> fst.Fst:
+        """Creates the fstrtext slot acceptor (see make_slot_acceptor)."""
+        return make_slot_acceptor_arrays(
+            self.sections, self.start, self.in_symbols, self.out_symbols, self.eps
+        )
+
+    def _slot_fst(self, slot_state: int, end_label: str) -> fst.Fst:
+        slot_fst = fst.Fst()
+        one_weight = fst.Weight.One(slot_fst.weight_type())
+        end_olabel = self.out_symbols.index(end_label)
+
+        state_map = {slot_state: slot_fst.add_state()}
+        slot_fst.set_start(state_map[slot_state])
+        state_stack = [slot_state]
+
+        # Copy states/arcs until __end__ is found
+        while len(state_stack) > 0:
+            state = state_stack.pop()
+            for arc_idx in range(self.arc_offsets[state], self.arc_offsets[state + 1]):
+                olabel = int(self.arc_olabels[arc_idx])
+                if olabel == end_olabel:
+                    # Mark previous state as final
+                    slot_fst.set_final(state_map[state])
+                    continue
+
+                next_state = int(self.arc_nextstates[arc_idx])
+                if next_state not in state_map:
+                    state_map[next_state] = slot_fst.add_state()
+                    state_stack.append(next_state)
+
+                slot_fst.add_arc(
+                    state_map[state],
+                    fst.Arc(
+                        int(self.arc_ilabels[arc_idx]),
+                        olabel,
+                        one_weight,
+                        state_map[next_state],
+                    ),
+                )
+
+        return slot_fst
+
+    def _symbols(self, name: str) -> "SymbolList":
+        return SymbolList(
+            self.sections[f"{name}_offsets"], self.sections[f"{name}_blob"]
+        )
+
+
+class SymbolList(Sequence):
+    """Read-only list of symbols backed by an offsets array and a UTF-8 blob.
+
+    Symbols are decoded when they're accessed.
+    """
+
+    def __init__(self, offsets: np.ndarray, blob: np.ndarray):
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+
+        if not (0 <= index < len(self)):
+            raise IndexError(index)
+
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return self._blob[start:end].tobytes().decode()
+
+
+def _symbol_table(symbols: Sequence) -> fst.SymbolTable:
+    """Creates a symbol table whose keys are list indexes."""
+    symbol_table = fst.SymbolTable()
+    for key, symbol in enumerate(symbols):
+        symbol_table.add_symbol(symbol, key)
+
+    return symbol_table
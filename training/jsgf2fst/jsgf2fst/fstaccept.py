@@ -10,6 +10,8 @@ from collections import deque
 
 import pywrapfst as fst
 
+from .artifact import fst_to_arrays, make_slot_acceptor_arrays
+
 logger = logging.getLogger("fstaccept")
 
 
@@ -309,110 +311,10 @@ def filter_words(words: Iterable[str], the_fst: fst.Fst) -> List[str]:
 
 
 def make_slot_acceptor(intent_fst: fst.Fst, eps: str = "<eps>") -> fst.Fst:
-    in_eps = intent_fst.input_symbols().find(eps)
-    out_eps = intent_fst.output_symbols().find(eps)
-    slot_fst = fst.Fst()
-
-    # Copy symbol tables
-    all_symbols = fst.SymbolTable()
-    meta_keys = set()
-
-    for table in [intent_fst.input_symbols(), intent_fst.output_symbols()]:
-        for i in range(table.num_symbols()):
-            key = table.get_nth_key(i)
-            sym = table.find(key).decode()
-            all_key = all_symbols.add_symbol(sym)
-            if sym.startswith("__"):
-                meta_keys.add(all_key)
-
-    weight_one = fst.Weight.One(slot_fst.weight_type())
-    weight_zero = fst.Weight.Zero(slot_fst.weight_type())
-
-    # States that will be set to final
-    final_states: Set[int] = set()
-
-    # States that already have all-word loops
-    loop_states: Set[int] = set()
-
-    all_eps = all_symbols.find(eps)
-
-    # Add self transitions to a state for all input words (besides <eps>)
-    def add_loop_state(state):
-        for sym_idx in range(all_symbols.num_symbols()):
-            all_key = all_symbols.get_nth_key(sym_idx)
-            if (all_key != all_eps) and (all_key not in meta_keys):
-                slot_fst.add_arc(state, fst.Arc(all_key, all_key, weight_one, state))
-
-    slot_fst.set_start(slot_fst.add_state())
-
-    # Queue of (intent state, acceptor state, copy count)
-    state_queue = deque()
-    state_queue.append((intent_fst.start(), slot_fst.start(), 0))
-
-    # BFS
-    while len(state_queue) > 0:
-        intent_state, slot_state, do_copy = state_queue.popleft()
-        final_states.add(slot_state)
-        for intent_arc in intent_fst.arcs(intent_state):
-            out_symbol = intent_fst.output_symbols().find(intent_arc.olabel).decode()
-            all_key = all_symbols.find(out_symbol)
-
-            if out_symbol.startswith("__label__"):
-                # Create corresponding __label__ arc
-                next_state = slot_fst.add_state()
-                slot_fst.add_arc(
-                    slot_state, fst.Arc(all_key, all_key, weight_one, next_state)
-                )
-
-                # Must create a loop here for intents with no slots
-                add_loop_state(next_state)
-                loop_states.add(slot_state)
-            else:
-                # Non-label arc
-                if out_symbol.startswith("__begin__"):
-                    # States/arcs will be copied until __end__ is reached
-                    do_copy += 1
-
-                    # Add loop transitions to soak up non-tag words
-                    if not slot_state in loop_states:
-                        add_loop_state(slot_state)
-                        loop_states.add(slot_state)
-
-                if (do_copy > 0) and (
-                    (intent_arc.ilabel != in_eps) or (intent_arc.olabel != out_eps)
-                ):
-                    # Copy state/arc
-                    in_symbol = (
-                        intent_fst.input_symbols().find(intent_arc.ilabel).decode()
-                    )
-                    next_state = slot_fst.add_state()
-                    slot_fst.add_arc(
-                        slot_state,
-                        fst.Arc(
-                            all_symbols.find(in_symbol), all_key, weight_one, next_state
-                        ),
-                    )
-                    final_states.discard(slot_state)
-                else:
-                    next_state = slot_state
-
-                if out_symbol.startswith("__end__"):
-                    # Stop copying after this state until next __begin__
-                    do_copy -= 1
-
-            next_info = (intent_arc.nextstate, next_state, do_copy)
-            state_queue.append(next_info)
-
-    # Mark all dangling states as final (excluding start)
-    for state in final_states:
-        if state != slot_fst.start():
-            slot_fst.set_final(state)
-
-    # Fix symbol tables
-    slot_fst.set_input_symbols(all_symbols)
-    slot_fst.set_output_symbols(all_symbols)
-
-    return slot_fst
+    arrays, in_symbols, out_symbols = fst_to_arrays(intent_fst)
+    return make_slot_acceptor_arrays(
+        arrays, intent_fst.start(), in_symbols, out_symbols, eps
+    )
 
 
 # -----------------------------------------------------------------------------
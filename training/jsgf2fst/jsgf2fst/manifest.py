@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+import os
+import json
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, Set, Union, Any
+
+import pywrapfst as fst
+
+logger = logging.getLogger("jsgf2fst")
+
+# -----------------------------------------------------------------------------
+
+# Intent manifest: the per-intent and per-slot FSTs written during training,
+# with a content hash for each one.
+#
+# {
+#   "intents": { "<intent>": { "fst": "<path>", "sha256": "<hex>" }, ... },
+#   "slots": { "$<slot>": { "fst": "<path>", "sha256": "<hex>" }, ... }
+# }
+#
+# Paths are relative to the manifest's directory. Keys are sorted, so the
+# manifest only changes when an intent or slot FST does.
+
+# -----------------------------------------------------------------------------
+
+
+def write_intent_manifest(
+    manifest_path: Union[str, Path],
+    intent_fst_paths: Dict[str, Path],
+    slot_fst_paths: Dict[str, Path] = {},
+):
+    """Writes a manifest with the content hash of each intent/slot FST."""
+    manifest_dir = Path(manifest_path).parent
+
+    def entries(fst_paths: Dict[str, Path]) -> Dict[str, Dict[str, str]]:
+        return {
+            name: {
+                "fst": os.path.relpath(fst_path, manifest_dir),
+                "sha256": file_sha256(fst_path),
+            }
+            for name, fst_path in fst_paths.items()
+        }
+
+    manifest = {"intents": entries(intent_fst_paths), "slots": entries(slot_fst_paths)}
+
+    with open(manifest_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4, sort_keys=True)
+
+    logger.debug(
+        f"Wrote manifest for {len(intent_fst_paths)} intent(s) and {len(slot_fst_paths)} slot(s) to {manifest_path}"
+    )
+
+
+def read_intent_manifest(manifest_path: Union[str, Path]) -> Dict[str, Path]:
+    """Returns intent name -> path of intent FST, sorted by intent name."""
+    manifest_dir = Path(manifest_path).parent
+    with open(manifest_path, "r") as manifest_file:
+        manifest: Dict[str, Any] = json.load(manifest_file)
+
+    return {
+        intent: manifest_dir / entry["fst"]
+        for intent, entry in sorted(manifest["intents"].items())
+    }
+
+
+def load_intent_manifest(
+    manifest_path: Union[str, Path], eps: str = "<eps>"
+) -> fst.Fst:
+    """Assembles the intent FSTs in a manifest into a single intent FST."""
+    from . import make_intent_fst
+
+    intent_fsts = {
+        intent: fst.Fst.read(str(fst_path))
+        for intent, fst_path in read_intent_manifest(manifest_path).items()
+    }
+
+    return make_intent_fst(intent_fsts, eps=eps)
+
+
+def manifest_vocab(manifest_path: Union[str, Path]) -> Set[str]:
+    """Returns the words (no meta/epsilon symbols) of every intent FST."""
+    vocab: Set[str] = set()
+    for fst_path in read_intent_manifest(manifest_path).values():
+        input_symbols = fst.Fst.read(str(fst_path)).input_symbols()
+        for i in range(input_symbols.num_symbols()):
+            key = input_symbols.get_nth_key(i)
+            symbol = input_symbols.find(key).decode().strip()
+            if not (symbol.startswith("__") or symbol.startswith("<")):
+                vocab.add(symbol)
+
+    return vocab
+
+
+def file_sha256(file_path: Union[str, Path]) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as hash_file:
+        for block in iter(lambda: hash_file.read(65536), b""):
+            sha256.update(block)
+
+    return sha256.hexdigest()
@@ -1,10 +1,13 @@
 import io
+import json
 from glob import glob
 import unittest
 import logging
 import tempfile
 from pathlib import Path
 
+import pywrapfst as fst
+
 logging.basicConfig(level=logging.DEBUG)
 
 from jsgf2fst import (
@@ -14,8 +17,65 @@ from jsgf2fst import (
     make_intent_fst,
     fstprintall,
     fstaccept,
+    make_slot_acceptor,
+    optimize_fst,
+    fst_size,
+    write_intent_artifact,
+    IntentArtifact,
+    write_intent_manifest,
+    load_intent_manifest,
+    manifest_vocab,
+    SLOT_JSGF_SYNTAX,
 )
 
+# Plain values share prefixes and substitutions, JSGF values go through the parser
+room_values = [
+    "living room",
+    "living room lamp",
+    "kitchen light",
+    "tv:television",
+    "den:",
+    "garage [door]",
+    "(bedroom | guest room) light",
+    "porch:front_porch light",
+]
+
+
+def fst_paths(the_fst, eps="<eps>"):
+    """Every (input words, output words) path through an acyclic FST.
+
+    Unlike fstprintall, paths that meet at a shared state are all kept.
+    """
+    input_symbols = the_fst.input_symbols()
+    output_symbols = the_fst.output_symbols()
+    zero_weight = fst.Weight.Zero(the_fst.weight_type())
+
+    paths = set()
+    state_stack = [(the_fst.start(), (), ())]
+    while len(state_stack) > 0:
+        state, in_words, out_words = state_stack.pop()
+        if the_fst.final(state) != zero_weight:
+            paths.add((in_words, out_words))
+
+        for arc in the_fst.arcs(state):
+            next_in_words, next_out_words = in_words, out_words
+            in_word = input_symbols.find(arc.ilabel).decode()
+            if in_word != eps:
+                next_in_words = next_in_words + (in_word,)
+
+            out_word = output_symbols.find(arc.olabel).decode()
+            if out_word != eps:
+                next_out_words = next_out_words + (out_word,)
+
+            state_stack.append((arc.nextstate, next_in_words, next_out_words))
+
+    return paths
+
+
+def write_slots(slots_dir, slot_name, values):
+    slots_dir.mkdir(parents=True, exist_ok=True)
+    (slots_dir / slot_name).write_text("\n".join(values) + "\n")
+
 
 class Jsgf2FstTestCase(unittest.TestCase):
     def setUp(self):
@@ -112,6 +172,88 @@ class Jsgf2FstTestCase(unittest.TestCase):
         self.assertEqual(ev["entity"], "color")
         self.assertEqual(ev["value"], "orange")
 
+    def test_slot_trie_same_as_parser(self):
+        # Values with JSGF syntax take the parser path
+        self.assertIsNotNone(SLOT_JSGF_SYNTAX.search("garage [door]"))
+        self.assertIsNone(SLOT_JSGF_SYNTAX.search("porch:front_porch light"))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # Same values, all forced through the parser
+            write_slots(Path(temp_dir) / "trie", "rooms", room_values)
+            write_slots(
+                Path(temp_dir) / "parser", "rooms", [f"({v})" for v in room_values]
+            )
+
+            trie_fst = slots_to_fsts(Path(temp_dir) / "trie")["$rooms"]
+            parser_fst = slots_to_fsts(Path(temp_dir) / "parser")["$rooms"]
+
+            self.assertEqual(fst_paths(trie_fst), fst_paths(parser_fst))
+            self.assertIn((("tv",), ("tv:television",)), fst_paths(trie_fst))
+            self.assertIn(
+                (("guest", "room", "light"), ("guest", "room", "light")),
+                fst_paths(trie_fst),
+            )
+
+            # Plain values only (a tree, so fstprintall sees every value)
+            plain_values = [v for v in room_values if not SLOT_JSGF_SYNTAX.search(v)]
+            write_slots(Path(temp_dir) / "plain", "rooms", plain_values)
+            plain_fst = slots_to_fsts(Path(temp_dir) / "plain")["$rooms"]
+
+            self.assertEqual(
+                sorted(fstprintall(plain_fst)),
+                sorted(list(out_words) for _, out_words in fst_paths(plain_fst)),
+            )
+
+            self.assertEqual(
+                sorted(" ".join(out_words) for out_words in fstprintall(plain_fst)),
+                sorted(
+                    [
+                        "living room",
+                        "living room lamp",
+                        "kitchen light",
+                        "tv:television",
+                        "den:",
+                        "porch:front_porch light",
+                    ]
+                ),
+            )
+
+    def test_slot_trie_optimize(self):
+        grammar = """#JSGF V1.0 UTF-8 en;
+grammar TurnOn;
+
+public <TurnOn> = turn on [the] ($rooms){room};
+"""
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            write_slots(Path(temp_dir) / "trie", "rooms", room_values)
+            write_slots(
+                Path(temp_dir) / "parser", "rooms", [f"({v})" for v in room_values]
+            )
+
+            intent_paths = []
+            for slots_name in ["trie", "parser"]:
+                slot_fsts = slots_to_fsts(Path(temp_dir) / slots_name)
+                turn_on = grammar_to_fsts(grammar, replace_fsts=slot_fsts)
+                intent_fst = make_intent_fst({"TurnOn": turn_on.grammar_fst})
+
+                # Optimizing doesn't change what's accepted or output
+                paths = fst_paths(intent_fst)
+                self.assertEqual(fst_paths(optimize_fst(intent_fst)), paths)
+                intent_paths.append(paths)
+
+            self.assertEqual(intent_paths[0], intent_paths[1])
+
+            # 2 optional words * 10 room values
+            self.assertEqual(len(intent_paths[0]), 20)
+
+            # Substitution and tag survive
+            intent = fstaccept(
+                optimize_fst(intent_fst), "turn on the tv", intent_name="TurnOn"
+            )[0]
+            self.assertEqual(intent["entities"][0]["entity"], "room")
+            self.assertEqual(intent["entities"][0]["value"], "television")
+
     # -------------------------------------------------------------------------
 
     def test_printall(self):
@@ -280,6 +422,155 @@ class Jsgf2FstTestCase(unittest.TestCase):
             self.assertEqual(ev["entity"], "color")
             self.assertEqual(ev["value"], "purple")
 
+    # -------------------------------------------------------------------------
+
+    def test_optimize(self):
+        slot_fsts = slots_to_fsts(Path("test/slots"))
+        change_light_color = grammar_to_fsts(
+            Path("test/ChangeLightColor.gram").read_text(), replace_fsts=slot_fsts
+        )
+
+        replace_fsts = {**slot_fsts, **change_light_color.fsts}
+        change_light = grammar_to_fsts(
+            Path("test/ChangeLight.gram").read_text(), replace_fsts=replace_fsts
+        )
+
+        intent_fst = make_intent_fst(
+            {
+                "ChangeLightColor": change_light_color.grammar_fst,
+                "ChangeLight": change_light.grammar_fst,
+            }
+        )
+
+        opt_fst = optimize_fst(intent_fst)
+
+        # Epsilon bridges are gone
+        before_size, after_size = fst_size(intent_fst), fst_size(opt_fst)
+        self.assertLess(after_size["states"], before_size["states"])
+        self.assertLess(after_size["arcs"], before_size["arcs"])
+
+        # Same paths, so both interpretations are still available
+        opt_paths = fst_paths(opt_fst)
+        self.assertEqual(opt_paths, fst_paths(intent_fst))
+
+        purple_outputs = [
+            out_words
+            for _, out_words in opt_paths
+            if [w for w in out_words if not w.startswith("__")]
+            == ["set", "color", "to", "purple"]
+        ]
+
+        self.assertEqual(
+            sorted(out_words[0] for out_words in purple_outputs),
+            ["__label__ChangeLight", "__label__ChangeLightColor"],
+        )
+
+        for out_words in purple_outputs:
+            self.assertEqual(
+                out_words[-3:], ("__begin__color", "purple", "__end__color")
+            )
+
+    # -------------------------------------------------------------------------
+
+    def test_intent_artifact(self):
+        set_timer = grammar_to_fsts(Path("test/SetTimer.gram").read_text())
+        intent_fst = make_intent_fst({"SetTimer": set_timer.grammar_fst})
+
+        with tempfile.NamedTemporaryFile(suffix=".bin") as artifact_file:
+            write_intent_artifact(intent_fst, artifact_file.name)
+            artifact = IntentArtifact(artifact_file.name)
+
+            # Same shape as intent FST
+            self.assertEqual(artifact.start, intent_fst.start())
+            self.assertEqual(len(artifact.final), intent_fst.num_states())
+            self.assertEqual(
+                len(artifact.arc_ilabels),
+                sum(intent_fst.num_arcs(s) for s in intent_fst.states()),
+            )
+
+            # Only real words in vocabulary
+            self.assertIn("timer", artifact.vocab)
+            self.assertNotIn("<eps>", artifact.vocab)
+
+            # Symbols are decoded from offsets + blob
+            self.assertEqual(
+                list(artifact.in_symbols),
+                [
+                    intent_fst.input_symbols().find(k).decode()
+                    for k in range(intent_fst.input_symbols().num_symbols())
+                ],
+            )
+            self.assertEqual(artifact.out_symbols[-1], artifact.out_symbols[:][-1])
+
+            # First state of each slot
+            slot_states = artifact.slot_states()
+            self.assertEqual(set(slot_states["SetTimer"]), {"minutes", "seconds"})
+
+            # Slot FSTs accept the same values as the slot in the intent FST
+            slot_fsts = artifact.slot_fsts()
+            self.assertEqual(set(slot_fsts["SetTimer"]), {"minutes", "seconds"})
+            self.assertIn(
+                (("ten",), ("ten:10",)), fst_paths(slot_fsts["SetTimer"]["minutes"])
+            )
+
+            # Same slot acceptor as from the intent FST
+            slot_acceptor = artifact.slot_acceptor()
+            expected_acceptor = make_slot_acceptor(intent_fst)
+            self.assertEqual(
+                slot_acceptor.write_to_string(), expected_acceptor.write_to_string()
+            )
+
+            # Reject files that aren't artifacts
+            artifact_file.seek(0)
+            artifact_file.write(b"not an artifact")
+            artifact_file.flush()
+
+            with self.assertRaises(ValueError):
+                IntentArtifact(artifact_file.name)
+
+    def test_intent_manifest(self):
+        grammar_fsts = {
+            name: grammar_to_fsts(Path(f"test/{name}.gram").read_text()).grammar_fst
+            for name in ["SetTimer", "GetGarageState"]
+        }
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            intent_fst_paths = {}
+            for name, grammar_fst in grammar_fsts.items():
+                intent_fst_paths[name] = Path(temp_dir) / "fsts" / f"{name}.fst"
+                intent_fst_paths[name].parent.mkdir(exist_ok=True)
+                grammar_fst.write(str(intent_fst_paths[name]))
+
+            manifest_path = Path(temp_dir) / "intent_manifest.json"
+            write_intent_manifest(manifest_path, intent_fst_paths)
+            manifest_text = manifest_path.read_text()
+
+            # Same as merging the grammar FSTs directly
+            intent_fst = load_intent_manifest(manifest_path)
+            expected_fst = make_intent_fst(grammar_fsts)
+            self.assertEqual(fst_paths(intent_fst), fst_paths(expected_fst))
+
+            # Only words in vocabulary
+            vocab = manifest_vocab(manifest_path)
+            self.assertIn("timer", vocab)
+            self.assertIn("garage", vocab)
+            self.assertNotIn("<eps>", vocab)
+
+            # Re-writing the same FSTs (in any order) doesn't change the manifest
+            write_intent_manifest(
+                manifest_path, dict(reversed(list(intent_fst_paths.items())))
+            )
+            self.assertEqual(manifest_path.read_text(), manifest_text)
+
+            # Changing one FST only changes its hash
+            hashes = json.loads(manifest_text)["intents"]
+            grammar_fsts["GetGarageState"].write(str(intent_fst_paths["SetTimer"]))
+            write_intent_manifest(manifest_path, intent_fst_paths)
+            new_hashes = json.loads(manifest_path.read_text())["intents"]
+
+            self.assertNotEqual(new_hashes["SetTimer"], hashes["SetTimer"])
+            self.assertEqual(new_hashes["GetGarageState"], hashes["GetGarageState"])
+
 
 # -----------------------------------------------------------------------------
 
@@ -7,7 +7,12 @@ import os
 import sys
 import argparse
 
-from voice_command.webrtcvad.webrtcvad_rhasspy import wait_for_command
+from audio_hub import AudioReader
+from voice_command.webrtcvad.webrtcvad_rhasspy import (
+    wait_for_command,
+    wait_for_commands,
+    bind_udp_stream,
+)
 
 # -------------------------------------------------------------------------------------------------
 
@@ -19,6 +24,21 @@ def main():
         help="File to raw audio data from (16-bit 16Khz mono PCM)",
         default=None,
     )
+    parser.add_argument(
+        "--audio-hub",
+        help="Read audio from a shared ring buffer (see audio_hub) instead of stdin",
+    )
+    parser.add_argument(
+        "--udp-stream",
+        action="append",
+        help="Receive audio for a stream on a UDP port ([NAME=][HOST:]PORT, may be repeated)",
+        default=[],
+    )
+    parser.add_argument(
+        "--udp-host",
+        help="Default host for UDP audio streams (default=0.0.0.0)",
+        default="0.0.0.0",
+    )
     parser.add_argument(
         "--events-in-file",
         help="File to read events from (one per line, topic followed by JSON)",
@@ -29,12 +49,29 @@ def main():
         help="File to write events to (one per line, topic followed by JSON)",
         default=None,
     )
+    parser.add_argument(
+        "--events-socket",
+        help="Unix socket to send/receive events on (instead of events files)",
+    )
+    parser.add_argument(
+        "--mqtt-host",
+        help="MQTT broker to send/receive events through (instead of events files)",
+    )
+    parser.add_argument(
+        "--mqtt-port", type=int, default=1883, help="MQTT broker port (default=1883)"
+    )
     parser.add_argument(
         "--chunk-size",
         help="Number of bytes to process at a time (default=960)",
         type=int,
         default=960,
     )
+    parser.add_argument(
+        "--block-chunks",
+        help="Number of chunks to read from audio file at a time (default=32)",
+        type=int,
+        default=32,
+    )
     parser.add_argument(
         "--vad-mode",
         help="Sensitivity (1-3, 3 is most sensitive, default=1)",
@@ -65,6 +102,12 @@ def main():
         type=float,
         default=0.5,
     )
+    parser.add_argument(
+        "--preroll-seconds",
+        help="Seconds of audio from before listening starts to include in voice command (default=0)",
+        type=float,
+        default=0,
+    )
     parser.add_argument(
         "--debug", action="store_true", help="Print DEBUG messages to standard out"
     )
@@ -78,8 +121,10 @@ def main():
 
     # -------------------------------------------------------------------------
 
-    if args.audio_file:
-        audio_file = open(audio_file, "r")
+    if args.audio_hub:
+        audio_file = AudioReader.attach(args.audio_hub)
+    elif args.audio_file:
+        audio_file = open(args.audio_file, "rb")
     else:
         audio_file = sys.stdin.buffer
 
@@ -95,16 +140,52 @@ def main():
 
     # -------------------------------------------------------------------------
 
+    if args.udp_stream:
+        # Many audio streams in one process
+        if not (events_in_file or args.events_socket or args.mqtt_host):
+            logger.fatal(
+                "--events-in-file, --events-socket, or --mqtt-host is required with --udp-stream"
+            )
+            sys.exit(1)
+
+        streams = dict(
+            bind_udp_stream(stream_arg, host=args.udp_host)
+            for stream_arg in args.udp_stream
+        )
+
+        wait_for_commands(
+            streams,
+            events_in_file=events_in_file,
+            events_out_file=events_out_file,
+            vad_mode=args.vad_mode,
+            chunk_size=args.chunk_size,
+            min_seconds=args.min_seconds,
+            max_seconds=args.max_seconds,
+            speech_seconds=args.speech_seconds,
+            silence_seconds=args.silence_seconds,
+            preroll_seconds=args.preroll_seconds,
+            events_socket=args.events_socket,
+            mqtt_host=args.mqtt_host,
+            mqtt_port=args.mqtt_port,
+        )
+
+        return
+
     wait_for_command(
         audio_file=audio_file,
         events_in_file=events_in_file,
         events_out_file=events_out_file,
         vad_mode=args.vad_mode,
         chunk_size=args.chunk_size,
+        block_chunks=args.block_chunks,
         min_seconds=args.min_seconds,
         max_seconds=args.max_seconds,
         speech_seconds=args.speech_seconds,
         silence_seconds=args.silence_seconds,
+        preroll_seconds=args.preroll_seconds,
+        events_socket=args.events_socket,
+        mqtt_host=args.mqtt_host,
+        mqtt_port=args.mqtt_port,
     )
 
 
@@ -13,7 +13,7 @@ setuptools.setup(
     url="https://github.com/synesthesiam/rhasspy-services",
     packages=setuptools.find_packages(),
     package_data={"webrtcvad_rhasspy": ["py.typed"]},
-    install_requires=["jsonlines", "pyyaml", "pydash", "webrtcvad"],
+    install_requires=["jsonlines", "pyyaml", "pydash", "paho-mqtt", "webrtcvad"],
     classifiers=["Programming Language :: Python :: 3"],
     long_description=long_description,
     long_description_content_type="text/markdown",
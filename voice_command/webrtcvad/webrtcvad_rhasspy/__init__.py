@@ -6,14 +6,31 @@ logger = logging.getLogger("webrtcvad_rhasspy")
 import sys
 import argparse
 import math
-import threading
-import time
-from queue import Queue
-from typing import List, BinaryIO, TextIO, Optional
+import socket
+import asyncio
+import functools
+import itertools
+from collections import deque
+from typing import (
+    List,
+    BinaryIO,
+    TextIO,
+    Optional,
+    Iterator,
+    Iterable,
+    Tuple,
+    Dict,
+    Any,
+    Deque,
+    Union,
+)
 
-import jsonlines
 import webrtcvad
 
+import event_bus
+from event_bus import EventBus, EventWriter, make_transport, maybe_object
+from audio_hub import AudioReader, read_chunks
+
 # -------------------------------------------------------------------------------------------------
 # MQTT Events
 # -------------------------------------------------------------------------------------------------
@@ -37,7 +54,7 @@ EVENT_RECEIVING_AUDIO = EVENT_PREFIX + "receiving-audio"
 
 
 def wait_for_command(
-    audio_file: BinaryIO,
+    audio_file: Union[BinaryIO, AudioReader],
     events_out_file: TextIO,
     events_in_file: Optional[TextIO] = None,
     vad_mode=3,
@@ -47,15 +64,12 @@ def wait_for_command(
     max_seconds=30,
     speech_seconds=0.3,
     silence_seconds=0.5,
+    block_chunks=32,
+    preroll_seconds=0,
+    events_socket: Optional[str] = None,
+    mqtt_host: Optional[str] = None,
+    mqtt_port: int = 1883,
 ):
-    def send_event(topic, payload_dict={}):
-        print(topic, end=" ", file=events_out_file)
-
-        with jsonlines.Writer(events_out_file) as out:
-            out.write(payload_dict)
-
-        events_out_file.flush()
-
     # Verify settings
     sample_rate = 16000
     assert vad_mode in range(1, 4), f"VAD mode must be 1-3 (got {vad_mode})"
@@ -70,162 +84,526 @@ def wait_for_command(
     vad = webrtcvad.Vad()
     vad.set_mode(vad_mode)
 
-    audio_chunks = Queue()
-    report_audio = False
-    request_id = ""
+    # Audio is read in large blocks and split into zero-copy frames
+    block_size = chunk_size * block_chunks
+
+    # Recent frames to process when listening starts (16-bit samples)
+    preroll_chunks = int(math.ceil((preroll_seconds * sample_rate * 2) / chunk_size))
+
+    if events_in_file or events_socket or mqtt_host:
+        # Audio and events are handled on the same event loop
+        bus = EventBus(
+            make_transport(
+                events_in_file,
+                events_out_file,
+                events_socket=events_socket,
+                mqtt_host=mqtt_host,
+                mqtt_port=mqtt_port,
+            ),
+            error_topic=EVENT_ERROR,
+        )
+
+        # (request id, start event) for start-listening events that are
+        # waiting for the current voice command to finish.
+        start_requests: "Deque[Tuple[str, Dict[str, Any]]]" = deque()
+
+        # Frames kept (without running VAD) until listening starts
+        preroll: "Deque[memoryview]" = deque(maxlen=preroll_chunks)
+
+        # Current voice command (None when not listening)
+        recorder: Optional[VoiceCommandRecorder] = None
+        request_id = ""
+        start_event: Dict[str, Any] = {}
+        report_audio = False
+
+        # True when there are no more events
+        events_done = False
+
+        def process_frames(frames: Iterable[memoryview]):
+            """Runs frames through voice commands, starting them in order."""
+            nonlocal recorder, request_id, start_event, report_audio
+            pending = deque(frames)
+            while True:
+                if recorder is None:
+                    if len(start_requests) == 0:
+                        # Keep pre-roll audio only
+                        preroll.extend(pending)
+                        break
+
+                    # Start next voice command with pre-roll audio
+                    request_id, start_event = start_requests.popleft()
+                    recorder = VoiceCommandRecorder(
+                        sample_rate=sample_rate,
+                        chunk_size=chunk_size,
+                        min_seconds=min_seconds,
+                        max_seconds=max_seconds,
+                        speech_seconds=speech_seconds,
+                        silence_seconds=silence_seconds,
+                    )
+                    report_audio = True
+                    logger.debug(f"Started listening (request_id={request_id})")
 
-    # Pre-compute values
-    seconds_per_buffer = chunk_size / sample_rate
-    speech_buffers = int(math.ceil(speech_seconds / seconds_per_buffer))
+                    pending.extendleft(reversed(preroll))
+                    preroll.clear()
 
-    # Processes one voice command
-    def process_audio(request_id=""):
-        nonlocal audio_chunks
+                if len(pending) == 0:
+                    break
 
-        # State
-        max_buffers = int(math.ceil(max_seconds / seconds_per_buffer))
-        min_phrase_buffers = int(math.ceil(min_seconds / seconds_per_buffer))
+                frame = pending.popleft()
+                for topic, payload in recorder.process(
+                    vad.is_speech(frame, sample_rate)
+                ):
+                    bus.send(topic + request_id, payload)
+
+                if recorder.finished:
+                    bus.send(EVENT_STARTED + request_id, start_event)
+                    recorder = None
+
+        async def read_audio():
+            nonlocal recorder, report_audio
+            leftover = b""
+            try:
+                async for block, _ in read_chunks(audio_file, block_size):
+                    if len(leftover) > 0:
+                        block = leftover + block
+
+                    num_frames = len(block) // chunk_size
+                    if (num_frames > 0) and report_audio and (recorder is not None):
+                        logger.debug("Receiving audio")
+                        bus.send(EVENT_RECEIVING_AUDIO + request_id)
+                        report_audio = False
+
+                    block_view = memoryview(block)
+                    process_frames(
+                        block_view[i * chunk_size : (i + 1) * chunk_size]
+                        for i in range(num_frames)
+                    )
+
+                    leftover = block[num_frames * chunk_size :]
+
+                    if events_done and (recorder is None):
+                        # Pending voice commands are finished
+                        break
+                else:
+                    # End of audio
+                    if recorder is not None:
+                        bus.send(EVENT_STARTED + request_id, start_event)
+                        recorder = None
+            except Exception as e:
+                logger.exception("read_audio")
+
+        def handle_start(request_id: str, event: str):
+            logger.debug(f"Start listening requested (request_id={request_id})")
+            start_requests.append((request_id, maybe_object(event)))
+
+            # Start now if not listening, using pre-roll audio
+            process_frames([])
+
+        bus.on(EVENT_START, handle_start)
 
-        speech_buffers_left = speech_buffers
-        is_speech = False
-        last_speech = False
-        in_phrase = False
-        after_phrase = False
-        buffer_count = 0
+        async def handle_events():
+            nonlocal events_done
+            audio_task = asyncio.ensure_future(read_audio())
+            await bus.run()
 
-        finished = False
-        timeout = False
+            # Finish pending voice commands
+            events_done = True
+            if recorder is None:
+                audio_task.cancel()
 
-        current_seconds = 0
+            await asyncio.wait([audio_task])
+            bus.flush()
 
+        event_bus.run(handle_events())
+    else:
+        events_out = EventWriter(events_out_file)
+
+        # Single reader: audio is read in large blocks and split into zero-copy frames
+        frames = read_frames(audio_file, chunk_size, block_size=block_size)
+        command_frames: Iterator[memoryview] = frames
+
+        # Process voice commands until audio runs out
         while True:
-            chunk = audio_chunks.get()
-            buffer_count += 1
-            current_seconds += seconds_per_buffer
-
-            # Check maximum number of seconds to record
-            max_buffers -= 1
-            if max_buffers <= 0:
-                # Timeout
-                logger.warn("Timeout")
-                send_event(
-                    EVENT_COMMAND_TIMEOUT + request_id, {"seconds": current_seconds}
-                )
+            for topic, payload in command_events(
+                detect_speech(command_frames, vad, sample_rate),
+                sample_rate=sample_rate,
+                chunk_size=chunk_size,
+                min_seconds=min_seconds,
+                max_seconds=max_seconds,
+                speech_seconds=speech_seconds,
+                silence_seconds=silence_seconds,
+            ):
+                events_out.send(topic, payload)
+
+            # Stop if audio is exhausted
+            next_frame = next(frames, None)
+            if next_frame is None:
                 break
 
-            # Detect speech in chunk
-            is_speech = vad.is_speech(chunk, sample_rate)
-            if is_speech and not last_speech:
-                # Silence -> speech
-                send_event(EVENT_SPEECH + request_id, {"seconds": current_seconds})
-            elif not is_speech and last_speech:
-                # Speech -> silence
-                send_event(EVENT_SILENCE + request_id, {"seconds": current_seconds})
-
-            last_speech = is_speech
-
-            # Handle state changes
-            if is_speech and speech_buffers_left > 0:
-                speech_buffers_left -= 1
-            elif is_speech and not in_phrase:
-                # Start of phrase
-                logger.debug("Voice command started")
-                send_event(
-                    EVENT_COMMAND_STARTED + request_id, {"seconds": current_seconds}
-                )
+            # Start of next command
+            command_frames = itertools.chain([next_frame], frames)
 
-                in_phrase = True
-                after_phrase = False
-                min_phrase_buffers = int(math.ceil(min_seconds / seconds_per_buffer))
-            elif in_phrase and (min_phrase_buffers > 0):
-                # In phrase, before minimum seconds
-                min_phrase_buffers -= 1
-            elif not is_speech:
-                # Outside of speech
-                if not in_phrase:
-                    # Reset
-                    speech_buffers_left = speech_buffers
-                elif after_phrase and (silence_buffers > 0):
-                    # After phrase, before stop
-                    silence_buffers -= 1
-                elif after_phrase and (silence_buffers <= 0):
-                    # Phrase complete
-                    logger.debug("Voice command finished")
-                    send_event(
-                        EVENT_COMMAND_STOPPED + request_id, {"seconds": current_seconds}
-                    )
-                    break
-                elif in_phrase and (min_phrase_buffers <= 0):
-                    # Transition to after phrase
-                    after_phrase = True
-                    silence_buffers = int(
-                        math.ceil(silence_seconds / seconds_per_buffer)
-                    )
 
-    # -------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
 
-    def read_audio():
-        nonlocal audio_file, audio_chunks, report_audio, request_id
-        try:
-            while True:
-                chunk = audio_file.read(chunk_size)
-                if len(chunk) == chunk_size:
-                    if report_audio:
-                        logger.debug("Receiving audio")
-                        send_event(EVENT_RECEIVING_AUDIO + request_id)
-                        report_audio = False
 
-                    audio_chunks.put(chunk)
-                else:
-                    # Avoid 100% CPU usage
-                    time.sleep(0.01)
-        except Exception as e:
-            logger.exception("read_audio")
+class AudioStream:
+    """One audio source (UDP socket) with its own VAD and voice command state."""
 
-    threading.Thread(target=read_audio, daemon=True).start()
+    def __init__(self, stream_id: str, sock: socket.socket, vad_mode=3):
+        self.stream_id = stream_id
+        self.sock = sock
+        self.vad = webrtcvad.Vad()
+        self.vad.set_mode(vad_mode)
 
-    # -------------------------------------------------------------------------
+        # Audio that doesn't fill a whole chunk yet (or pre-roll audio when
+        # not listening)
+        self.pending = bytearray()
 
-    if events_in_file:
-        # Wait for start event
-        for line in events_in_file:
-            line = line.strip()
-            if len(line) == 0:
-                continue
+        # Current voice command (None when not listening)
+        self.request_id: Optional[str] = None
+        self.start_event: Dict[str, Any] = {}
+        self.recorder: Optional[VoiceCommandRecorder] = None
+        self.report_audio = False
 
-            logger.debug(line)
 
-            try:
-                # Expected <topic> <payload> on each line
-                topic, event = line.split(" ", maxsplit=1)
-                topic_parts = topic.split("/")
-                base_topic = "/".join(topic_parts[:3])
-
-                # Everything after base topic is request id
-                request_id = "/".join(topic_parts[3:])
-                if len(request_id) > 0:
-                    request_id = "/" + request_id
-
-                if base_topic == EVENT_START:
-                    # Clear audio queue
-                    with audio_chunks.mutex:
-                        audio_chunks.queue.clear()
-
-                    # Process voice command
-                    logger.debug(f"Started listening (request_id={request_id})")
-                    report_audio = True
-                    process_audio(request_id)
-                    send_event(EVENT_STARTED + request_id, maybe_object(event))
-            except Exception as e:
-                logger.exception(line)
-                send_event(EVENT_ERROR + request_id, {"error": str(e)})
+class StreamProtocol(asyncio.DatagramProtocol):
+    """Passes UDP audio packets for a stream to a callback."""
+
+    def __init__(self, stream: AudioStream, on_audio):
+        self.stream = stream
+        self.on_audio = on_audio
+
+    def datagram_received(self, data, addr):
+        self.on_audio(self.stream, data)
+
+    def error_received(self, exc):
+        logger.error(f"{self.stream.stream_id}: {exc}")
+
+
+def wait_for_commands(
+    streams: Dict[str, socket.socket],
+    events_in_file: Optional[TextIO],
+    events_out_file: TextIO,
+    vad_mode=3,
+    sample_rate=16000,
+    chunk_size=960,
+    min_seconds=2,
+    max_seconds=30,
+    speech_seconds=0.3,
+    silence_seconds=0.5,
+    preroll_seconds=0,
+    events_socket: Optional[str] = None,
+    mqtt_host: Optional[str] = None,
+    mqtt_port: int = 1883,
+):
+    """Detects voice commands in many independent audio streams at once.
+
+    Each start-listening event is matched to a stream by its "stream"
+    property or, if missing, its request id. Streams are only run through
+    the VAD while a voice command is being recorded. Up to preroll_seconds
+    of audio from before the start event is included in the command.
+    """
+    # Whole chunks of recent audio kept per stream (16-bit samples)
+    preroll_bytes = chunk_size * int(
+        math.ceil((preroll_seconds * sample_rate * 2) / chunk_size)
+    )
+
+    bus = EventBus(
+        make_transport(
+            events_in_file,
+            events_out_file,
+            events_socket=events_socket,
+            mqtt_host=mqtt_host,
+            mqtt_port=mqtt_port,
+        ),
+        error_topic=EVENT_ERROR,
+    )
+
+    audio_streams = {
+        stream_id: AudioStream(stream_id, sock, vad_mode=vad_mode)
+        for stream_id, sock in streams.items()
+    }
+
+    def process_audio(stream: AudioStream, data: bytes):
+        """Runs VAD on complete chunks for a listening stream."""
+        stream.pending += data
+        num_chunks = len(stream.pending) // chunk_size
+
+        with memoryview(stream.pending) as pending_view:
+            for i in range(num_chunks):
+                with pending_view[i * chunk_size : (i + 1) * chunk_size] as chunk:
+                    is_speech = stream.vad.is_speech(chunk, sample_rate)
+
+                for topic, payload in stream.recorder.process(is_speech):
+                    bus.send(topic + stream.request_id, payload)
+
+                if stream.recorder.finished:
+                    bus.send(EVENT_STARTED + stream.request_id, stream.start_event)
+                    stream.request_id = None
+                    stream.recorder = None
+                    break
+
+        if stream.recorder is None:
+            stream.pending.clear()
+        else:
+            del stream.pending[: num_chunks * chunk_size]
+
+    def on_audio(stream: AudioStream, data: bytes):
+        if stream.recorder is None:
+            # Not listening (keep pre-roll audio only)
+            if preroll_bytes > 0:
+                stream.pending += data
+                del stream.pending[:-preroll_bytes]
+
+            return
+
+        if stream.report_audio:
+            logger.debug(f"Receiving audio ({stream.stream_id})")
+            bus.send(EVENT_RECEIVING_AUDIO + stream.request_id)
+            stream.report_audio = False
+
+        process_audio(stream, data)
+
+    def handle_start(request_id: str, event: str):
+        event_dict = maybe_object(event)
+        stream_id = str(event_dict.get("stream", request_id[1:]))
+        stream = audio_streams.get(stream_id)
+        if stream is None:
+            raise ValueError(f"Unknown audio stream: {stream_id}")
+
+        if stream.recorder is not None:
+            logger.warning(
+                f"Replacing voice command on {stream_id} (request_id={stream.request_id})"
+            )
+
+        # Start new voice command
+        stream.request_id = request_id
+        stream.start_event = event_dict
+        stream.recorder = VoiceCommandRecorder(
+            sample_rate=sample_rate,
+            chunk_size=chunk_size,
+            min_seconds=min_seconds,
+            max_seconds=max_seconds,
+            speech_seconds=speech_seconds,
+            silence_seconds=silence_seconds,
+        )
+        # Keep whole chunks of pre-roll audio
+        del stream.pending[: len(stream.pending) % chunk_size]
+        stream.report_audio = True
+
+        logger.debug(f"Started listening on {stream_id} (request_id={request_id})")
+
+    bus.on(EVENT_START, handle_start)
+
+    async def handle_events():
+        # One datagram endpoint per stream
+        loop = asyncio.get_event_loop()
+        transports = []
+        for stream in audio_streams.values():
+            transport, _ = await loop.create_datagram_endpoint(
+                functools.partial(StreamProtocol, stream, on_audio), sock=stream.sock
+            )
+            transports.append(transport)
+
+        await bus.run()
+
+        for transport in transports:
+            transport.close()
+
+    event_bus.run(handle_events())
+
+
+def bind_udp_stream(
+    stream_arg: str, host: str = "0.0.0.0"
+) -> Tuple[str, socket.socket]:
+    """Binds a UDP socket for a [NAME=][HOST:]PORT stream argument."""
+    stream_id, address = None, stream_arg
+    if "=" in stream_arg:
+        stream_id, address = stream_arg.split("=", maxsplit=1)
+
+    if ":" in address:
+        host, port_str = address.rsplit(":", maxsplit=1)
     else:
-        # Process a voice command immediately
-        chunk = audio_file.read(chunk_size)
-        while len(chunk) == chunk_size:
-            audio_chunks.put(chunk)
-            process_audio()
-            chunk = audio_file.read(chunk_size)
+        port_str = address
+
+    port = int(port_str)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+
+    logger.debug(f"Listening for UDP audio on {host}:{port}")
+
+    return (stream_id or str(port), sock)
+
+
+# -----------------------------------------------------------------------------
+
+
+def read_frames(
+    audio_file: BinaryIO, chunk_size: int = 960, block_size: int = 960 * 32
+) -> Iterator[memoryview]:
+    """Reads audio in large blocks and yields fixed-size frames without copying."""
+    # read1 returns what's available (up to block_size) instead of waiting
+    # for the whole block, so live audio isn't delayed.
+    read = getattr(audio_file, "read1", audio_file.read)
+    leftover = b""
+
+    while True:
+        block = read(block_size)
+        if not block:
+            # End of audio
+            break
+
+        if len(leftover) > 0:
+            block = leftover + block
+
+        block_view = memoryview(block)
+        num_frames = len(block) // chunk_size
+        for i in range(num_frames):
+            yield block_view[i * chunk_size : (i + 1) * chunk_size]
+
+        leftover = block[num_frames * chunk_size :]
+
+
+def detect_speech(
+    frames: Iterable[memoryview], vad: webrtcvad.Vad, sample_rate: int = 16000
+) -> Iterator[Tuple[memoryview, bool]]:
+    """Runs voice activity detection on frames, yielding (frame, is_speech)."""
+    for frame in frames:
+        yield (frame, vad.is_speech(frame, sample_rate))
+
+
+def command_events(
+    frames: Iterator[Tuple[memoryview, bool]],
+    sample_rate=16000,
+    chunk_size=960,
+    min_seconds=2,
+    max_seconds=30,
+    speech_seconds=0.3,
+    silence_seconds=0.5,
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Consumes (frame, is_speech) pairs for one voice command, yielding (topic, payload) events.
+
+    Stops after the command finishes, times out, or frames run out. Frames
+    after the end of the command are left in the iterator.
+    """
+    recorder = VoiceCommandRecorder(
+        sample_rate=sample_rate,
+        chunk_size=chunk_size,
+        min_seconds=min_seconds,
+        max_seconds=max_seconds,
+        speech_seconds=speech_seconds,
+        silence_seconds=silence_seconds,
+    )
+
+    for _, is_speech in frames:
+        yield from recorder.process(is_speech)
+        if recorder.finished:
+            break
+
+
+class VoiceCommandRecorder:
+    """State machine for a single voice command.
+
+    Call process with the VAD result of each frame until finished is True.
+    """
+
+    def __init__(
+        self,
+        sample_rate=16000,
+        chunk_size=960,
+        min_seconds=2,
+        max_seconds=30,
+        speech_seconds=0.3,
+        silence_seconds=0.5,
+    ):
+        self.min_seconds = min_seconds
+        self.silence_seconds = silence_seconds
+
+        # Pre-compute values
+        self.seconds_per_buffer = chunk_size / sample_rate
+        self.speech_buffers = int(math.ceil(speech_seconds / self.seconds_per_buffer))
+
+        # State
+        self.max_buffers = int(math.ceil(max_seconds / self.seconds_per_buffer))
+        self.min_phrase_buffers = int(math.ceil(min_seconds / self.seconds_per_buffer))
+
+        self.speech_buffers_left = self.speech_buffers
+        self.last_speech = False
+        self.in_phrase = False
+        self.after_phrase = False
+        self.silence_buffers = 0
+
+        self.current_seconds = 0
+        self.finished = False
+
+    def process(self, is_speech: bool) -> List[Tuple[str, Dict[str, Any]]]:
+        """Advances by one frame, returning (topic, payload) events."""
+        events: List[Tuple[str, Dict[str, Any]]] = []
+        if self.finished:
+            return events
+
+        self.current_seconds += self.seconds_per_buffer
+
+        # Check maximum number of seconds to record
+        self.max_buffers -= 1
+        if self.max_buffers <= 0:
+            # Timeout
+            logger.warning("Timeout")
+            events.append((EVENT_COMMAND_TIMEOUT, {"seconds": self.current_seconds}))
+            self.finished = True
+            return events
+
+        # Detect speech in chunk
+        if is_speech and not self.last_speech:
+            # Silence -> speech
+            events.append((EVENT_SPEECH, {"seconds": self.current_seconds}))
+        elif not is_speech and self.last_speech:
+            # Speech -> silence
+            events.append((EVENT_SILENCE, {"seconds": self.current_seconds}))
+
+        self.last_speech = is_speech
+
+        # Handle state changes
+        if is_speech and self.speech_buffers_left > 0:
+            self.speech_buffers_left -= 1
+        elif is_speech and not self.in_phrase:
+            # Start of phrase
+            logger.debug("Voice command started")
+            events.append((EVENT_COMMAND_STARTED, {"seconds": self.current_seconds}))
+
+            self.in_phrase = True
+            self.after_phrase = False
+            self.min_phrase_buffers = int(
+                math.ceil(self.min_seconds / self.seconds_per_buffer)
+            )
+        elif self.in_phrase and (self.min_phrase_buffers > 0):
+            # In phrase, before minimum seconds
+            self.min_phrase_buffers -= 1
+        elif not is_speech:
+            # Outside of speech
+            if not self.in_phrase:
+                # Reset
+                self.speech_buffers_left = self.speech_buffers
+            elif self.after_phrase and (self.silence_buffers > 0):
+                # After phrase, before stop
+                self.silence_buffers -= 1
+            elif self.after_phrase and (self.silence_buffers <= 0):
+                # Phrase complete
+                logger.debug("Voice command finished")
+                events.append(
+                    (EVENT_COMMAND_STOPPED, {"seconds": self.current_seconds})
+                )
+                self.finished = True
+            elif self.in_phrase and (self.min_phrase_buffers <= 0):
+                # Transition to after phrase
+                self.after_phrase = True
+                self.silence_buffers = int(
+                    math.ceil(self.silence_seconds / self.seconds_per_buffer)
+                )
+
+        return events
 
 
 # -----------------------------------------------------------------------------
@@ -7,7 +7,12 @@ import os
 import sys
 import argparse
 
-from wake_word.porcupine.porcupine_rhasspy import wait_for_wake_word
+from audio_hub import AudioReader
+from wake_word.porcupine.porcupine_rhasspy import (
+    wait_for_wake_word,
+    serve_wake_word,
+    bind_udp_stream,
+)
 
 # -------------------------------------------------------------------------------------------------
 
@@ -19,6 +24,21 @@ def main():
         help="File to raw audio data from (16-bit 16Khz mono PCM)",
         default=None,
     )
+    parser.add_argument(
+        "--audio-hub",
+        help="Read audio from a shared ring buffer (see audio_hub) instead of stdin",
+    )
+    parser.add_argument(
+        "--udp-stream",
+        action="append",
+        default=[],
+        help="Receive audio for a stream on a UDP port ([NAME=][HOST:]PORT, may be repeated)",
+    )
+    parser.add_argument(
+        "--udp-host",
+        help="Default host for UDP audio streams (default=0.0.0.0)",
+        default="0.0.0.0",
+    )
     parser.add_argument(
         "--events-in-file",
         help="File to read events from (one per line, topic followed by JSON)",
@@ -29,6 +49,17 @@ def main():
         help="File to write events to (one per line, topic followed by JSON)",
         default=None,
     )
+    parser.add_argument(
+        "--events-socket",
+        help="Unix socket to send/receive events on (instead of events files)",
+    )
+    parser.add_argument(
+        "--mqtt-host",
+        help="MQTT broker to send/receive events through (instead of events files)",
+    )
+    parser.add_argument(
+        "--mqtt-port", type=int, default=1883, help="MQTT broker port (default=1883)"
+    )
     parser.add_argument(
         "--library", required=True, help="Path to porcupine shared library (.so)"
     )
@@ -52,6 +83,17 @@ def main():
     parser.add_argument(
         "--auto-start", action="store_true", help="Start listening immediately"
     )
+    parser.add_argument(
+        "--energy-gate",
+        action="store_true",
+        help="Only run porcupine when audio could contain speech (requires numpy)",
+    )
+    parser.add_argument(
+        "--energy-ratio",
+        type=float,
+        default=3.0,
+        help="Energy over noise floor that opens the gate (default=3.0)",
+    )
     parser.add_argument(
         "--debug", action="store_true", help="Print DEBUG messages to console"
     )
@@ -65,7 +107,9 @@ def main():
 
     # -------------------------------------------------------------------------
 
-    if args.audio_file:
+    if args.audio_hub:
+        audio_file = AudioReader.attach(args.audio_hub)
+    elif args.audio_file:
         audio_file = open(audio_file, "r")
     else:
         audio_file = sys.stdin.buffer
@@ -82,6 +126,37 @@ def main():
 
     # -------------------------------------------------------------------------
 
+    if args.udp_stream:
+        # Many audio streams in one process
+        if not (events_in_file or args.events_socket or args.mqtt_host):
+            logger.fatal(
+                "--events-in-file, --events-socket, or --mqtt-host is required with --udp-stream"
+            )
+            sys.exit(1)
+
+        streams = dict(
+            bind_udp_stream(stream_arg, host=args.udp_host)
+            for stream_arg in args.udp_stream
+        )
+
+        serve_wake_word(
+            streams,
+            events_in_file=events_in_file,
+            events_out_file=events_out_file,
+            library=args.library,
+            model=args.model,
+            keyword=args.keyword,
+            sensitivity=args.sensitivity,
+            auto_start=args.auto_start,
+            events_socket=args.events_socket,
+            mqtt_host=args.mqtt_host,
+            mqtt_port=args.mqtt_port,
+            energy_gate=args.energy_gate,
+            energy_ratio=args.energy_ratio,
+        )
+
+        return
+
     wait_for_wake_word(
         audio_file=audio_file,
         events_in_file=events_in_file,
@@ -91,6 +166,11 @@ def main():
         keyword=args.keyword,
         sensitivity=args.sensitivity,
         auto_start=args.auto_start,
+        events_socket=args.events_socket,
+        mqtt_host=args.mqtt_host,
+        mqtt_port=args.mqtt_port,
+        energy_gate=args.energy_gate,
+        energy_ratio=args.energy_ratio,
     )
 
 
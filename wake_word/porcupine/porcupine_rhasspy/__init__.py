@@ -5,12 +5,17 @@ logger = logging.getLogger("porcupine_rhasspy")
 
 import os
 import sys
-import jsonlines
 import time
+import socket
 import argparse
-import threading
-import struct
-from typing import List, BinaryIO, TextIO, Optional
+import asyncio
+import functools
+from typing import Any, Dict, List, Tuple, BinaryIO, TextIO, Optional, Union
+
+import event_bus
+from event_bus import EventBus, EventWriter, make_transport, maybe_object
+
+from audio_hub import AudioReader, read_chunks
 
 from .porcupine import Porcupine
 
@@ -37,7 +42,7 @@ EVENT_RELOADED = EVENT_PREFIX + "reloaded"
 
 
 def wait_for_wake_word(
-    audio_file: BinaryIO,
+    audio_file: Union[BinaryIO, AudioReader],
     events_out_file: TextIO,
     library: str,
     model: str,
@@ -45,16 +50,13 @@ def wait_for_wake_word(
     events_in_file: Optional[TextIO] = None,
     sensitivity: List[float] = [],
     auto_start: bool = False,
+    events_socket: Optional[str] = None,
+    mqtt_host: Optional[str] = None,
+    mqtt_port: int = 1883,
+    read_frames: int = 8,
+    energy_gate: bool = False,
+    energy_ratio: float = 3.0,
 ):
-    def send_event(topic, payload_dict={}, show_event=True):
-        if show_event:
-            print(topic, end=" ")
-
-        with jsonlines.Writer(events_out_file) as out:
-            out.write(payload_dict)
-
-        events_out_file.flush()
-
     # Ensure each keyword has a sensitivity value
     sensitivities = sensitivity
     while len(sensitivities) < len(keyword):
@@ -66,7 +68,9 @@ def wait_for_wake_word(
     )
 
     chunk_size = handle.frame_length * 2
-    chunk_format = "h" * handle.frame_length
+
+    # Audio is read up to this many frames at a time
+    read_size = chunk_size * max(1, read_frames)
 
     logger.debug(
         f"Loaded porcupine (keywords={keyword}, sensitivities={sensitivities})"
@@ -76,110 +80,512 @@ def wait_for_wake_word(
         f"Expecting sample rate={handle.sample_rate}, frame length={handle.frame_length}"
     )
 
-    request_id = ""
-    report_audio = False
+    gate = None
+    if energy_gate:
+        # Only run porcupine on audio that could contain speech
+        from .gate import EnergyGate
+
+        gate = EnergyGate(handle.frame_length, energy_ratio=energy_ratio)
+
+    if events_in_file or events_socket or mqtt_host:
+        # Audio and events are handled on the same event loop
+        bus = EventBus(
+            make_transport(
+                events_in_file,
+                events_out_file,
+                events_socket=events_socket,
+                mqtt_host=mqtt_host,
+                mqtt_port=mqtt_port,
+            ),
+            error_topic=EVENT_ERROR,
+        )
 
-    if events_in_file:
         listening = False
-
-        # Read thread
-        def read_audio():
-            nonlocal listening, handle, report_audio
-            try:
-                while True:
-                    chunk = audio_file.read(chunk_size)
-                    if len(chunk) == chunk_size:
-                        if listening:
-                            if report_audio:
-                                logger.debug("Receiving audio")
-                                send_event(EVENT_RECEIVING_AUDIO + request_id)
-                                report_audio = False
-
-                            # Process audio chunk
-                            chunk = struct.unpack_from(chunk_format, chunk)
-                            keyword_index = handle.process(chunk)
-
-                            if keyword_index:
-                                if len(keyword) == 1:
-                                    keyword_index = 0
-
-                                if keyword_index >= 0:
-                                    logger.debug(f"Keyword {keyword_index} detected")
-                                    result = {
-                                        "index": keyword_index,
-                                        "keyword": keyword[keyword_index],
-                                    }
-
-                                    send_event(EVENT_DETECTED + request_id, result)
-                    else:
-                        # Prevent 100% CPU usage
-                        time.sleep(0.01)
-            except Exception as e:
-                logger.exception("read_audio")
-
-        threading.Thread(target=read_audio, daemon=True).start()
+        listening_request_id = ""
+        report_audio = False
 
         if auto_start:
             logger.debug("Automatically started listening")
             listening = True
             report_audio = True
 
-        # Process events
-        for line in events_in_file:
-            line = line.strip()
-            if len(line) == 0:
-                continue
+        async def read_audio():
+            nonlocal report_audio
+            audio_buffer = bytearray()
+
+            # Ring buffer cursor at the end of audio_buffer (--audio-hub)
+            buffer_cursor: Optional[int] = None
+
+            async for chunk, chunk_cursor in read_chunks(audio_file, read_size):
+                if (buffer_cursor is not None) and (
+                    (chunk_cursor - (len(chunk) // 2)) != buffer_cursor
+                ):
+                    # Fell behind and skipped audio
+                    audio_buffer.clear()
+
+                audio_buffer += chunk
+                buffer_cursor = chunk_cursor
+                if len(audio_buffer) < chunk_size:
+                    continue
+
+                if listening:
+                    if report_audio:
+                        logger.debug("Receiving audio")
+                        bus.send(EVENT_RECEIVING_AUDIO + listening_request_id)
+                        report_audio = False
+
+                    # Process complete audio frames
+                    buffer_size = len(audio_buffer)
+                    for keyword_index, frame_end in process_frames(
+                        handle, keyword, audio_buffer, gate
+                    ):
+                        result = {
+                            "index": keyword_index,
+                            "keyword": keyword[keyword_index],
+                        }
+
+                        if buffer_cursor is not None:
+                            # Sample where the wake word ended
+                            result["audio_cursor"] = buffer_cursor - (
+                                (buffer_size - frame_end) // 2
+                            )
+
+                        bus.send(EVENT_DETECTED + listening_request_id, result)
+                else:
+                    # Drop complete frames
+                    del audio_buffer[
+                        : len(audio_buffer) - (len(audio_buffer) % chunk_size)
+                    ]
+
+        def handle_start(request_id: str, event: str):
+            nonlocal listening, listening_request_id, report_audio
+
+            # Clear buffer and start reading
+            listening = True
+            listening_request_id = request_id
+            report_audio = True
+
+            if gate is not None:
+                # Don't replay audio from before start
+                gate.reset()
+
+            logger.debug(f"Started listening (request_id={request_id})")
+            bus.send(EVENT_STARTED + request_id)
+
+        def handle_stop(request_id: str, event: str):
+            nonlocal listening, listening_request_id
+
+            # Stop reading and transcribe
+            listening = False
+            listening_request_id = request_id
+            logger.debug(f"Stopped listening (request_id={request_id})")
+
+            if gate is not None:
+                logger.debug(
+                    f"Energy gate passed {gate.frames_passed} frame(s), skipped {gate.frames_skipped}"
+                )
+
+            bus.send(EVENT_STOPPED + request_id)
+
+        # Replacement handles are loaded in the background, one at a time
+        reload_lock: Optional[asyncio.Lock] = None
+        reload_tasks: List[asyncio.Future] = []
+
+        async def reload_handle(request_id, event_dict, new_keyword):
+            nonlocal handle, keyword
+            async with reload_lock:
+                try:
+                    # Load porcupine in a thread
+                    start_time = time.time()
+                    new_handle = await asyncio.get_event_loop().run_in_executor(
+                        None,
+                        functools.partial(
+                            Porcupine,
+                            library,
+                            model,
+                            keyword_file_paths=new_keyword,
+                            sensitivities=sensitivities,
+                        ),
+                    )
+                    load_seconds = time.time() - start_time
+
+                    # Audio is processed on this loop, so the swap is atomic
+                    old_handle = handle
+                    handle, keyword = new_handle, new_keyword
+                    old_handle.delete()
+
+                    logger.debug(f"Reloaded porcupine in {load_seconds} second(s)")
+                    event_dict["load_seconds"] = load_seconds
+                    bus.send(EVENT_RELOADED + request_id, event_dict)
+                except Exception as e:
+                    logger.exception("reload")
+                    bus.send(EVENT_ERROR + request_id, {"error": str(e)})
+
+        def handle_reload(request_id: str, event: str):
+            nonlocal reload_tasks
+            logger.debug("Reloading keyword(s)")
+            event_dict = maybe_object(event)
+
+            new_keyword = event_dict.get("keyword", keyword)
+            if isinstance(new_keyword, str):
+                new_keyword = [new_keyword]
+
+            # Load porcupine without blocking detection
+            reload_tasks = [t for t in reload_tasks if not t.done()]
+            reload_tasks.append(
+                asyncio.ensure_future(
+                    reload_handle(request_id, event_dict, new_keyword)
+                )
+            )
+
+        bus.on(EVENT_START, handle_start)
+        bus.on(EVENT_STOP, handle_stop)
+        bus.on(EVENT_RELOAD, handle_reload)
+
+        async def handle_events():
+            nonlocal reload_lock
+            reload_lock = asyncio.Lock()
+
+            audio_task = asyncio.ensure_future(read_audio())
+            await bus.run()
+
+            if len(reload_tasks) > 0:
+                await asyncio.wait(reload_tasks)
+                bus.flush()
+
+            audio_task.cancel()
+
+        event_bus.run(handle_events())
+    else:
+        # Read all data from audio file, process, and stop
+        events_out = EventWriter(events_out_file)
+        audio_buffer = bytearray()
+        chunk = audio_file.read(read_size)
+        while len(chunk) > 0:
+            # Process complete audio frames
+            audio_buffer += chunk
+            for keyword_index, _ in process_frames(handle, keyword, audio_buffer, gate):
+                result = {"index": keyword_index, "keyword": keyword[keyword_index]}
+                events_out.send(None, result)
+
+            chunk = audio_file.read(read_size)
+
+
+def serve_wake_word(
+    streams: Dict[str, socket.socket],
+    events_out_file: TextIO,
+    library: str,
+    model: str,
+    keyword: List[str],
+    events_in_file: Optional[TextIO] = None,
+    sensitivity: List[float] = [],
+    auto_start: bool = False,
+    events_socket: Optional[str] = None,
+    mqtt_host: Optional[str] = None,
+    mqtt_port: int = 1883,
+    energy_gate: bool = False,
+    energy_ratio: float = 3.0,
+):
+    """Detects wake words in many UDP audio streams at once.
+
+    Each stream has its own porcupine handle, all loaded from the same
+    library, model, and keywords. Start/stop events are matched to a stream
+    by their "stream" property or request id, and apply to every stream
+    otherwise. Detections include the stream id.
+    """
+    # Ensure each keyword has a sensitivity value
+    sensitivities = sensitivity
+    while len(sensitivities) < len(keyword):
+        sensitivities.append(0.5)
+
+    def load_handles(new_keyword: List[str]) -> Dict[str, Porcupine]:
+        return {
+            stream_id: Porcupine(
+                library,
+                model,
+                keyword_file_paths=new_keyword,
+                sensitivities=sensitivities,
+            )
+            for stream_id in streams
+        }
 
-            logger.debug(line)
+    handles = load_handles(keyword)
 
+    logger.debug(
+        f"Loaded porcupine for {len(handles)} stream(s) (keywords={keyword}, sensitivities={sensitivities})"
+    )
+
+    make_gate = None
+    if energy_gate:
+        # Only run porcupine on audio that could contain speech
+        from .gate import EnergyGate
+
+        make_gate = functools.partial(EnergyGate, energy_ratio=energy_ratio)
+
+    wake_streams = {}
+    for stream_id, sock in streams.items():
+        handle = handles[stream_id]
+        gate = make_gate(handle.frame_length) if make_gate else None
+        wake_streams[stream_id] = WakeWordStream(stream_id, sock, handle, gate)
+
+        if auto_start:
+            wake_streams[stream_id].start("")
+
+    if auto_start:
+        logger.debug("Automatically started listening")
+
+    bus = EventBus(
+        make_transport(
+            events_in_file,
+            events_out_file,
+            events_socket=events_socket,
+            mqtt_host=mqtt_host,
+            mqtt_port=mqtt_port,
+        ),
+        error_topic=EVENT_ERROR,
+    )
+
+    def on_audio(stream: WakeWordStream, data: bytes):
+        if not stream.listening:
+            return
+
+        if stream.report_audio:
+            logger.debug(f"Receiving audio ({stream.stream_id})")
+            bus.send(
+                EVENT_RECEIVING_AUDIO + stream.request_id, {"stream": stream.stream_id}
+            )
+            stream.report_audio = False
+
+        # Process complete audio frames
+        stream.audio_buffer += data
+        for keyword_index, _ in process_frames(
+            stream.handle, keyword, stream.audio_buffer, stream.gate
+        ):
+            result = {
+                "index": keyword_index,
+                "keyword": keyword[keyword_index],
+                "stream": stream.stream_id,
+            }
+
+            bus.send(EVENT_DETECTED + stream.request_id, result)
+
+    def get_streams(request_id: str, event: str) -> List[WakeWordStream]:
+        """Returns the streams an event applies to."""
+        event_dict = maybe_object(event)
+        stream_id = event_dict.get("stream")
+        if stream_id is None:
+            if request_id[1:] in wake_streams:
+                # Request id names a stream
+                stream_id = request_id[1:]
+            else:
+                return list(wake_streams.values())
+
+        stream = wake_streams.get(str(stream_id))
+        if stream is None:
+            raise ValueError(f"Unknown audio stream: {stream_id}")
+
+        return [stream]
+
+    def handle_start(request_id: str, event: str):
+        for stream in get_streams(request_id, event):
+            stream.start(request_id)
+            logger.debug(
+                f"Started listening on {stream.stream_id} (request_id={request_id})"
+            )
+
+        bus.send(EVENT_STARTED + request_id)
+
+    def handle_stop(request_id: str, event: str):
+        for stream in get_streams(request_id, event):
+            stream.stop(request_id)
+            logger.debug(
+                f"Stopped listening on {stream.stream_id} (request_id={request_id})"
+            )
+
+        bus.send(EVENT_STOPPED + request_id)
+
+    # Replacement handles are loaded in the background, one set at a time
+    reload_lock: Optional[asyncio.Lock] = None
+    reload_tasks: List[asyncio.Future] = []
+
+    async def reload_handles(request_id, event_dict, new_keyword):
+        nonlocal keyword
+        async with reload_lock:
             try:
-                # Expected <topic> <payload> on each line
-                topic, event = line.split(" ", maxsplit=1)
-                topic_parts = topic.split("/")
-                base_topic = "/".join(topic_parts[:3])
-
-                # Everything after base topic is request id
-                request_id = "/".join(topic_parts[3:])
-                if len(request_id) > 0:
-                    request_id = "/" + request_id
-
-                if base_topic == EVENT_START:
-                    # Clear buffer and start reading
-                    listening = True
-                    report_audio = True
-                    logger.debug(f"Started listening (request_id={request_id})")
-                    send_event(EVENT_STARTED + request_id)
-                elif base_topic == EVENT_STOP:
-                    # Stop reading and transcribe
-                    listening = False
-                    logger.debug(f"Stopped listening (request_id={request_id})")
-                    send_event(EVENT_STOPPED + request_id)
-                elif base_topic == EVENT_RELOAD:
-                    logger.debug("Reloading keyword(s)")
-                    event_dict = maybe_object(event)
-
-                    keyword = event_dict.get("keyword", keyword)
-                    if isinstance(keyword, str):
-                        keyword = [keyword]
-
-                    # Load porcupine
-                    handle = Porcupine(
-                        library,
-                        model,
-                        keyword_file_paths=keyword,
-                        sensitivities=sensitivities,
-                    )
-                    send_event(EVENT_RELOADED + request_id, event_dict)
+                # Load porcupine in a thread
+                start_time = time.time()
+                new_handles = await asyncio.get_event_loop().run_in_executor(
+                    None, load_handles, new_keyword
+                )
+                load_seconds = time.time() - start_time
+
+                # Audio is processed on this loop, so the swap is atomic
+                for stream_id, stream in wake_streams.items():
+                    old_handle = stream.handle
+                    stream.handle = new_handles[stream_id]
+                    old_handle.delete()
+
+                keyword = new_keyword
+
+                logger.debug(f"Reloaded porcupine in {load_seconds} second(s)")
+                event_dict["load_seconds"] = load_seconds
+                bus.send(EVENT_RELOADED + request_id, event_dict)
             except Exception as e:
-                logger.exception(line)
-                send_event(EVENT_ERROR + request_id, {"error": str(e)})
+                logger.exception("reload")
+                bus.send(EVENT_ERROR + request_id, {"error": str(e)})
+
+    def handle_reload(request_id: str, event: str):
+        nonlocal reload_tasks
+        logger.debug("Reloading keyword(s)")
+        event_dict = maybe_object(event)
+
+        new_keyword = event_dict.get("keyword", keyword)
+        if isinstance(new_keyword, str):
+            new_keyword = [new_keyword]
+
+        # Load porcupine without blocking detection
+        reload_tasks = [t for t in reload_tasks if not t.done()]
+        reload_tasks.append(
+            asyncio.ensure_future(reload_handles(request_id, event_dict, new_keyword))
+        )
+
+    bus.on(EVENT_START, handle_start)
+    bus.on(EVENT_STOP, handle_stop)
+    bus.on(EVENT_RELOAD, handle_reload)
+
+    async def handle_events():
+        nonlocal reload_lock
+        reload_lock = asyncio.Lock()
+
+        # One datagram endpoint per stream
+        loop = asyncio.get_event_loop()
+        transports = []
+        for stream in wake_streams.values():
+            transport, _ = await loop.create_datagram_endpoint(
+                functools.partial(StreamProtocol, stream, on_audio), sock=stream.sock
+            )
+            transports.append(transport)
+
+        await bus.run()
+
+        if len(reload_tasks) > 0:
+            await asyncio.wait(reload_tasks)
+            bus.flush()
+
+        for transport in transports:
+            transport.close()
+
+    event_bus.run(handle_events())
+
+
+# -------------------------------------------------------------------------------------------------
+
+
+class WakeWordStream:
+    """Porcupine handle and listening state for one audio stream."""
+
+    def __init__(
+        self,
+        stream_id: str,
+        sock: socket.socket,
+        handle: Porcupine,
+        gate: Optional[Any] = None,
+    ):
+        self.stream_id = stream_id
+        self.sock = sock
+        self.handle = handle
+        self.gate = gate
+
+        self.listening = False
+        self.request_id = ""
+        self.report_audio = False
+
+        # Partial frame left over from the last packet
+        self.audio_buffer = bytearray()
+
+    def start(self, request_id: str):
+        self.listening = True
+        self.request_id = request_id
+        self.report_audio = True
+        self.audio_buffer.clear()
+
+        if self.gate is not None:
+            # Don't replay audio from before start
+            self.gate.reset()
+
+    def stop(self, request_id: str):
+        self.listening = False
+        self.request_id = request_id
+
+
+class StreamProtocol(asyncio.DatagramProtocol):
+    """Passes UDP audio packets for a stream to a callback."""
+
+    def __init__(self, stream: WakeWordStream, on_audio):
+        self.stream = stream
+        self.on_audio = on_audio
+
+    def datagram_received(self, data, addr):
+        self.on_audio(self.stream, data)
+
+    def error_received(self, exc):
+        logger.error(f"{self.stream.stream_id}: {exc}")
+
+
+def bind_udp_stream(
+    stream_arg: str, host: str = "0.0.0.0"
+) -> Tuple[str, socket.socket]:
+    """Binds a UDP socket for a [NAME=][HOST:]PORT stream argument."""
+    stream_id, address = None, stream_arg
+    if "=" in stream_arg:
+        stream_id, address = stream_arg.split("=", maxsplit=1)
+
+    if ":" in address:
+        host, port_str = address.rsplit(":", maxsplit=1)
     else:
-        # Read all data from audio file, process, and stop
-        chunk = audio_file.read(chunk_size)
-        while len(chunk) == chunk_size:
-            # Process audio chunk
-            chunk = struct.unpack_from(chunk_format, chunk)
-            keyword_index = handle.process(chunk)
+        port_str = address
+
+    port = int(port_str)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+
+    logger.debug(f"Listening for UDP audio on {host}:{port}")
+
+    return (stream_id or str(port), sock)
+
+
+# -------------------------------------------------------------------------------------------------
+
+
+def process_frames(
+    handle: Porcupine,
+    keyword: List[str],
+    audio_buffer: bytearray,
+    gate: Optional[Any] = None,
+) -> List[Tuple[int, int]]:
+    """Runs porcupine on each complete frame, removing them from the buffer.
+
+    Frames are handed to porcupine as views of the buffer (no unpacking). If
+    an energy gate is given, only frames it lets through are processed.
+    Returns (keyword index, end of detected frame) for each detection, where
+    the end is a byte offset from the start of the buffer.
+    """
+    chunk_size = handle.frame_length * 2
+    num_frames = len(audio_buffer) // chunk_size
+    detected = []
+
+    with memoryview(audio_buffer) as audio_view:
+        if gate is not None:
+            frames = gate.filter(audio_view[: num_frames * chunk_size])
+        else:
+            frames = [
+                (offset + chunk_size, audio_view[offset : offset + chunk_size])
+                for offset in range(0, num_frames * chunk_size, chunk_size)
+            ]
+
+        for frame_end, frame in frames:
+            keyword_index = handle.process(frame)
 
             if keyword_index:
                 if len(keyword) == 1:
@@ -187,20 +593,15 @@ def wait_for_wake_word(
 
                 if keyword_index >= 0:
                     logger.debug(f"Keyword {keyword_index} detected")
-                    result = {"index": keyword_index, "keyword": keyword[keyword_index]}
-                    send_event(EVENT_DETECTED, result, show_event=False)
-
-            chunk = audio_file.read(chunk_size)
+                    detected.append((keyword_index, frame_end))
 
+        # Release views before the buffer is resized
+        frames = frame = None
 
-# -------------------------------------------------------------------------------------------------
-
+    # Keep partial frame
+    del audio_buffer[: num_frames * chunk_size]
 
-def maybe_object(json_str):
-    try:
-        return json.loads(json_str)
-    except:
-        return {}
+    return detected
 
 
 # -------------------------------------------------------------------------------------------------
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+import logging
+
+logger = logging.getLogger("porcupine_rhasspy.gate")
+
+from collections import deque
+from typing import Deque, List, Tuple, Union
+
+import numpy as np
+
+# -------------------------------------------------------------------------------------------------
+
+
+class EnergyGate:
+    """Cheap pre-filter that skips frames which can't contain speech.
+
+    Each frame's RMS energy and zero-crossing rate are compared against an
+    adaptive noise floor. Frames that are loud enough (or are quieter but
+    have the high zero-crossing rate of a fricative) open the gate, which
+    stays open for hangover_frames afterwards. Skipped frames are kept in a
+    lookback buffer and replayed when the gate opens, so the start of a wake
+    word is never lost.
+    """
+
+    def __init__(
+        self,
+        frame_length: int,
+        energy_ratio: float = 3.0,
+        lookback_frames: int = 16,
+        hangover_frames: int = 16,
+        min_floor: float = 50.0,
+        fricative_ratio: float = 1.5,
+        fricative_zcr: float = 0.3,
+        floor_rise: float = 0.005,
+        floor_fall: float = 0.2,
+    ):
+        self.frame_length = frame_length
+        self.frame_bytes = frame_length * 2
+
+        # Speech is this many times louder than the noise floor (RMS)
+        self.energy_ratio = energy_ratio
+
+        # Quieter frames still count if they cross zero often enough
+        self.fricative_ratio = fricative_ratio
+        self.fricative_zcr = fricative_zcr
+
+        # Noise floor follows quiet frames quickly and loud ones slowly
+        self.min_floor = min_floor
+        self.floor_rise = floor_rise
+        self.floor_fall = floor_fall
+        self.noise_floor = min_floor
+
+        self.hangover_frames = hangover_frames
+        self._hangover = 0
+
+        # (end position, frame) of recently skipped frames
+        self._lookback: Deque[Tuple[int, bytes]] = deque(maxlen=lookback_frames)
+
+        # Bytes of audio filtered so far
+        self._position = 0
+
+        # Frame counts
+        self.frames_passed = 0
+        self.frames_skipped = 0
+
+    def filter(
+        self, audio: Union[bytes, memoryview]
+    ) -> List[Tuple[int, Union[bytes, memoryview]]]:
+        """Returns the frames porcupine should process, in order.
+
+        audio must hold complete 16-bit frames. Returned frames are either
+        views of audio or copies of earlier frames from the lookback buffer,
+        each paired with the offset of its end relative to the start of audio
+        (negative for frames from earlier calls).
+        """
+        num_frames = len(audio) // self.frame_bytes
+        if num_frames == 0:
+            return []
+
+        # Features for all frames at once
+        samples = np.frombuffer(
+            audio, dtype=np.int16, count=num_frames * self.frame_length
+        ).reshape(num_frames, self.frame_length)
+
+        float_samples = samples.astype(np.float32)
+        frame_rms = np.sqrt(np.mean(float_samples * float_samples, axis=1))
+
+        signs = np.signbit(samples)
+        frame_zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+
+        # Release audio buffer before frames are handed out
+        del samples, signs
+
+        start_position = self._position
+        frames: List[Tuple[int, Union[bytes, memoryview]]] = []
+        for frame_idx in range(num_frames):
+            rms = float(frame_rms[frame_idx])
+            offset = frame_idx * self.frame_bytes
+            frame = audio[offset : offset + self.frame_bytes]
+            frame_end = offset + self.frame_bytes
+
+            is_speech = (rms > (self.noise_floor * self.energy_ratio)) or (
+                (rms > (self.noise_floor * self.fricative_ratio))
+                and (frame_zcr[frame_idx] > self.fricative_zcr)
+            )
+
+            if is_speech:
+                self._hangover = self.hangover_frames
+
+                if len(self._lookback) > 0:
+                    # Replay audio from just before the gate opened
+                    frames.extend(
+                        (position - start_position, lookback_frame)
+                        for position, lookback_frame in self._lookback
+                    )
+                    self.frames_passed += len(self._lookback)
+                    self.frames_skipped -= len(self._lookback)
+                    self._lookback.clear()
+
+                frames.append((frame_end, frame))
+                self.frames_passed += 1
+            elif self._hangover > 0:
+                # Keep gate open a little longer
+                frames.append((frame_end, frame))
+                self.frames_passed += 1
+                self._hangover -= 1
+            else:
+                self._lookback.append((start_position + frame_end, bytes(frame)))
+                self.frames_skipped += 1
+
+            # Adapt noise floor
+            rate = self.floor_rise if rms > self.noise_floor else self.floor_fall
+            self.noise_floor = max(
+                self.min_floor, self.noise_floor + (rate * (rms - self.noise_floor))
+            )
+
+        self._position += num_frames * self.frame_bytes
+
+        return frames
+
+    def reset(self):
+        """Closes the gate and forgets buffered audio (noise floor is kept)."""
+        self._hangover = 0
+        self._lookback.clear()
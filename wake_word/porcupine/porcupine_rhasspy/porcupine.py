@@ -144,14 +144,15 @@ class Porcupine(object):
 
         :param pcm: An array (or array-like) of consecutive audio samples. For more information regarding required audio
         properties (i.e. sample rate, number of channels encoding, and number of samples per frame) please refer to
-        'include/pv_porcupine.h'.
+        'include/pv_porcupine.h'. Raw 16-bit audio (bytes, bytearray, memoryview, or a NumPy int16 array) is passed to
+        the library without being converted.
         :return: For a single wake-word use cse True if wake word is detected. For multiple wake-word use case it
         returns the index of detected wake-word. Indexing is 0-based and according to ordering of input keyword file
         paths. It returns -1 when no keyword is detected.
         """
 
         result = c_int()
-        status = self.process_func(self._handle, (c_short * len(pcm))(*pcm), byref(result))
+        status = self.process_func(self._handle, self._pcm_pointer(pcm), byref(result))
         if status is not self.PicovoiceStatuses.SUCCESS:
             raise self._PICOVOICE_STATUS_TO_EXCEPTION[status]('Processing failed')
 
@@ -162,6 +163,27 @@ class Porcupine(object):
         else:
             return keyword_index
 
+    def _pcm_pointer(self, pcm):
+        """Returns a pointer to one frame of samples, avoiding copies where possible."""
+
+        if isinstance(pcm, (list, tuple)):
+            return (c_short * len(pcm))(*pcm)
+
+        frame_bytes = self._frame_length * sizeof(c_short)
+        if isinstance(pcm, bytes):
+            # Points into the bytes object, which outlives the call
+            if len(pcm) < frame_bytes:
+                raise ValueError('Expected %d bytes of audio, got %d' % (frame_bytes, len(pcm)))
+
+            return cast(pcm, POINTER(c_short))
+
+        try:
+            # Writable buffers (bytearray, NumPy arrays, ...) are shared
+            return (c_short * self._frame_length).from_buffer(pcm)
+        except TypeError:
+            # Read-only buffer (e.g., memoryview of bytes)
+            return (c_short * self._frame_length).from_buffer_copy(pcm)
+
     def delete(self):
         """Releases resources acquired by Porcupine's library."""
 
@@ -0,0 +1,70 @@
+import unittest
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+import numpy as np
+
+from wake_word.porcupine.porcupine_rhasspy.gate import EnergyGate
+
+# Porcupine frame length (samples)
+frame_length = 512
+frame_bytes = frame_length * 2
+
+silence = bytes(frame_bytes)
+loud = (
+    np.where(np.arange(frame_length) % 2 == 0, 5000, -5000).astype(np.int16).tobytes()
+)
+
+
+class EnergyGateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.gate = EnergyGate(frame_length, lookback_frames=4, hangover_frames=2)
+
+    def test_silence_skipped(self):
+        self.assertEqual(self.gate.filter(silence * 6), [])
+        self.assertEqual(self.gate.frames_passed, 0)
+        self.assertEqual(self.gate.frames_skipped, 6)
+
+        # Partial frames are ignored
+        self.assertEqual(self.gate.filter(silence[:100]), [])
+
+    def test_open_hangover_lookback(self):
+        self.gate.filter(silence * 6)
+
+        frames = self.gate.filter(loud + (silence * 3))
+        offsets = [offset for offset, frame in frames]
+
+        # Last 4 skipped frames (from the previous call) are replayed first,
+        # then the loud frame and 2 frames of hangover.
+        self.assertEqual(
+            offsets,
+            [-3 * frame_bytes, -2 * frame_bytes, -frame_bytes, 0]
+            + [frame_bytes, 2 * frame_bytes, 3 * frame_bytes],
+        )
+
+        self.assertEqual([bytes(frame) for _, frame in frames[:4]], [silence] * 4)
+        self.assertEqual(bytes(frames[4][1]), loud)
+        self.assertEqual([bytes(frame) for _, frame in frames[5:]], [silence] * 2)
+
+        # Gate closed after hangover
+        self.assertEqual(self.gate.frames_passed, 7)
+        self.assertEqual(self.gate.frames_skipped, 3)
+
+    def test_reset(self):
+        self.gate.filter(silence * 6)
+        self.gate.filter(loud)
+        self.gate.reset()
+
+        # No hangover or replay after reset
+        self.assertEqual(self.gate.filter(silence), [])
+        self.gate.reset()
+        self.assertEqual(
+            [offset for offset, _ in self.gate.filter(loud)], [frame_bytes]
+        )
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()